@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import time
+
+import defopt
+import numpy as np
+import pandas as pd
+
+from gp_features import _prepare_X, prepare_X, prepare_Xy, stack_Xy
+
+
+def make_dataset(n_trials, min_nt, max_nt, seed):
+    """create a synthetic dataset with random stimuli and reaction-times"""
+    rng = np.random.RandomState(seed)
+    nts = rng.randint(min_nt, max_nt + 1, n_trials)
+    rt = np.floor(rng.rand(n_trials) * nts * 1.2)
+    rt[rt >= nts] = np.nan  # misses
+    return pd.DataFrame({
+        'ys': [rng.randn(nt) for nt in nts],
+        'rt': rt,
+        'hazard_code': rng.randint(0, 2, n_trials),
+        'mouse_code': rng.randint(0, 6, n_trials)
+    })
+
+
+def loop_prepare_X(dset, n_lags, max_nt):
+    """reference implementation, one trial at a time"""
+    return [
+        _prepare_X(dset_row, n_lags, max_nt) for _, dset_row in dset.iterrows()
+    ]
+
+
+def loop_prepare_Xy(dset, n_lags, max_nt):
+    """reference implementation, one trial at a time"""
+    Xs, ys = [], []
+    for _, row in dset.iterrows():
+        X = _prepare_X(row, n_lags, max_nt)
+        y = np.zeros((len(X), 1))
+        if not np.isnan(row.rt):
+            last_idx = int(row.rt) + 1
+            X, y = X[:last_idx], y[:last_idx]
+            y[-1] = 1
+        Xs.append(X)
+        ys.append(y)
+    return Xs, ys
+
+
+def timeit(func, n_repeats):
+    """best wall-clock time over several repeats, and last result"""
+    timings = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main(*, n_trials=5000, min_nt=20, max_nt=400, nlags=50, n_repeats=3,
+         seed=12345):
+    """Benchmark lagged data builders against the per-trial reference
+
+    :param int n_trials: number of synthetic trials
+    :param int min_nt: minimum number of time steps per trial
+    :param int max_nt: maximum number of time steps per trial
+    :param int nlags: number of past stimulus to include for each observation
+    :param int n_repeats: number of repetitions for each timing
+    :param int seed: random seed for the synthetic dataset
+
+    """
+
+    dset = make_dataset(n_trials, min_nt, max_nt, seed)
+
+    t_loop_X, Xs_loop = timeit(
+        lambda: loop_prepare_X(dset, nlags, max_nt), n_repeats
+    )
+    t_X, Xs = timeit(lambda: prepare_X(dset, nlags, max_nt), n_repeats)
+    assert all(np.array_equal(X, X_ref) for X, X_ref in zip(Xs, Xs_loop))
+
+    t_loop_Xy, (Xs_loop, ys_loop) = timeit(
+        lambda: loop_prepare_Xy(dset, nlags, max_nt), n_repeats
+    )
+    t_Xy, (Xs, ys) = timeit(lambda: prepare_Xy(dset, nlags, max_nt), n_repeats)
+    assert all(np.array_equal(X, X_ref) for X, X_ref in zip(Xs, Xs_loop))
+    assert all(np.array_equal(y, y_ref) for y, y_ref in zip(ys, ys_loop))
+
+    t_stack, (X_train, y_train, _) = timeit(
+        lambda: stack_Xy(dset, nlags, max_nt), n_repeats
+    )
+    assert np.array_equal(X_train, np.vstack(Xs_loop))
+    assert np.array_equal(y_train, np.vstack(ys_loop))
+
+    print('{} trials, {} rows, {} lags'.format(n_trials, len(X_train), nlags))
+    print('prepare_X   loop {:8.3f}s  vectorized {:8.3f}s  (x{:.1f})'
+          .format(t_loop_X, t_X, t_loop_X / t_X))
+    print('prepare_Xy  loop {:8.3f}s  vectorized {:8.3f}s  (x{:.1f})'
+          .format(t_loop_Xy, t_Xy, t_loop_Xy / t_Xy))
+    print('stack_Xy    loop {:8.3f}s  vectorized {:8.3f}s  (x{:.1f})'
+          .format(t_loop_Xy, t_stack, t_loop_Xy / t_stack))
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import subprocess
+import sys
+from pathlib import Path
+
+import defopt
+
+# scripts which neither fit nor predict, expected to start quickly
+ANALYSIS_SCRIPTS = [
+    'gp_ppc', 'gp_score', 'plot_orsolic_paper', 'plot_models',
+    'plot_lesioned_models', 'show_posterior', 'bench_prepare_X'
+]
+
+# dependencies which should only be loaded to fit or predict
+HEAVY_MODULES = ['tensorflow', 'gpflow', 'sklearn']
+
+IMPORT_CODE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed, ','.join(heavy))
+'''
+
+
+def time_import(module, src_dir):
+    """import time of a module in a fresh interpreter, and heavy modules"""
+    code = IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=str(src_dir), check=True,
+        stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout.split()
+    return float(output[0]), output[1:]
+
+
+def main(*modules, n_repeats=3, max_time=1.0):
+    """Benchmark start-up time of analysis scripts
+
+    Each module is imported in a fresh interpreter, reporting the best import
+    time over several repeats and heavy dependencies loaded by the import.
+
+    :param str modules: modules to import (default: analysis scripts not
+                        fitting nor predicting)
+    :param int n_repeats: number of repetitions for each timing
+    :param float max_time: maximum import time, in seconds, before a module
+                           is flagged as slow
+
+    """
+
+    src_dir = Path(__file__).resolve().parent
+    modules = modules or ANALYSIS_SCRIPTS
+
+    slow_modules = []
+    for module in modules:
+        timings = []
+        for _ in range(n_repeats):
+            elapsed, heavy = time_import(module, src_dir)
+            timings.append(elapsed)
+        status = 'ok'
+        if heavy or min(timings) > max_time:
+            status = 'SLOW'
+            slow_modules.append(module)
+        print('{:25s} {:8.3f}s  {:4s} {}'.format(
+            module, min(timings), status, ' '.join(heavy)
+        ))
+
+    if slow_modules:
+        sys.exit('slow start-up: {}'.format(', '.join(slow_modules)))
+
+
+if __name__ == "__main__":
+    defopt.run(main)
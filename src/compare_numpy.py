@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+from pathlib import Path
+
+import defopt
+import numpy as np
+import tensorflow as tf
+import gpflow
+
+import gp_numpy
+from gp_model import load_model, stack_Xy, precision_settings
+from trial_store import read_dataset
+
+
+def predict(model, X, batch_size, components):
+    """posterior mean, variance and additive components, with timing"""
+    start = time.perf_counter()
+    fmean, fvar, fparts = [], [], []
+    for i in range(0, len(X), batch_size):
+        X_batch = X[i:i + batch_size]
+        fmean_batch, fvar_batch = model.predict_f(X_batch)
+        fmean.append(fmean_batch)
+        fvar.append(fvar_batch)
+        if components:
+            fparts.append(np.hstack(model.predict_f_partial(X_batch)))
+    elapsed = time.perf_counter() - start
+
+    fparts = np.vstack(fparts) if components else None
+    return np.vstack(fmean), np.vstack(fvar), fparts, elapsed
+
+
+def main(result_dir, *, fold='test', batch_size=10000, max_diff=1e-6):
+    """Compare predictions of a fitted model with gpflow and NumPy backends
+
+    Models with variational posteriors for the kernel hyperparameters need to
+    be converted first (see gp_convert.py).
+
+    :param str result_dir: directory of the fitted Gaussian process
+    :param str fold: data fold used for comparison, 'train', 'val' or 'test'
+    :param int batch_size: number of rows predicted at once
+    :param float max_diff: maximum absolute difference allowed between
+                           backends
+
+    """
+
+    result_path = Path(result_dir)
+    dset = read_dataset(result_path)
+
+    model_np = gp_numpy.load_model(result_path)
+    components = isinstance(model_np.kern, gp_numpy.Sum)
+    X, _, _ = stack_Xy(dset[dset[fold]], model_np.n_lags, model_np.max_nt)
+
+    fmean_np, fvar_np, comps_np, time_np = predict(
+        model_np, X, batch_size, components
+    )
+
+    # build the gpflow model in its own graph, in double precision as NumPy
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph).as_default(), \
+            gpflow.settings.temp_settings(precision_settings('float64')):
+        model_tf = load_model(result_path)
+        fmean_tf, fvar_tf, comps_tf, time_tf = predict(
+            model_tf, X, batch_size, components
+        )
+
+    diffs = [
+        ('mean', np.abs(fmean_np - fmean_tf)),
+        ('variance', np.abs(fvar_np - fvar_tf))
+    ]
+    if components:
+        diffs.append(('components', np.abs(comps_np - comps_tf)))
+
+    print('{} trials, {} rows ({} fold)'
+          .format(dset[fold].sum(), len(X), fold))
+    for name, diff in diffs:
+        print('{:12s} abs. diff.   max {:.3e}  mean {:.3e}'
+              .format(name, diff.max(), diff.mean()))
+    print('prediction time  gpflow {:8.3f}s  numpy {:8.3f}s  (x{:.1f})'
+          .format(time_tf, time_np, time_tf / time_np))
+
+    mismatches = [name for name, diff in diffs if diff.max() > max_diff]
+    if mismatches:
+        sys.exit('backends differ: {}'.format(', '.join(mismatches)))
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import time
+from pathlib import Path
+
+import defopt
+import numpy as np
+import tensorflow as tf
+import gpflow
+
+from gp_model import load_model, stack_Xy, precision_settings, predict_logpmf
+from gp_score import observed_logprob
+from trial_store import read_dataset
+
+
+def evaluate(result_path, dset, fold, precision, batch_size):
+    """predictions of a fitted model, evaluated with a given precision"""
+
+    # build each model in its own graph, to avoid mixing float types
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph).as_default(), \
+            gpflow.settings.temp_settings(precision_settings(precision)):
+        model = load_model(result_path)
+
+        X, y, _ = stack_Xy(dset[dset[fold]], model.n_lags, model.max_nt)
+        start = time.perf_counter()
+        logit_hazard, logp = [], []
+        for i in range(0, len(X), batch_size):
+            X_batch, y_batch = X[i:i + batch_size], y[i:i + batch_size]
+            logit_hazard.append(model.predict_f(X_batch)[0])
+            logp.append(model.predict_density(X_batch, y_batch))
+        elapsed = time.perf_counter() - start
+
+    logit_hazard = np.vstack(logit_hazard).astype(float)
+    logp = np.vstack(logp).astype(float).sum()
+
+    return logit_hazard, logp, elapsed
+
+
+def evaluate_logpmf(result_path, dset, fold, precision, n_samples, method):
+    """observed log-probability of reaction times, from sampled log-PMFs"""
+
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph).as_default(), \
+            gpflow.settings.temp_settings(precision_settings(precision)):
+        model = load_model(result_path)
+        dset = dset[dset[fold]]
+        log_pmf = predict_logpmf(model, dset, n_samples, method=method)
+
+    return observed_logprob(log_pmf, dset.rt).sum()
+
+
+def main(result_dir, *, fold='test', batch_size=100000, nsamples=None):
+    """Compare predictions of a fitted model in single and double precision
+
+    :param str result_dir: directory of the fitted Gaussian process
+    :param str fold: data fold used for comparison, 'train', 'val' or 'test'
+    :param int batch_size: number of rows predicted at once
+    :param int nsamples: number of samples used to also compare log-PMFs
+                         sampled through inducing variables, in both
+                         precisions, against the 'cholesky' method, not
+                         computed by default
+
+    """
+
+    # fix seed for reproducibility
+    np.random.seed(12345)
+
+    result_path = Path(result_dir)
+    dset = read_dataset(result_path)
+
+    hazard_64, logp_64, time_64 = evaluate(
+        result_path, dset, fold, 'float64', batch_size
+    )
+    hazard_32, logp_32, time_32 = evaluate(
+        result_path, dset, fold, 'float32', batch_size
+    )
+
+    hazard_diff = np.abs(hazard_32 - hazard_64)
+    print('{} trials, {} rows ({} fold)'
+          .format(dset[fold].sum(), len(hazard_64), fold))
+    print('logit-hazard abs. diff.   max {:.3e}  mean {:.3e}'
+          .format(hazard_diff.max(), hazard_diff.mean()))
+    rel_diff = abs(logp_32 - logp_64) / abs(logp_64)
+    print('log-likelihood   float64 {:.6f}  float32 {:.6f}  '
+          '(rel. diff. {:.3e})'.format(logp_64, logp_32, rel_diff))
+    print('prediction time  float64 {:8.3f}s  float32 {:8.3f}s  (x{:.1f})'
+          .format(time_64, time_32, time_64 / time_32))
+
+    if nsamples is None:
+        return
+
+    # log-PMFs differ by Monte-Carlo noise, and the 'inducing' method drops
+    # the variance of f | u, hence only approximate agreement is expected
+    logprobs = [
+        ('cholesky', 'float64'), ('inducing', 'float64'),
+        ('inducing', 'float32')
+    ]
+    for method, precision in logprobs:
+        logprob = evaluate_logpmf(
+            result_path, dset, fold, precision, nsamples, method
+        )
+        print('observed log-prob.  {:8s} {}  {:.6f}'
+              .format(method, precision, logprob))
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -7,6 +7,7 @@ import gpflow
 from gpflow.params import Parameter
 import tensorflow as tf
 from tensorflow.contrib.distributions import Normal, Gamma, bijectors
+from tensorflow.contrib.graph_editor import graph_replace
 
 
 def get_support_transform(distribution):
@@ -17,7 +18,7 @@ def get_support_transform(distribution):
 
 
 Factor = namedtuple(
-    'Factor', ['sample', 'elbo_part', 'tensors', 'init_tensors']
+    'Factor', ['sample', 'elbo_part', 'tensors', 'init_tensors', 'transform']
 )
 
 
@@ -50,14 +51,51 @@ def build_factor(name, prior, shape=None):
 
     tensors = (loc, log_scale)
     init_tensors = (init_loc, init_log_scale)
-    return Factor(sample, elbo_part, tensors, init_tensors)
+    return Factor(sample, elbo_part, tensors, init_tensors, transform)
 
 
-class FVGP(gpflow.models.SVGP):
+# default and maximum number of hyperparameters draws per graph call, as each
+# draw adds a copy of the prediction graph (see `FVGP.batch_samples`)
+SAMPLES_CHUNK_SIZE = 10
+MAX_SAMPLES_CHUNK_SIZE = 50
 
-    def __init__(self, *args, priors=None, extra_factors=None, **kwargs):
+
+class CastInputsMixin:
+    """SVGP mixin casting double precision inputs to the model float type
+
+    Autoflow placeholders are created with the float type set when gpflow is
+    imported, so inputs are cast to allow fitting models in single precision.
+    """
+
+    def _build_predict(self, Xnew, *args, **kwargs):
+        Xnew = tf.cast(Xnew, gpflow.settings.float_type)
+        return super()._build_predict(Xnew, *args, **kwargs)
+
+    @gpflow.autoflow((tf.float64, [None, None]), (tf.float64, [None, None]))
+    def predict_density(self, Xnew, Ynew):
+        pred_f_mean, pred_f_var = self._build_predict(Xnew)
+        Ynew = tf.cast(Ynew, gpflow.settings.float_type)
+        return self.likelihood.predict_density(pred_f_mean, pred_f_var, Ynew)
+
+
+class FVGP(CastInputsMixin, gpflow.models.SVGP):
+    """SVGP with approximate posteriors over kernel hyperparameters
+
+    Predictions average over `samples_chunk_size` hyperparameters draws per
+    graph call, which bounds their memory usage and the size of their graph.
+    It is fixed when the model is created, as graphs are only built once.
+    """
+
+    def __init__(self, *args, priors=None, extra_factors=None,
+                 samples_chunk_size=SAMPLES_CHUNK_SIZE, **kwargs):
         super().__init__(*args, **kwargs)
 
+        if not 0 < samples_chunk_size <= MAX_SAMPLES_CHUNK_SIZE:
+            raise ValueError(
+                'Samples chunk size should be between 1 and {}.'
+                .format(MAX_SAMPLES_CHUNK_SIZE)
+            )
+        self._samples_chunk_size = samples_chunk_size
         self._advi_values = {}
         self.factors = {}
 
@@ -91,6 +129,10 @@ class FVGP(gpflow.models.SVGP):
             for tensor in self.advi_tensors
         ]
 
+    @property
+    def samples_chunk_size(self):
+        return self._samples_chunk_size
+
     @property
     def advi_tensors(self):
         tensors = (factor.tensors for factor in self.factors.values())
@@ -147,11 +189,73 @@ class FVGP(gpflow.models.SVGP):
         elbo_parts = [factor.elbo_part for factor in self.factors.values()]
         return objective - tf.reduce_sum(elbo_parts)
 
-    def predict_density(self, Xnew, Ynew, nsamples=50):
-        samples = [
-            super(FVGP, self).predict_density(Xnew, Ynew)
-            for _ in range(nsamples)
+    def batch_samples(self, tensors, batch_size, random_tensors=()):
+        """copies of tensors, each one using its own factors draw
+
+        Copies are stacked along a new leading dimension. Tensors given in
+        `random_tensors` are standard normal draws, redrawn for each copy.
+
+        Factors draws cannot be broadcast through the model instead, as gpflow
+        kernels only accept inputs and parameters without a batch dimension,
+        hence one copy of the graph per draw, up to `MAX_SAMPLES_CHUNK_SIZE`.
+        """
+        if not 0 < batch_size <= MAX_SAMPLES_CHUNK_SIZE:
+            raise ValueError(
+                'Batch size should be between 1 and {}.'
+                .format(MAX_SAMPLES_CHUNK_SIZE)
+            )
+
+        replacements = {}
+        for factor in self.factors.values():
+            loc, log_scale = factor.tensors
+            raw_samples = Normal(loc, tf.exp(log_scale)).sample(batch_size)
+            replacements[factor.sample] = factor.transform.forward(raw_samples)
+        for tensor in random_tensors:
+            shape = tf.concat([[batch_size], tf.shape(tensor)], axis=0)
+            replacements[tensor] = tf.random_normal(shape, dtype=tensor.dtype)
+
+        copies = [
+            graph_replace(tensors, {
+                tensor: batch[i] for tensor, batch in replacements.items()
+            })
+            for i in range(batch_size)
         ]
+        return [tf.stack(tensor_copies) for tensor_copies in zip(*copies)]
+
+    @gpflow.autoflow((tf.float64, [None, None]), (tf.float64, [None, None]))
+    def _predict_density_batch(self, Xnew, Ynew):
+        pred_f_mean, pred_f_var = self._build_predict(Xnew)
+        Ynew = tf.cast(Ynew, gpflow.settings.float_type)
+        density = self.likelihood.predict_density(
+            pred_f_mean, pred_f_var, Ynew
+        )
+        density, = self.batch_samples([density], self.samples_chunk_size)
+        return density
+
+    @gpflow.autoflow((tf.float64, [None, None]))
+    def _predict_f_samples_batch(self, Xnew):
+        float_type = gpflow.settings.float_type
+        mu, var = self._build_predict(Xnew, full_cov=True)
+        jitter = gpflow.settings.jitter
+        L = tf.cholesky(
+            var[0, :, :] + tf.eye(tf.shape(mu)[0], dtype=float_type) * jitter
+        )
+        V = tf.random_normal([tf.shape(L)[0], 1], dtype=float_type)
+        sample = mu + tf.matmul(L, V)
+        sample, = self.batch_samples(
+            [sample], self.samples_chunk_size, random_tensors=[V]
+        )
+        return sample
+
+    def _sample_chunks(self, predict_batch, num_samples, *args):
+        n_chunks = -(-num_samples // self.samples_chunk_size)
+        samples = np.vstack([predict_batch(*args) for _ in range(n_chunks)])
+        return samples[:num_samples]
+
+    def predict_density(self, Xnew, Ynew, nsamples=50):
+        samples = self._sample_chunks(
+            self._predict_density_batch, nsamples, Xnew, Ynew
+        )
         return sp.logsumexp(samples, 0) - np.log(nsamples)
 
     def predict_y(self, Xnew):
@@ -164,7 +268,6 @@ class FVGP(gpflow.models.SVGP):
         raise NotImplementedError()
 
     def predict_f_samples(self, Xnew, num_samples):
-        return np.vstack([
-            super(FVGP, self).predict_f_samples(Xnew, 1)
-            for _ in range(num_samples)
-        ])
+        return self._sample_chunks(
+            self._predict_f_samples_batch, num_samples, Xnew
+        )
@@ -6,6 +6,9 @@ from pathlib import Path
 import numpy as np
 import defopt
 
+from gp_model import save_posterior_cache, fit_precision
+from trial_store import copy_dataset
+
 
 def main(input_model_dir, output_model_dir):
     """Convert a FVGP model with ARD prior to PartialSVGP model
@@ -20,10 +23,12 @@ def main(input_model_dir, output_model_dir):
     # create output folder and copy unaltered files
     output_dir_path.mkdir(parents=True, exist_ok=True)
 
-    shutil.copy(str(input_dir_path / 'dataset.pickle'),
-                str(output_dir_path / 'dataset.pickle'))
+    copy_dataset(input_dir_path, output_dir_path)
     shutil.copy(str(input_dir_path / 'model_options.npz'),
                 str(output_dir_path / 'model_options.npz'))
+    if (input_dir_path / 'arguments.json').exists():
+        shutil.copy(str(input_dir_path / 'arguments.json'),
+                    str(output_dir_path / 'arguments.json'))
 
     # convert model parameters and save them
     model_params = np.load(input_dir_path / 'model_params_best.npz')
@@ -40,6 +45,9 @@ def main(input_model_dir, output_model_dir):
 
     np.savez(output_dir_path / 'model_params_best.npz', **model_params)
 
+    # precompute posterior factors for predictions
+    save_posterior_cache(output_dir_path, fit_precision(output_dir_path))
+
 
 if __name__ == "__main__":
     defopt.run(main)
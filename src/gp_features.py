@@ -0,0 +1,237 @@
+"""lagged data builders and filter utilities, only depending on NumPy
+
+These are kept out of `gp_model` so that analysis scripts can use them without
+importing TensorFlow and gpflow.
+"""
+
+import hashlib
+
+import numpy as np
+
+from trial_store import Ragged
+
+
+def extract_filters(params):
+    """extract and sort filters from a projected model"""
+
+    filters = next(
+        value for param, value in params.items() if param.endswith('W')
+    )
+
+    # sort by filter standard deviation
+    filters_idx = np.argsort(-filters.std(axis=0))
+    filters_sorted = filters[:, filters_idx]
+
+    # flip to make bigger deviation positive
+    mask_idx = np.arange(filters_sorted.shape[1])
+    flip_mask = filters_sorted[7, mask_idx] < 0
+    filters_sorted[:, flip_mask] = -filters_sorted[:, flip_mask]
+
+    return filters_sorted, filters_idx, flip_mask
+
+
+def _prepare_X(dset_row, n_lags, max_nt):
+    """convert stimulus data into lagged version (helper function)"""
+    nt = len(dset_row.ys)
+    X = np.zeros((nt, n_lags + 3))
+    for i in range(min(n_lags, nt)):
+        X[i:, i] = dset_row.ys[:nt-i]
+    X[:, -3] = np.arange(nt) / max_nt
+    X[:, -2] = dset_row.hazard_code
+    X[:, -1] = dset_row.mouse_code
+    return X
+
+
+def _lag_windows(values, offsets, n_lags):
+    """strided view of lag windows over a zero-padded stimulus buffer
+
+    Each trial is preceded by `n_lags` zeros in the padded buffer, such that
+    row `i` of the returned view holds the stimulus at position
+    `i + n_lags - 1` of the padded buffer followed by its `n_lags - 1`
+    predecessors. The second output gives, for each trial, the row of its
+    first time step.
+    """
+    n_trials = len(offsets) - 1
+    lengths = np.diff(offsets)
+
+    # scatter trials into a buffer with n_lags zeros in front of each of them
+    trial_idx = np.repeat(np.arange(n_trials), lengths)
+    padded = np.zeros(len(values) + n_trials * n_lags)
+    padded[np.arange(len(values)) + (trial_idx + 1) * n_lags] = values
+
+    # sliding windows (no copy), reversed so that column i holds lag i
+    stride = padded.strides[0]
+    windows = np.lib.stride_tricks.as_strided(
+        padded, shape=(max(len(padded) - n_lags + 1, 0), n_lags),
+        strides=(stride, stride), writeable=False
+    )[:, ::-1]
+
+    starts = offsets[:-1] + np.arange(n_trials) * n_lags + 1
+    return windows, starts
+
+
+def _ragged_stim(dset):
+    """trials stimuli as a value buffer and an offsets array"""
+    ys = dset['ys']
+    if not isinstance(ys, Ragged):
+        ys = Ragged.from_arrays(ys, dtype=float)
+    return ys.values, ys.offsets
+
+
+def _trial_lengths(dset, nt, truncate):
+    """number of rows per trial, cut after the lick if truncate is set"""
+    if not truncate:
+        return nt
+    rt = np.asarray(dset['rt'], dtype=float)
+    licked = ~np.isnan(rt)
+    last_idx = np.where(licked, rt, 0).astype(int) + 1
+    return np.where(licked, np.clip(last_idx, 0, nt), nt)
+
+
+class LagFeatures:
+    """lagged data and binary responses, built on demand from raw stimuli
+
+    Only the (padded) stimulus and per-trial metadata are stored, rows of
+    lagged data being gathered from a strided view when requested. The dataset
+    can be a dataframe or a `TrialStore`. If `truncate` is set, trials are cut
+    after the lick time.
+    """
+
+    def __init__(self, dset, n_lags, max_nt, truncate=True):
+        values, offsets = _ragged_stim(dset)
+        self.stim = values
+        self.windows, self.starts = _lag_windows(values, offsets, n_lags)
+        self.n_lags = n_lags
+        self.max_nt = max_nt
+
+        self.lengths = _trial_lengths(dset, np.diff(offsets), truncate)
+        self.row_offsets = np.zeros(len(self.lengths) + 1, dtype=int)
+        np.cumsum(self.lengths, out=self.row_offsets[1:])
+
+        self.hazard_code = np.asarray(dset['hazard_code'])
+        self.mouse_code = np.asarray(dset['mouse_code'])
+
+        # response is 1 on the last row of trials with a lick
+        rt = np.asarray(dset['rt'], dtype=float)
+        self.licked = truncate & ~np.isnan(rt) & (self.lengths > 0)
+
+    @property
+    def num_rows(self):
+        return self.row_offsets[-1]
+
+    @property
+    def num_trials(self):
+        return len(self.lengths)
+
+    def digest(self):
+        """hash of the lagged data, used to key cached results"""
+        digest = hashlib.sha1()
+        for array, dtype in [(self.stim, np.float64), (self.lengths, np.int64),
+                             (self.hazard_code, np.int64),
+                             (self.mouse_code, np.int64)]:
+            digest.update(np.ascontiguousarray(array, dtype=dtype).tobytes())
+        digest.update('{}-{}'.format(self.n_lags, self.max_nt).encode())
+        return digest.hexdigest()
+
+    def rows(self, trials, times):
+        """lagged data and responses for given trials and time steps"""
+        X = np.empty((len(trials), self.n_lags + 3))
+        X[:, :-3] = self.windows[self.starts[trials] + times]
+        X[:, -3] = times / self.max_nt
+        X[:, -2] = self.hazard_code[trials]
+        X[:, -1] = self.mouse_code[trials]
+
+        last_row = times == self.lengths[trials] - 1
+        y = (self.licked[trials] & last_row).astype(float)[:, np.newaxis]
+
+        return X, y
+
+    def row_range(self, start, stop):
+        """lagged data and responses for a range of stacked rows"""
+        rows = np.arange(start, min(stop, self.num_rows))
+        trials = np.searchsorted(self.row_offsets, rows, side='right') - 1
+        return self.rows(trials, rows - self.row_offsets[trials])
+
+    def trial_rows(self, trials):
+        """lagged data and responses for all rows of the given trials"""
+        lengths = self.lengths[trials]
+        offsets = np.zeros(len(lengths) + 1, dtype=int)
+        np.cumsum(lengths, out=offsets[1:])
+        times = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+        return self.rows(np.repeat(trials, lengths), times)
+
+    def sample_rows(self, trials, n_rows, rng=np.random):
+        """lagged data and responses for rows drawn among given trials"""
+        offsets = np.zeros(len(trials) + 1, dtype=int)
+        np.cumsum(self.lengths[trials], out=offsets[1:])
+        rows = rng.randint(offsets[-1], size=n_rows)
+        idx = np.searchsorted(offsets, rows, side='right') - 1
+        return self.rows(trials[idx], rows - offsets[idx])
+
+    def batches(self, batch_size, level='row', seed=None):
+        """endless generator of random mini-batches
+
+        Row-level batches contain `batch_size` rows drawn uniformly, while
+        trial-level batches contain whole trials, taken in a shuffled order
+        until reaching about `batch_size` rows. Arguments are checked before
+        returning the generator, as a generator without rows would never
+        yield.
+        """
+        if self.num_rows == 0:
+            raise ValueError('No rows to draw mini-batches from.')
+
+        rng = np.random.RandomState(seed)
+        if level == 'row':
+            return self._row_batches(batch_size, rng)
+        elif level == 'trial':
+            return self._trial_batches(batch_size, rng)
+        else:
+            raise ValueError('Unknown batch level {}.'.format(level))
+
+    def _row_batches(self, batch_size, rng):
+        while True:
+            rows = rng.randint(self.num_rows, size=batch_size)
+            trials = np.searchsorted(self.row_offsets, rows, side='right') - 1
+            yield self.rows(trials, rows - self.row_offsets[trials])
+
+    def _trial_batches(self, batch_size, rng):
+        while True:
+            order = rng.permutation(self.num_trials)
+            cumlengths = np.cumsum(self.lengths[order])
+            splits = np.searchsorted(
+                cumlengths, np.arange(batch_size, cumlengths[-1], batch_size)
+            )
+            for trials in np.split(order, np.unique(splits) + 1):
+                if len(trials) > 0:
+                    yield self.trial_rows(trials)
+
+
+def stack_Xy(dset, n_lags, max_nt, truncate=True, chunk_size=65536):
+    """build lagged data and binary responses of all trials at once
+
+    The dataset can be a dataframe or a `TrialStore`. Returns the stacked data
+    and responses, as well as the row offsets of each trial. If `truncate` is
+    set, trials are cut after the lick time.
+    """
+    features = LagFeatures(dset, n_lags, max_nt, truncate)
+
+    # gather lag windows by chunks to limit temporary copies
+    X = np.empty((features.num_rows, n_lags + 3))
+    y = np.empty((features.num_rows, 1))
+    for i in range(0, features.num_rows, chunk_size):
+        X[i:i + chunk_size], y[i:i + chunk_size] = \
+            features.row_range(i, i + chunk_size)
+
+    return X, y, features.row_offsets
+
+
+def prepare_X(dset, n_lags, max_nt):
+    """convert stimulus data into lagged version"""
+    X, _, row_offsets = stack_Xy(dset, n_lags, max_nt, truncate=False)
+    return np.split(X, row_offsets[1:-1])
+
+
+def prepare_Xy(dset, n_lags, max_nt):
+    """convert stimuli/reaction-time into lagged data and binary responses"""
+    X, y, row_offsets = stack_Xy(dset, n_lags, max_nt)
+    return np.split(X, row_offsets[1:-1]), np.split(y, row_offsets[1:-1])
@@ -4,54 +4,24 @@ import json
 import time
 from pathlib import Path
 from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import defopt
 import numpy as np
-import scipy.io as io
-import pandas as pd
 import tensorflow as tf
 import gpflow
+from scipy.special import logsumexp
 from sklearn.model_selection import train_test_split
 
 from strenum import strenum
-from gp_model import prepare_Xy, build_model, build_model_ard
-
-
-def load_data(filename):
-    """load reaction time dataset"""
-    if filename.endswith('.mat'):
-        # convert matlab data into dataframe
-        mat = io.loadmat(filename)
-        dset = pd.DataFrame({
-            'rt': mat['rt'].ravel() - 1,
-            'sig': mat['sig'].ravel(),
-            'sig_avg': mat['sig_avg'].ravel(),
-            'sig_std': mat['sig_std'].ravel(),
-            'session': mat['session'].ravel(),
-            'hazard': np.vstack(mat['hazard'].ravel()).ravel(),
-            'outcome': mat['outcome'].ravel(),
-            'noiseless': mat['noiseless'].ravel() != 0,
-            'ys': [y.ravel() for y in mat['ys'].flat],
-            'change': mat['change'].ravel() - 1
-        })
-    else:
-        dset = pd.read_pickle(filename)
-
-    # add reaction-time from change point
-    # TODO move to matlab code
-    dset['rt_change'] = dset.rt - dset.change
-
-    # add filename as mouse name
-    # TODO move to matlab code
-    dset['mouse'] = Path(filename).stem
-
-    # misc. cleaning
-    # TODO move to matlab code
-    dset = dset.groupby('sig').filter(lambda x: len(x) > 200)
-    dset = dset[~dset.noiseless]  # remove noiseless sessions
-    dset = dset[dset.outcome != 'abort']  # remove movement aborted trials
-
-    return dset
+from trial_store import TrialStore, save_dataset
+from ingest import load_datasets
+from gp_advi import FVGP
+from gp_model import (
+    LagFeatures, stack_Xy, build_model, build_model_ard, precision_settings,
+    read_params, save_posterior_cache, Precision
+)
 
 
 def split_data(dset, fractions, seed):
@@ -88,25 +58,16 @@ class StopOptimization(Exception):
 
 class Logger:
 
-    def __init__(self, name, model, dset, batch_size, patience=np.inf):
+    def __init__(self, name, patience=np.inf):
         self.name = name
-        self.model = model
-        self.batch_size = batch_size
         self.patience = patience
 
-        X, y = prepare_Xy(dset, model.n_lags, model.max_nt)
-        self.X, self.y = np.vstack(X), np.vstack(y)
-
         self.logp = []
         self.best_logp = -np.inf
         self.max_iter = patience
         self.previous_time = time.time()
 
-    def __call__(self, cnt):
-        logp = 0
-        for i in range(0, len(self.X), self.batch_size):
-            j = min(i + self.batch_size, len(self.X))
-            logp += self.model.predict_density(self.X[i:j], self.y[i:j]).sum()
+    def __call__(self, cnt, logp):
         self.logp.append(logp)
 
         current_time = time.time()
@@ -135,11 +96,159 @@ class Logger:
         return has_improved
 
 
+class Evaluator:
+    """log-likelihood of datasets for snapshots of the model parameters
+
+    A copy of the model is built in its own graph and session, and snapshots
+    are evaluated one after the other in a background thread while
+    optimization continues. Datasets given as stacked data and responses are
+    resident in variables, while datasets given as `LagFeatures` are built
+    and fed chunk by chunk, keeping memory independent of their size.
+    """
+
+    def __init__(self, build_fn, data, batch_size, n_samples=50):
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph)
+
+        with self.graph.as_default(), self.session.as_default():
+            self.model = build_fn()
+
+            # average over samples of hyperparameters with an ADVI posterior,
+            # several samples being evaluated by each graph call
+            if isinstance(self.model, FVGP):
+                self.n_samples = n_samples
+            else:
+                self.n_samples = 1
+
+            self.batch_size = batch_size
+            self.logps = {
+                name: self._build_logp(fold) for name, fold in data.items()
+            }
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _build_logp(self, fold):
+        """log-density tensor of a chunk of rows, and its feeds
+
+        The returned function generates the feed dictionaries of all chunks,
+        so that the graph does not grow with the number of rows. The tensor
+        has a leading dimension for samples of hyperparameters.
+        """
+
+        float_type = gpflow.settings.float_type
+
+        if isinstance(fold, LagFeatures):
+            X_chunk = tf.placeholder(float_type, [None, fold.n_lags + 3])
+            y_chunk = tf.placeholder(float_type, [None, 1])
+
+            def feeds():
+                for i in range(0, fold.num_rows, self.batch_size):
+                    X, y = fold.row_range(i, i + self.batch_size)
+                    yield {X_chunk: X, y_chunk: y}
+
+        else:
+            # store data in variables initialized once, not in the graph
+            X, y = fold
+            X_init = tf.placeholder(float_type, X.shape)
+            y_init = tf.placeholder(float_type, y.shape)
+            X_var = tf.Variable(X_init, trainable=False, collections=[])
+            y_var = tf.Variable(y_init, trainable=False, collections=[])
+            self.session.run(
+                [X_var.initializer, y_var.initializer],
+                feed_dict={X_init: X, y_init: y}
+            )
+
+            # chunks are selected by feeding their first row
+            start = tf.placeholder(tf.int32, [])
+            X_chunk = X_var[start:start + self.batch_size]
+            y_chunk = y_var[start:start + self.batch_size]
+            n_rows = len(X)
+
+            def feeds():
+                for i in range(0, n_rows, self.batch_size):
+                    yield {start: i}
+
+        with gpflow.params_as_tensors_for(self.model):
+            fmean, fvar = self.model._build_predict(X_chunk)
+            logp = self.model.likelihood.predict_density(fmean, fvar, y_chunk)
+            if isinstance(self.model, FVGP):
+                logp, = self.model.batch_samples(
+                    [logp], self.model.samples_chunk_size
+                )
+            else:
+                logp = logp[np.newaxis]
+
+        return logp, feeds
+
+    def _evaluate(self, snapshot, names):
+        self.model.assign(snapshot, session=self.session)
+
+        results = {}
+        for name in names:
+            logp_chunk, feeds = self.logps[name]
+            logp = 0
+            for feed_dict in feeds():
+                samples = []
+                while len(samples) < self.n_samples:
+                    samples.extend(
+                        self.session.run(logp_chunk, feed_dict=feed_dict)
+                    )
+                samples = samples[:self.n_samples]
+                logp += np.sum(logsumexp(samples, 0) - np.log(self.n_samples))
+            results[name] = logp
+
+        return results
+
+    def submit(self, snapshot, names):
+        """evaluate a snapshot on given datasets, returning a future"""
+        return self.executor.submit(self._evaluate, snapshot, names)
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+
+def group_representatives(dset):
+    """longest trial of each hazard block and mouse pair"""
+    nt = dset.ys.map(len).values
+    rt = dset.rt.values
+    n_rows = np.where(np.isnan(rt), nt, np.clip(rt + 1, 0, nt))
+    order = np.argsort(-n_rows, kind='mergesort')
+    return dset.iloc[order].drop_duplicates(['hazard_code', 'mouse_code'])
+
+
+class FoldFeatures:
+    """stacked features and licks of dataset folds, computed once
+
+    Folds are stacked on first access and shared by all models fitted to the
+    same dataset. Their lagged features can also be built on demand, without
+    stacking them (see `lag_features`).
+    """
+
+    def __init__(self, dset, n_lags):
+        self.dset = dset
+        self.n_lags = n_lags
+        self.max_nt = dset.ys.map(len).max()
+        self._Xy = {}
+
+    def __getitem__(self, name):
+        if name not in self._Xy:
+            dset = self.dset[self.dset[name]]
+            self._Xy[name] = stack_Xy(dset, self.n_lags, self.max_nt)[:2]
+        return self._Xy[name]
+
+    def lag_features(self, name):
+        """lagged features of a fold, built on demand"""
+        dset = self.dset[self.dset[name]]
+        return LagFeatures(dset, self.n_lags, self.max_nt)
+
+
 # enumeration types used to define GP model and kernel options
 Hazard = strenum('Hazard', 'early late split nonsplit all')
 MeanType = strenum('MeanType', 'zero constant linear')
 Hierarchy = strenum('Hierarchy', 'mouse hzrd')
 Combination = strenum('Combination', 'add mul')
+Streaming = strenum('Streaming', 'none row trial')
 KernelInput = strenum(
     'KernelInput', 'full time logtime wtime stim proj expproj hzrd'
 )
@@ -150,57 +259,15 @@ KernelType = strenum(
 )
 
 
-def main(result_dir, *dset_filename, hazard=Hazard.nonsplit,
-         mean_type=MeanType.zero, kernels_type=(KernelType.RBF,),
-         kernels_input=(KernelInput.full,),
-         hierarchy=(), combination=Combination.add,
-         sigma=1e-1, nproj=5, ntanh=5, nz=100, batch_size=50000, nlags=50,
-         learning_rate=1e-3, max_iter=1000000, patience=10000,
-         max_duration=np.inf, fractions=(0.2, 0.2), threads=0,
-         logger_batch_size=100000, save_train=False, save_test=False,
-         load_params=None, use_ard=False):
-    """Fit a Gaussian process model to reaction time data
-
-    :param str result_dir: directory for results files
-    :param str dset_filename: reaction time dataset file
-    :param Hazard hazard: hazard rate block type
-    :param MeanType mean_type: Gaussian process mean function
-    :param list[KernelType] kernels_type: kernels type
-    :param list[KernelInput] kernels_input: kernels input
-    :param list[Hierarchy] hierarchy: kernel hierarchical structure, if any
-    :param Combination combination: kernels combination
-    :param float sigma: standard deviation of Laplacian prior for projected
-                        kernels
-    :param int nproj: number of projections in projected kernels
-    :param int ntanh: number of tanh functions in warped kernels
-    :param int nz: number of inducing points per mouse
-    :param int batch_size: size of mini-batches
-    :param int nlags: number of past stimulus to include for each observation
-    :param float learning_rate: Adam learning rate
-    :param int max_iter: maximum number of iterations for optimization
-    :param int patience: patience parameter for early stopping
-    :param int max_duration: maximum time allowed for model fit in minutes
-    :param list[float] fractions: validation and test fold fractions (same sets
-                                  if only one value provided)
-    :param float threads: limit number of threads for tensorflow-cpu
-                          (0: no limit)
-    :param int logger_batch_size: batch size for Logger objects
-    :param bool save_train: save training set score
-    :param bool save_test: save test set score
-    :param str load_params: file used to initialize the GP model parameters
-    :param bool use_ard: use ARD prior for projected kernels
-
-    """
+# seed used to split datasets and initialize models
+SEED = 12345
 
-    # record all inputs
-    main_inputs = locals().copy()
 
-    # fix seed for reproducibility
-    seed = 12345
-    np.random.seed(seed)
+def prepare_data(dset_filename, hazard, fractions, cache_dir=None,
+                 n_workers=0):
+    """load datasets, select hazard blocks and split trials in folds"""
 
-    # load datasets and create splits for training
-    dset = pd.concat([load_data(fname) for fname in dset_filename])
+    dset = load_datasets(dset_filename, cache_dir, n_workers)
     dset['mouse_code'] = dset.mouse.astype('category').cat.codes
     dset['hazard_code'] = dset.hazard.astype('category').cat.codes
 
@@ -210,85 +277,257 @@ def main(result_dir, *dset_filename, hazard=Hazard.nonsplit,
     elif hazard != Hazard.all:
         dset = dset[dset.hazard == hazard]
 
-    dset = split_data(dset, fractions, seed)
+    return split_data(dset, fractions, SEED)
+
+
+def fit_model(dset, options, folds=None):
+    """fit a model to a prepared dataset, given all options of `main`
+
+    The model is built and optimized in its own graph and session, so that
+    several models can be fitted one after the other in the same process.
+    `folds` are the stacked folds of the dataset, if already computed.
+    """
+
+    if folds is None:
+        folds = FoldFeatures(dset, options['nlags'])
 
     # limit multithreading in tensorflow-cpu
-    if threads > 0:
+    session_conf = None
+    if options['threads'] > 0:
         session_conf = tf.ConfigProto(
-            intra_op_parallelism_threads=threads,
-            inter_op_parallelism_threads=threads
+            intra_op_parallelism_threads=options['threads'],
+            inter_op_parallelism_threads=options['threads']
         )
-        tf.Session(config=session_conf)
+
+    graph = tf.Graph()
+    session = tf.Session(graph=graph, config=session_conf)
+    precision = precision_settings(options['precision'])
+    with graph.as_default(), session.as_default(), \
+            gpflow.settings.temp_settings(precision):
+        np.random.seed(SEED)
+        _fit_model(dset, folds, options)
+    session.close()
+
+
+def _fit_model(dset, folds, options):
+    result_path = Path(options['result_dir'])
+    batch_size = options['batch_size']
+    use_ard = options['use_ard']
 
     # build the model
     model_opts = {
-        'kernels_type': kernels_type,
-        'kernels_input': kernels_input,
-        'hierarchy': hierarchy,
-        'combination': combination,
-        'sigma': sigma,
-        'n_proj': nproj,
-        'n_tanh': ntanh,
-        'n_z': nz,
+        'kernels_type': options['kernels_type'],
+        'kernels_input': options['kernels_input'],
+        'hierarchy': options['hierarchy'],
+        'combination': options['combination'],
+        'sigma': options['sigma'],
+        'n_proj': options['nproj'],
+        'n_tanh': options['ntanh'],
+        'n_z': options['nz'],
         'batch_size': batch_size,
-        'n_lags': nlags,
-        'max_nt': dset.ys.map(len).max(),
-        'mean_type': mean_type,
-        'hazard': hazard
+        'n_lags': folds.n_lags,
+        'max_nt': folds.max_nt,
+        'mean_type': options['mean_type'],
+        'hazard': options['hazard']
     }
-    if ('proj' in kernels_input) and use_ard:
-        model = build_model_ard(dset[dset.train], **model_opts)
+    if ('proj' in options['kernels_input']) and use_ard:
+        model_builder = partial(
+            build_model_ard,
+            samples_chunk_size=options['samples_chunk_size']
+        )
+    else:
+        model_builder = build_model
+    streaming = options['streaming']
+    if streaming == Streaming.none:
+        streaming, Xy = None, folds['train']
     else:
-        model = build_model(dset[dset.train], **model_opts)
+        streaming, Xy = str(streaming), None
+    model = model_builder(
+        dset[dset.train], streaming=streaming,
+        kmeans_rows=options['kmeans_rows'] or None,
+        kmeans_init_size=options['kmeans_init_size'] or None,
+        n_workers=options['nworkers'], cache_dir=options['cache_dir'], Xy=Xy,
+        **model_opts
+    )
 
-    if load_params:
-        model_params = dict(np.load(load_params))
+    if options['load_params']:
+        model_params = read_params(options['load_params'])
         model.assign(model_params)
 
     # save options
-    result_path = Path(result_dir)
     result_path.mkdir(parents=True, exist_ok=True)
     with (result_path / 'arguments.json').open('w') as fd:
-        json.dump(main_inputs, fd, indent=4, sort_keys=True)
-    dset.to_pickle(result_path / 'dataset.pickle')
+        json.dump(options, fd, indent=4, sort_keys=True)
+    save_dataset(
+        TrialStore.from_dataframe(dset), result_path, options['dataset_store']
+    )
     np.savez(result_path / 'model_options.npz', **model_opts)
 
     # prepare logging objects
-    logger = partial(Logger, model=model, batch_size=logger_batch_size)
-    logger_train = logger('train', dset=dset[dset.train])
-    logger_val = logger('val', dset=dset[dset.val], patience=patience)
-    logger_test = logger('test', dset=dset[dset.test])
+    logger_train = Logger('train')
+    logger_val = Logger('val', patience=options['patience'])
+    logger_test = Logger('test')
+
+    # evaluate parameter snapshots in the background, on a copy of the model
+    # built from one trial per group, as only parameters shape matter
+    eval_names = ['val']
+    if options['save_train']:
+        eval_names.append('train')
+    if options['save_test']:
+        eval_names.append('test')
+    # with streaming, evaluation data is built chunk by chunk, not stacked
+    if streaming is None:
+        eval_data = {name: folds[name] for name in eval_names}
+    else:
+        eval_data = {name: folds.lag_features(name) for name in eval_names}
+    evaluator = Evaluator(
+        partial(model_builder, group_representatives(dset[dset.train]),
+                fast_init=True, **model_opts),
+        eval_data, options['logger_batch_size']
+    )
 
-    n_iter_per_epoch = int(np.ceil(model.Y.shape[0] / model.Y.batch_size))
-    max_time = time.time() + max_duration * 60
+    n_iter_per_epoch = int(np.ceil(model.num_data / batch_size))
+    max_time = time.time() + options['max_duration'] * 60
     best_model_path = result_path / 'model_params_best.npz'
+    pending = deque()
+    max_pending = 2
+
+    def process_evaluations(max_pending):
+        """apply evaluation results, in order, waiting for lagging ones"""
+        while pending and (len(pending) > max_pending or pending[0][2].done()):
+            cnt, snapshot, future = pending.popleft()
+            logps = future.result()
+            try:
+                if logger_val(cnt, logps['val']):
+                    np.savez(best_model_path, **snapshot)
+            except StopOptimization:
+                # discard evaluations of later iterations
+                for _, _, future in pending:
+                    future.cancel()
+                pending.clear()
+                raise
+            if 'train' in logps:
+                logger_train(cnt, logps['train'])
+            if 'test' in logps:
+                logger_test(cnt, logps['test'])
 
     def callback(x):
         if time.time() > max_time:
             raise StopOptimization()
+        process_evaluations(max_pending)
         if (x % n_iter_per_epoch) != 0:
             return
-        if logger_val(x):
-            session = model.enquire_session()
-            np.savez(best_model_path, **model.read_values(session))
-        if save_train:
-            logger_train(x)
-        if save_test:
-            logger_test(x)
+        snapshot = model.read_values(model.enquire_session())
+        pending.append((x, snapshot, evaluator.submit(snapshot, eval_names)))
+        process_evaluations(max_pending)
 
     # fit the model
-    optimizer = gpflow.train.AdamOptimizer(learning_rate=learning_rate)
+    optimizer = gpflow.train.AdamOptimizer(
+        learning_rate=options['learning_rate']
+    )
     try:
-        optimizer.minimize(model, maxiter=max_iter, step_callback=callback)
+        optimizer.minimize(
+            model, maxiter=options['max_iter'], step_callback=callback
+        )
     except StopOptimization:
         model.anchor(model.enquire_session())
 
+    # apply pending evaluations
+    try:
+        process_evaluations(max_pending=0)
+    except StopOptimization:
+        pass
+    evaluator.close()
+
     # save final params and log
     np.savez(result_path / 'model_params_last.npz',
              **model.read_values())
     np.savez(result_path / 'logger.npz', logp_train=logger_train.logp,
              logp_val=logger_val.logp, logp_test=logger_test.logp)
 
+    # precompute posterior factors for predictions, FVGP models needing to be
+    # converted first (see gp_convert.py)
+    if not use_ard and best_model_path.exists():
+        save_posterior_cache(result_path, options['precision'])
+
+
+def main(result_dir, *dset_filename, hazard=Hazard.nonsplit,
+         mean_type=MeanType.zero, kernels_type=(KernelType.RBF,),
+         kernels_input=(KernelInput.full,),
+         hierarchy=(), combination=Combination.add,
+         sigma=1e-1, nproj=5, ntanh=5, nz=100, batch_size=50000, nlags=50,
+         learning_rate=1e-3, max_iter=1000000, patience=10000,
+         max_duration=np.inf, fractions=(0.2, 0.2), threads=0,
+         logger_batch_size=100000, save_train=False, save_test=False,
+         load_params=None, use_ard=False, cache_dir=None, nworkers=0,
+         streaming=Streaming.none, precision=Precision.float64,
+         kmeans_rows=0, kmeans_init_size=0, dataset_store=None,
+         samples_chunk_size=10):
+    """Fit a Gaussian process model to reaction time data
+
+    :param str result_dir: directory for results files
+    :param str dset_filename: reaction time dataset file
+    :param Hazard hazard: hazard rate block type
+    :param MeanType mean_type: Gaussian process mean function
+    :param list[KernelType] kernels_type: kernels type
+    :param list[KernelInput] kernels_input: kernels input
+    :param list[Hierarchy] hierarchy: kernel hierarchical structure, if any
+    :param Combination combination: kernels combination
+    :param float sigma: standard deviation of Laplacian prior for projected
+                        kernels
+    :param int nproj: number of projections in projected kernels
+    :param int ntanh: number of tanh functions in warped kernels
+    :param int nz: number of inducing points per mouse
+    :param int batch_size: size of mini-batches
+    :param int nlags: number of past stimulus to include for each observation
+    :param float learning_rate: Adam learning rate
+    :param int max_iter: maximum number of iterations for optimization
+    :param int patience: patience parameter for early stopping
+    :param int max_duration: maximum time allowed for model fit in minutes
+    :param list[float] fractions: validation and test fold fractions (same sets
+                                  if only one value provided)
+    :param float threads: limit number of threads for tensorflow-cpu
+                          (0: no limit)
+    :param int logger_batch_size: batch size for Logger objects
+    :param bool save_train: save training set score
+    :param bool save_test: save test set score
+    :param str load_params: file used to initialize the GP model parameters
+    :param bool use_ard: use ARD prior for projected kernels
+    :param str cache_dir: folder to cache cleaned datasets and inducing points
+                          initializations, not used by default
+    :param int nworkers: number of processes loading datasets and initializing
+                         inducing points in parallel (0: one per dataset file
+                         or group of trials)
+    :param Streaming streaming: build mini-batches on the fly, sampling rows
+                                or whole trials, instead of materializing
+                                training data, evaluation data being also
+                                built by chunks (none: disabled)
+    :param Precision precision: floating point precision of the model
+    :param int kmeans_rows: maximum number of rows per group of trials used to
+                            initialize inducing points (0: all rows)
+    :param int kmeans_init_size: number of rows used for k-means++ seeding
+                                 (0: k-means default)
+    :param str dataset_store: folder of datasets shared by models, saved once
+                              per content, the result directory only keeping
+                              a reference and split masks (default: save the
+                              dataset in the result directory)
+    :param int samples_chunk_size: number of hyperparameters draws evaluated
+                                   per graph call with an ARD prior, trading
+                                   memory for calls (between 1 and 50)
+
+    """
+
+    # record all inputs
+    main_inputs = locals().copy()
+
+    # fix seed for reproducibility
+    np.random.seed(SEED)
+
+    # load datasets and create splits for training
+    dset = prepare_data(dset_filename, hazard, fractions, cache_dir, nworkers)
+
+    fit_model(dset, main_inputs)
+
 
 if __name__ == "__main__":
     defopt.run(main, short={})
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import json
+import inspect
+from multiprocessing import get_context
+
+import defopt
+import numpy as np
+
+import gp_fit
+from gp_fit import FoldFeatures, prepare_data, fit_model, SEED
+
+# options defining the fitted data, which models of a batch cannot override
+DATA_OPTIONS = ('hazard', 'fractions', 'nlags', 'cache_dir', 'nworkers')
+
+
+def model_options(dset_filename, shared, model):
+    """all `gp_fit.main` options of one model of the batch"""
+
+    overridden = set(model) & set(DATA_OPTIONS)
+    if overridden:
+        raise ValueError(
+            'Data options cannot be set per model ({}), they are shared by '
+            'all models of a batch.'.format(', '.join(sorted(overridden)))
+        )
+    if 'result_dir' not in model:
+        raise ValueError('Missing result directory for model {}.'
+                         .format(model))
+
+    options = {
+        name: param.default
+        for name, param in inspect.signature(gp_fit.main).parameters.items()
+        if param.default is not inspect.Parameter.empty
+    }
+    unknown = (set(shared) | set(model)) - set(options) - {'result_dir'}
+    if unknown:
+        raise ValueError('Unknown options: {}.'
+                         .format(', '.join(sorted(unknown))))
+
+    options.update(shared)
+    options.update(model)
+    options['dset_filename'] = dset_filename
+    return options
+
+
+# data shared by all fits of a worker process, see `_init_worker`
+_worker_data = {}
+
+
+def _init_worker(dset, folds):
+    _worker_data['dset'] = dset
+    _worker_data['folds'] = folds
+
+
+def _fit_worker(options):
+    fit_model(_worker_data['dset'], options, _worker_data['folds'])
+
+
+def main(config_file, *dset_filename, nfits=1):
+    """Fit several Gaussian process models to the same reaction time data
+
+    Datasets are loaded, filtered and split once, and lagged features of each
+    fold are stacked once and shared by all models, including models fitted
+    in parallel processes. Each model is saved in its own result directory,
+    as with `gp_fit.py`.
+
+    The configuration file is a JSON file with a "shared" dictionary of
+    `gp_fit.py` options, applied to all models, and a "models" list of
+    dictionaries, each one with a "result_dir" entry and the options specific
+    to this model (e.g. "kernels_type", "kernels_input", "mean_type" and
+    "use_ard"). Options setting the data (hazard, fractions, nlags, cache_dir
+    and nworkers) can only be shared.
+
+    :param str config_file: JSON file describing the models to fit
+    :param str dset_filename: reaction time dataset file
+    :param int nfits: number of models fitted in parallel, in separate
+                      processes (1: fit models one after the other)
+
+    """
+
+    with open(config_file) as fd:
+        config = json.load(fd)
+
+    shared = config.get('shared', {})
+    models_options = [
+        model_options(dset_filename, shared, model)
+        for model in config['models']
+    ]
+    options = models_options[0]
+
+    # fix seed for reproducibility
+    np.random.seed(SEED)
+
+    # load datasets and create splits for training, once for all models
+    dset = prepare_data(
+        dset_filename, options['hazard'], options['fractions'],
+        options['cache_dir'], options['nworkers']
+    )
+
+    folds = FoldFeatures(dset, options['nlags'])
+
+    if nfits <= 1:
+        for options in models_options:
+            print('fitting model in {}'.format(options['result_dir']))
+            fit_model(dset, options, folds)
+
+    else:
+        # stack folds used by any model before sending them to workers, which
+        # are spawned as forking a process running TensorFlow can deadlock
+        names = {'train', 'val'}
+        if any(options['save_test'] for options in models_options):
+            names.add('test')
+        for name in names:
+            folds[name]
+
+        with get_context('spawn').Pool(
+                nfits, initializer=_init_worker, initargs=(dset, folds)
+        ) as pool:
+            pool.map(_fit_worker, models_options, chunksize=1)
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -1,77 +1,30 @@
+import hashlib
+import json
 import operator
+import os
+from pathlib import Path
 from functools import partial, reduce
 from itertools import product
+from multiprocessing import get_context
 
 import gpflow
 import numpy as np
 import tensorflow as tf
-from scipy.special import expit, logsumexp
-from sklearn.cluster import MiniBatchKMeans
+from scipy.special import logsumexp
 from tensorflow.contrib.distributions import Normal, Gamma
 
-from gp_advi import FVGP, build_factor
-
-
-def extract_filters(params):
-    """extract and sort filters from a projected model"""
-
-    filters = next(
-        value for param, value in params.items() if param.endswith('W')
-    )
-
-    # sort by filter standard deviation
-    filters_idx = np.argsort(-filters.std(axis=0))
-    filters_sorted = filters[:, filters_idx]
-
-    # flip to make bigger deviation positive
-    mask_idx = np.arange(filters_sorted.shape[1])
-    flip_mask = filters_sorted[7, mask_idx] < 0
-    filters_sorted[:, flip_mask] = -filters_sorted[:, flip_mask]
-
-    return filters_sorted, filters_idx, flip_mask
-
-
-def _prepare_X(dset_row, n_lags, max_nt):
-    """convert stimulus data into lagged version (helper function)"""
-    nt = len(dset_row.ys)
-    X = np.zeros((nt, n_lags + 3))
-    for i in range(min(n_lags, nt)):
-        X[i:, i] = dset_row.ys[:nt-i]
-    X[:, -3] = np.arange(nt) / max_nt
-    X[:, -2] = dset_row.hazard_code
-    X[:, -1] = dset_row.mouse_code
-    return X
-
-
-def prepare_X(dset, n_lags, max_nt):
-    """convert stimulus data into lagged version"""
-    return [
-        _prepare_X(dset_row, n_lags, max_nt) for _, dset_row in dset.iterrows()
-    ]
-
-
-def prepare_Xy(dset, n_lags, max_nt):
-    """convert stimuli/reaction-time into lagged data and binary responses"""
-    Xs, ys = [], []
-
-    for _, row in dset.iterrows():
-        X = _prepare_X(row, n_lags, max_nt)
-        y = np.zeros((len(X), 1))
-
-        if not np.isnan(row.rt):
-            last_idx = int(row.rt) + 1
-            X, y = X[:last_idx], y[:last_idx]
-            y[-1] = 1
-
-        Xs.append(X)
-        ys.append(y)
-
-    return Xs, ys
+from strenum import strenum
+from gp_advi import CastInputsMixin, FVGP, build_factor, SAMPLES_CHUNK_SIZE
+from gp_pathwise import sample_prior
+from gp_features import (  # NOQA, re-exported for backward compatibility
+    extract_filters, _prepare_X, LagFeatures, stack_Xy, prepare_X, prepare_Xy
+)
 
 
 class ProjKernel(gpflow.kernels.Kernel):
 
-    def __init__(self, base_kernel, input_dim, K, W=None, active_dims=None):
+    def __init__(self, base_kernel, input_dim, K, W=None, active_dims=None,
+                 rng=np.random):
         super().__init__(input_dim, active_dims)
 
         # disable lengthscales optimisation for sub-kernels
@@ -86,7 +39,7 @@ class ProjKernel(gpflow.kernels.Kernel):
         self.base_kernel = base_kernel
 
         if W is None:
-            W = np.random.randn(input_dim, K)
+            W = rng.randn(input_dim, K)
         self.W = gpflow.params.Parameter(W)
 
     def _project(self, X, X2=None):
@@ -111,13 +64,13 @@ def _warping(X, a, b, c):
 
 class WarpedKernel(gpflow.kernels.Kernel):
 
-    def __init__(self, base_kernel, n_tanh):
+    def __init__(self, base_kernel, n_tanh, rng=np.random):
         super().__init__(base_kernel.input_dim, active_dims=None)
         self.base_kernel = base_kernel
 
-        coeffs_a = np.abs(np.random.randn(n_tanh))
-        coeffs_b = np.abs(np.random.randn(n_tanh))
-        coeffs_c = np.random.randn(n_tanh)
+        coeffs_a = np.abs(rng.randn(n_tanh))
+        coeffs_b = np.abs(rng.randn(n_tanh))
+        coeffs_c = rng.randn(n_tanh)
 
         self.coeffs_a = gpflow.params.Parameter(
             coeffs_a, gpflow.transforms.Exp()
@@ -169,7 +122,7 @@ class LogTranformedKernel(gpflow.kernels.Kernel):
 class ExpProjKernel(gpflow.kernels.Kernel):
 
     def __init__(self, base_kernel, input_dim, n_exp,
-                 ND=None, A=None, L=None, active_dims=None):
+                 ND=None, A=None, L=None, active_dims=None, rng=np.random):
         super().__init__(input_dim, active_dims)
 
         # disable lengthscales optimisation for sub-kernels
@@ -184,7 +137,7 @@ class ExpProjKernel(gpflow.kernels.Kernel):
         self.base_kernel = base_kernel
 
         if A is None:
-            A = np.random.randn(1, n_exp)
+            A = rng.randn(1, n_exp)
         if ND is None:
             ND = 0.0
         if L is None:
@@ -198,7 +151,8 @@ class ExpProjKernel(gpflow.kernels.Kernel):
 
     @gpflow.params_as_tensors
     def _makeW(self):
-        t = tf.expand_dims(tf.range(self.input_dim, dtype='float64'), 1)
+        float_type = gpflow.settings.float_type
+        t = tf.expand_dims(tf.range(self.input_dim, dtype=float_type), 1)
         # make sigmoids for non-decision time
         nd = tf.reciprocal(tf.exp(tf.negative(t)+self.ND)+1.0)
         nd = tf.tile(nd, [1, self.n_exp])
@@ -260,7 +214,7 @@ class Hierarchical(gpflow.kernels.Combination):
 
         for i, ind_dim in enumerate(self.indicator_dims):
             indX, indX2 = X[:, ind_dim:ind_dim + 1], X2[:, ind_dim:ind_dim + 1]
-            mask = tf.to_double(tf.equal(indX, tf.transpose(indX2)))
+            mask = tf.cast(tf.equal(indX, tf.transpose(indX2)), K.dtype)
             k = self.kernels[i + 1]
             K += mask * k.K(X, X2)
 
@@ -274,8 +228,11 @@ class Hierarchical(gpflow.kernels.Combination):
 
 
 def build_kernel(kernel_type, kernel_input, hierarchy, n_lags, n_proj=None,
-                 sigma=None, n_tanh=5):
-    """construct the GP kernel to fit reaction-time"""
+                 sigma=None, n_tanh=5, rng=np.random):
+    """construct the GP kernel to fit reaction-time
+
+    Random initial values of parameters are drawn from `rng`.
+    """
 
     # retrieve a class corresponding to the kernel type
     kernel_class = getattr(gpflow.kernels, str(kernel_type))
@@ -323,7 +280,7 @@ def build_kernel(kernel_type, kernel_input, hierarchy, n_lags, n_proj=None,
     # kernel with warped time
     elif kernel_input == 'wtime':
         base_kernel = kernel_class(1, active_dims=[n_lags])
-        kernel = WarpedKernel(base_kernel, n_tanh=n_tanh)
+        kernel = WarpedKernel(base_kernel, n_tanh=n_tanh, rng=rng)
 
     # kernel with only hazard block input
     elif kernel_input == 'hzrd':
@@ -336,14 +293,14 @@ def build_kernel(kernel_type, kernel_input, hierarchy, n_lags, n_proj=None,
     elif kernel_input == 'proj':
         kernel_dims = np.arange(n_proj) + n_lags + 3
         base_kernel = kernel_class(n_proj, active_dims=kernel_dims)
-        kernel = ProjKernel(base_kernel, n_lags, n_proj)
+        kernel = ProjKernel(base_kernel, n_lags, n_proj, rng=rng)
         if sigma is not None:
             kernel.W.prior = gpflow.priors.Laplace(0, sigma)
 
     elif kernel_input == 'expproj':
         kernel_dims = np.arange(n_proj) + n_lags + 3
         base_kernel = kernel_class(n_proj, active_dims=kernel_dims)
-        kernel = ExpProjKernel(base_kernel, n_lags, n_proj)
+        kernel = ExpProjKernel(base_kernel, n_lags, n_proj, rng=rng)
 
     else:
         ValueError('Unknown kernel input type {}.'.format(kernel_input))
@@ -351,53 +308,445 @@ def build_kernel(kernel_type, kernel_input, hierarchy, n_lags, n_proj=None,
     return kernel
 
 
-class PartialSVGP(gpflow.models.svgp.SVGP):
+class PartialSVGP(CastInputsMixin, gpflow.models.svgp.SVGP):
     """SVGP allowing partial predictions for additive kernels"""
     # "inspired" from https://gist.github.com/mrksr/6f020d6ce75ece9e0e1df16df21ef47a  # NOQA
 
+    # precomputed posterior factors, see save_posterior_cache
+    posterior_cache = None
+
     @gpflow.autoflow((gpflow.settings.float_type, [None, None]))
     def predict_f_partial(self, Xnew):
-        return [
-            self.build_partial_predict(Xnew, k) for k in self.kern.kernels
-        ]
+        return self.build_partial_predict(Xnew, self.kern.kernels)
+
+    @gpflow.autoflow((gpflow.settings.float_type, [None, None]))
+    def predict_f_partial_var(self, Xnew):
+        return self.build_partial_predict(
+            Xnew, self.kern.kernels, compute_var=True
+        )
 
     @gpflow.params_as_tensors
-    def build_partial_predict(self, Xnew, kern):
-        """predict component contribution in an additive kernel"""
+    def build_partial_predict(self, Xnew, kernels, compute_var=False):
+        """predict components contributions in an additive kernel
+
+        Kmm is factorized once and all components are projected with a single
+        triangular solve. Returns the list of component means, and the list of
+        their marginal variances if `compute_var` is set.
+        """
+
+        Xnew = tf.cast(Xnew, gpflow.settings.float_type)
+        Lm, As = self._build_projections(Xnew, kernels)
+        fmeans = self._build_component_means(Lm, As)
+        if not compute_var:
+            return fmeans
+
+        # variance of each component, as in
+        # gpflow.conditionals.base_conditional
+        q_sqrt = tf.matrix_band_part(self.q_sqrt[0], -1, 0)
+        fvars = []
+        for kern, A in zip(kernels, As):
+            fvar = kern.Kdiag(Xnew) - tf.reduce_sum(tf.square(A), 0)
+            if not self.whiten:
+                A = tf.matrix_triangular_solve(
+                    tf.transpose(Lm), A, lower=False
+                )
+            LTA = tf.matmul(q_sqrt, A, transpose_a=True)
+            fvar += tf.reduce_sum(tf.square(LTA), 0)
+            fvars.append(fvar[:, None])
+        return fmeans, fvars
+
+    @gpflow.autoflow((tf.float64, [None, None, None]), (tf.int32, [None]),
+                     (tf.int32, []))
+    def predict_logpmf_padded(self, Xnew, lengths, num_samples):
+        """Monte-Carlo log-PMF of the time-survival model for padded trials
+
+        `Xnew` holds the lagged data of trials padded to the same number of
+        rows and `lengths` their actual number of rows. Hazard functions are
+        sampled jointly within each trial, padded entries of the output being
+        set to -inf.
+        """
+        float_type = gpflow.settings.float_type
+        jitter = gpflow.settings.jitter
+        Xnew = tf.cast(Xnew, float_type)
+        n_rows = tf.shape(Xnew)[1]
+
+        def sample_trial(args):
+            X, length = args
+            fmean, fvar = self._build_predict(X, full_cov=True)
+
+            # padded rows are replaced by independent unit variance entries
+            mask = tf.sequence_mask(length, n_rows, dtype=float_type)
+            cov = fvar[0] * mask[:, None] * mask[None, :] + tf.diag(1 - mask)
+            L = tf.cholesky(cov + tf.eye(n_rows, dtype=float_type) * jitter)
+            V = tf.random_normal([n_rows, num_samples], dtype=float_type)
+            return fmean + tf.matmul(L, V)
+
+        samples = tf.map_fn(sample_trial, (Xnew, lengths), dtype=float_type)
+
+        # convert hazard functions into probability mass functions
+        log_sf = tf.cumsum(tf.log_sigmoid(-samples), axis=1, exclusive=True)
+        log_pmf = log_sf + tf.log_sigmoid(samples)
+
+        # average to get Monte-Carlo estimate of the posterior PMF
+        log_pmf = (
+            tf.reduce_logsumexp(log_pmf, axis=2)
+            - tf.log(tf.cast(num_samples, float_type))
+        )
+
+        mask = tf.sequence_mask(lengths, n_rows)
+        padding = tf.fill(tf.shape(log_pmf), tf.constant(-np.inf, float_type))
+        return tf.where(mask, log_pmf, padding)
+
+    def predict_fused(self, Xnew, outputs, first_rows=None, num_samples=None,
+                      num_features=None):
+        """predictions for stacked trials, sharing kernel computations
+
+        Cross-covariances with inducing points and triangular solves are
+        computed once for all requested outputs, among:
+
+        - 'mean', posterior mean of the logit-hazard,
+        - 'var', posterior marginal variance of the logit-hazard,
+        - 'components', posterior means of each additive kernel component,
+        - 'projected_stim', stimulus projected on the filters of the first
+          projected kernel,
+        - 'log_pmf', Monte-Carlo log-PMF of the time-survival model, using
+          `num_samples` samples.
+
+        Only requested outputs are evaluated. For the log-PMF, hazard functions
+        are sampled through inducing variables, as the mean of `f | u` with
+        `u ~ q(u)`, which drops the variance of `f | u`. If `num_features` is
+        given, prior samples approximated with random features are updated
+        instead (pathwise sampling), preserving the covariance of `f | u`
+        within trials. `first_rows` gives the first row of the trial of each
+        row of `Xnew`.
+        """
+        inputs = self._fused_tensors('inputs')
+        feed_dict = {inputs['Xnew']: Xnew}
+        if first_rows is not None:
+            feed_dict[inputs['first_rows']] = first_rows
+        if num_samples is not None:
+            feed_dict[inputs['num_samples']] = num_samples
+        if num_features is not None:
+            feed_dict[inputs['num_features']] = num_features
+
+        fetches = {}
+        for output in outputs:
+            name = output
+            if output == 'log_pmf':
+                name = 'log_pmf_inducing'
+                if num_features is not None:
+                    name = 'log_pmf_pathwise'
+            fetches[output] = self._fused_tensors(name)
+
+        session = self.enquire_session()
+        return session.run(fetches, feed_dict=feed_dict)
+
+    def _fused_tensors(self, name):
+        """tensors of fused predictions, each one built on first request
+
+        If the model has a posterior cache (see `save_posterior_cache`), the
+        Cholesky factor of Kmm and posterior weights are taken from it, mean
+        predictions then only requiring cross-covariances with inducing points.
+        """
+
+        fused = getattr(self, '_fused', None)
+        if fused is not None and name in fused:
+            return fused[name]
 
+        float_type = gpflow.settings.float_type
+        session = self.enquire_session()
+        with session.graph.as_default(), gpflow.params_as_tensors_for(self):
+            if fused is None:
+                inputs = {
+                    'Xnew': tf.placeholder(tf.float64, [None, None]),
+                    'first_rows': tf.placeholder(tf.int32, [None]),
+                    'num_samples': tf.placeholder(tf.int32, []),
+                    'num_features': tf.placeholder(tf.int32, [])
+                }
+                fused = {
+                    'inputs': inputs,
+                    'X': tf.cast(inputs['Xnew'], float_type)
+                }
+                if self.posterior_cache is not None:
+                    fused.update(
+                        (key, tf.constant(self.posterior_cache[key],
+                                          dtype=float_type))
+                        for key in ('Lm', 'alpha', 'B')
+                    )
+                self._fused = fused
+
+            if isinstance(self.kern, gpflow.kernels.Sum):
+                kernels = self.kern.kernels
+            else:
+                kernels = [self.kern]
+
+            if name in fused:
+                pass
+
+            elif name == 'Kmns':
+                Z = self.feature.Z
+                fused[name] = [kern.K(Z, fused['X']) for kern in kernels]
+
+            elif name == 'Lm':
+                fused[name] = self._build_cholesky()
+
+            elif name in ('alpha', 'B'):
+                fused['alpha'], fused['B'] = self._build_posterior_factors(
+                    self._fused_tensors('Lm')
+                )
+
+            elif name == 'As':
+                # one triangular solve for all kernels
+                A = tf.matrix_triangular_solve(
+                    self._fused_tensors('Lm'),
+                    tf.concat(self._fused_tensors('Kmns'), axis=1), lower=True
+                )
+                fused[name] = tf.split(A, len(kernels), axis=1)
+
+            elif name == 'components':
+                alpha = self._fused_tensors('alpha')
+                fused[name] = tf.stack([
+                    tf.matmul(Kmn, alpha, transpose_a=True)
+                    for Kmn in self._fused_tensors('Kmns')
+                ])
+
+            elif name == 'mean':
+                Kmn = tf.add_n(self._fused_tensors('Kmns'))
+                fmean = tf.matmul(Kmn, self._fused_tensors('alpha'),
+                                  transpose_a=True)
+                fused[name] = fmean + self.mean_function(fused['X'])
+
+            elif name == 'var':
+                Kmn = tf.add_n(self._fused_tensors('Kmns'))
+                A = tf.add_n(self._fused_tensors('As'))
+                BTKmn = tf.matmul(self._fused_tensors('B'), Kmn,
+                                  transpose_a=True)
+                fvar = (
+                    self.kern.Kdiag(fused['X'])
+                    - tf.reduce_sum(tf.square(A), 0)
+                    + tf.reduce_sum(tf.square(BTKmn), 0)
+                )
+                fused[name] = fvar[:, None]
+
+            elif name == 'projected_stim':
+                kernel = _find_kernel(self.kern, ProjKernel)
+                with gpflow.params_as_tensors_for(kernel):
+                    X_sliced, _ = kernel._slice(fused['X'], None)
+                    fused[name] = tf.matmul(X_sliced, kernel.W)
+
+            elif name in ('log_pmf_inducing', 'log_pmf_pathwise'):
+                inputs = fused['inputs']
+                num_features = None
+                if name == 'log_pmf_pathwise':
+                    num_features = inputs['num_features']
+                samples = self._build_hazard_samples(
+                    fused['X'], self._fused_tensors('Lm'),
+                    tf.add_n(self._fused_tensors('As')),
+                    inputs['num_samples'], num_features
+                )
+                fused[name] = self._build_logpmf_rows(
+                    samples, inputs['first_rows'], inputs['num_samples']
+                )
+
+            else:
+                raise ValueError('Unknown prediction output {}.'.format(name))
+
+        return fused[name]
+
+    @gpflow.autoflow()
+    def compute_posterior_cache(self):
+        """posterior factors of the model, see `save_posterior_cache`"""
+        Lm = self._build_cholesky()
+        alpha, B = self._build_posterior_factors(Lm)
+        return Lm, alpha, B
+
+    @gpflow.params_as_tensors
+    def _build_cholesky(self):
+        """Cholesky factor of the inducing points covariance"""
         float_type = gpflow.settings.float_type
         jitter = gpflow.settings.jitter
+        Z = self.feature.Z
+        num_inducing = tf.shape(Z)[0]  # M
+        Kmm = self.kern.K(Z) + tf.eye(num_inducing, dtype=float_type) * jitter
+        return tf.cholesky(Kmm)
+
+    @gpflow.params_as_tensors
+    def _build_posterior_factors(self, Lm):
+        """posterior weights `alpha` and variance factor `B`
+
+        The posterior mean is `Knm alpha` and the posterior variance is
+        `Knn - Knm Kmm^-1 Kmn + Knm B B^T Kmn`.
+        """
+        alpha = self.q_mu
+        B = tf.matrix_band_part(self.q_sqrt[0], -1, 0)
+        if not self.whiten:
+            alpha = tf.matrix_triangular_solve(Lm, alpha, lower=True)
+            B = tf.matrix_triangular_solve(Lm, B, lower=True)
+        LmT = tf.transpose(Lm)
+        alpha = tf.matrix_triangular_solve(LmT, alpha, lower=False)
+        B = tf.matrix_triangular_solve(LmT, B, lower=False)
+        return alpha, B
 
-        # compute kernel stuff
+    @gpflow.params_as_tensors
+    def _build_projections(self, Xnew, kernels):
+        """Cholesky factor of Kmm and Lm^-1 Kmn for each given kernel"""
+
+        Lm = self._build_cholesky()
+
+        # one triangular solve for all kernels
         Z = self.feature.Z
-        num_data = tf.shape(Z)[0]  # M
-        Kmn = kern.K(Z, Xnew)
-        Kmm = self.kern.K(Z) + tf.eye(num_data, dtype=float_type) * jitter
-        Lm = tf.cholesky(Kmm)
+        Kmns = [kern.K(Z, Xnew) for kern in kernels]
+        A = tf.matrix_triangular_solve(Lm, tf.concat(Kmns, axis=1), lower=True)
+        return Lm, tf.split(A, len(kernels), axis=1)
+
+    @gpflow.params_as_tensors
+    def _build_component_means(self, Lm, As):
+        """conditional means from projections Lm^-1 Kmn of kernels"""
+        alpha = self.q_mu
+        if not self.whiten:
+            alpha = tf.matrix_triangular_solve(
+                tf.transpose(Lm), alpha, lower=False
+            )
+        return [tf.matmul(A, alpha, transpose_a=True) for A in As]
 
-        # compute the projection matrix A
-        A = tf.matrix_triangular_solve(Lm, Kmn, lower=True)
+    @gpflow.params_as_tensors
+    def _build_hazard_samples(self, Xnew, Lm, A, num_samples,
+                              num_features=None):
+        """hazard function samples, drawn through inducing variables"""
+
+        float_type = gpflow.settings.float_type
+        jitter = gpflow.settings.jitter
 
-        # another backsubstitution in the unwhitened case
+        # sample inducing variables u ~ q(u), as v = Lm^-1 u
+        num_inducing = tf.shape(Lm)[0]
+        eps = tf.random_normal([num_inducing, num_samples], dtype=float_type)
+        v = self.q_mu + tf.matmul(self.q_sqrt[0], eps)
         if not self.whiten:
-            A = tf.matrix_triangular_solve(tf.transpose(Lm), A, lower=False)
+            v = tf.matrix_triangular_solve(Lm, v, lower=True)
 
-        # construct the conditional mean
-        fmean = tf.matmul(A, self.q_mu, transpose_a=True)
+        # pathwise update f = f_prior + Knm Kmm^-1 (u - f_prior(Z))
+        if num_features is not None:
+            prior_X, prior_Z = sample_prior(
+                self.kern, [Xnew, self.feature.Z], num_samples, num_features
+            )
+            prior_Z += tf.sqrt(jitter) * tf.random_normal(
+                tf.shape(prior_Z), dtype=float_type
+            )
+            v -= tf.matrix_triangular_solve(Lm, prior_Z, lower=True)
+            samples = prior_X + tf.matmul(A, v, transpose_a=True)
+        else:
+            samples = tf.matmul(A, v, transpose_a=True)
+
+        return samples + self.mean_function(Xnew)
+
+    @staticmethod
+    def _build_logpmf_rows(samples, first_rows, num_samples):
+        """Monte-Carlo log-PMF from hazard samples of stacked trials"""
+
+        # convert hazard functions into probability mass functions, survival
+        # being accumulated within each trial, as a cumulative sum over all
+        # trials would lose precision when subtracting trials starts
+        samples = tf.cast(samples, tf.float64)
+        times = tf.range(tf.shape(samples)[0]) - first_rows
+        trials = tf.cumsum(tf.cast(tf.equal(times, 0), tf.int32)) - 1
+        indices = tf.stack([trials, times], axis=1)
+        padded_shape = tf.stack([
+            tf.reduce_max(trials) + 1,
+            tf.reduce_max(times) + 1,
+            tf.shape(samples)[1]
+        ])
+        log_sf = tf.scatter_nd(indices, tf.log_sigmoid(-samples), padded_shape)
+        log_sf = tf.gather_nd(
+            tf.cumsum(log_sf, axis=1, exclusive=True), indices
+        )
+        log_pmf = log_sf + tf.log_sigmoid(samples)
 
-        return fmean
+        # average to get Monte-Carlo estimate of the posterior PMF
+        return (
+            tf.reduce_logsumexp(log_pmf, axis=1)
+            - tf.log(tf.cast(num_samples, tf.float64))
+        )
 
 
-def build_model(dset, n_lags, max_nt, kernels_type, kernels_input, hierarchy,
-                combination, n_z, batch_size, fast_init=False,
-                mean_type='zero', hazard='nonsplit', **kernel_kwargs):
-    """classification GP to fit reaction-time"""
+def _find_kernel(kernel, kernel_class):
+    """first kernel of a given class in a combination of kernels"""
+    kernel_stack = [kernel]
+    while kernel_stack:
+        kernel = kernel_stack.pop(0)
+        if isinstance(kernel, kernel_class):
+            return kernel
+        if isinstance(kernel, gpflow.kernels.Combination):
+            kernel_stack.extend(kernel.kernels)
+    raise ValueError('No {} in kernel.'.format(kernel_class.__name__))
 
-    # prepare training data
-    X_train, y_train = prepare_Xy(dset, n_lags, max_nt)
-    X_train, y_train = np.vstack(X_train), np.vstack(y_train)
 
-    # kernel for Gaussian process
+class StreamingMixin:
+    """SVGP mixin drawing mini-batches from a prefetching input pipeline
+
+    Mini-batches of lagged data are built on the fly by a generator over
+    `LagFeatures`, run by a `tf.data` pipeline which prefetches them while the
+    optimizer runs, so that the training data is never materialized. Batches
+    contain random rows or whole trials, depending on `level`.
+    """
+
+    def __init__(self, features, kern, likelihood, batch_size, level='row',
+                 prefetch=2, seed=None, **kwargs):
+        kwargs.setdefault('name', self.model_name)
+
+        # data holders are only used for their shape, hence a single row
+        X, Y = features.row_range(0, 1)
+        super().__init__(X, Y, kern, likelihood, num_data=features.num_rows,
+                         **kwargs)
+
+        self.lag_features = features
+        self.batch_size = batch_size
+        self.level = level
+        self.prefetch = prefetch
+        self.seed = seed
+
+    def _build_minibatch(self):
+        float_type = gpflow.settings.float_type
+        n_cols = self.lag_features.n_lags + 3
+
+        batches = partial(
+            self.lag_features.batches, self.batch_size, self.level, self.seed
+        )
+        dataset = tf.data.Dataset.from_generator(
+            batches, (float_type, float_type),
+            (tf.TensorShape([None, n_cols]), tf.TensorShape([None, 1]))
+        )
+        dataset = dataset.prefetch(self.prefetch)
+        return dataset.make_one_shot_iterator().get_next()
+
+    @gpflow.params_as_tensors
+    def _build_likelihood(self):
+        X, Y = self._build_minibatch()
+        float_type = gpflow.settings.float_type
+
+        KL = self.build_prior_KL()
+        fmean, fvar = self._build_predict(X, full_cov=False)
+        var_exp = self.likelihood.variational_expectations(fmean, fvar, Y)
+        scale = (
+            tf.cast(self.num_data, float_type)
+            / tf.cast(tf.shape(X)[0], float_type)
+        )
+        return tf.reduce_sum(var_exp) * scale - KL
+
+
+class StreamingSVGP(StreamingMixin, PartialSVGP):
+    """PartialSVGP trained on mini-batches built on the fly"""
+    model_name = 'PartialSVGP'
+
+
+class StreamingFVGP(StreamingMixin, FVGP):
+    """FVGP trained on mini-batches built on the fly"""
+    model_name = 'FVGP'
+
+
+def build_combined_kernel(kernels_type, kernels_input, hierarchy, combination,
+                          n_lags, **kernel_kwargs):
+    """combine kernels for each input, as a sum or a product"""
+
     if len(kernels_type) == 1:
         kernels_type = list(kernels_type) * len(kernels_input)
 
@@ -408,50 +757,300 @@ def build_model(dset, n_lags, max_nt, kernels_type, kernels_input, hierarchy,
         ]
 
     kernel_op = operator.mul if combination == 'mul' else operator.add
-    kernel = reduce(kernel_op, kernels)
+    return reduce(kernel_op, kernels)
+
+
+def build_mean_function(mean_type, base_rate, n_cols):
+    """GP mean function, initialized with a base logit-hazard rate"""
+    if mean_type == 'zero':
+        mean_func = None
+    elif mean_type == 'constant':
+        mean_func = gpflow.mean_functions.Constant(base_rate)
+    elif mean_type == 'linear':
+        mean_func = gpflow.mean_functions.Linear(
+            A=np.zeros((n_cols, 1)), b=base_rate
+        )
+    else:
+        raise ValueError('Unknown mean function type {}.'.format(mean_type))
+    return mean_func
+
+
+def _fit_kmeans(X, seed, n_z, init_size):
+    """k-means cluster centers of lagged data, ignoring code columns"""
+    # slow import, only needed to fit models
+    from sklearn.cluster import MiniBatchKMeans
+    kmeans = MiniBatchKMeans(n_z, init_size=init_size, random_state=seed)
+    kmeans.fit(X[:, :-2])
+    Z = np.empty((n_z, X.shape[1]))
+    Z[:, :-2] = kmeans.cluster_centers_
+    Z[:, -2:] = X[0, -2:]
+    return Z
+
+
+def init_inducing_points(features, n_z, max_rows=None, init_size=None,
+                         n_workers=1, cache_dir=None):
+    """k-means initialization of inducing points, per hazard block and mouse
+
+    Groups are clustered in parallel processes (0 worker: one per group), on at
+    most `max_rows` rows drawn at random, k-means++ seeding using `init_size`
+    rows. Worker processes are spawned rather than forked, as forking a
+    process running TensorFlow can deadlock. If a cache folder is given,
+    results are saved there, keyed on the lagged data, `n_z` and sampling
+    options, and reused by other models.
+    """
+    has_rows = features.lengths > 0
+    groups = list(product(
+        np.unique(features.hazard_code[has_rows]),
+        np.unique(features.mouse_code[has_rows])
+    ))
+
+    # draw seeds even if the cache is used, to leave random state unchanged
+    seeds = np.random.randint(2**31, size=len(groups))
+
+    if cache_dir is not None:
+        key = hashlib.sha1('{}-{}-{}-{}'.format(
+            features.digest(), n_z, max_rows, init_size
+        ).encode()).hexdigest()
+        cache_path = Path(cache_dir) / 'inducing-{}.npy'.format(key[:16])
+        if cache_path.exists():
+            return np.load(str(cache_path))
+
+    Xs = []
+    for (i, j), seed in zip(groups, seeds):
+        trials = np.flatnonzero(
+            has_rows & (features.hazard_code == i) & (features.mouse_code == j)
+        )
+        if max_rows is not None and features.lengths[trials].sum() > max_rows:
+            rng = np.random.RandomState(seed)
+            X, _ = features.sample_rows(trials, max_rows, rng)
+        else:
+            X, _ = features.trial_rows(trials)
+        Xs.append(X)
+
+    if n_workers <= 0:
+        n_workers = min(len(groups), os.cpu_count() or 1)
+
+    fit_kmeans = partial(_fit_kmeans, n_z=n_z, init_size=init_size)
+    if n_workers <= 1:
+        Zs = list(map(fit_kmeans, Xs, seeds))
+    else:
+        with get_context('spawn').Pool(n_workers) as pool:
+            Zs = pool.starmap(fit_kmeans, zip(Xs, seeds))
+    Z = np.vstack(Zs)
+
+    if cache_dir is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(
+            '{}.tmp{}.npy'.format(cache_path.stem, os.getpid())
+        )
+        np.save(str(tmp_path), Z)
+        os.replace(str(tmp_path), str(cache_path))
+
+    return Z
+
+
+def build_model(dset, n_lags, max_nt, kernels_type, kernels_input, hierarchy,
+                combination, n_z, batch_size, fast_init=False,
+                mean_type='zero', hazard='nonsplit', streaming=None,
+                kmeans_rows=None, kmeans_init_size=None, n_workers=1,
+                cache_dir=None, Xy=None, **kernel_kwargs):
+    """classification GP to fit reaction-time
+
+    If `streaming` is set to 'row' or 'trial', training data are not
+    materialized but mini-batches of rows or whole trials are built on the fly.
+    Otherwise, `Xy` can provide the stacked features and licks of `dset`, if
+    already computed. Remaining options control the k-means initialization of
+    inducing points, see `init_inducing_points`.
+
+    With `fast_init`, parameters are only given placeholder values, to be
+    overwritten by `assign`, and the global random state is left untouched.
+    """
+
+    # prepare training data
+    features = LagFeatures(dset, n_lags, max_nt)
+    if streaming is None:
+        if Xy is None:
+            Xy = stack_Xy(dset, n_lags, max_nt)[:2]
+        X_train, y_train = Xy
+    n_cols = n_lags + 3
+    rng = np.random.RandomState(0) if fast_init else np.random
+
+    # kernel for Gaussian process
+    kernel = build_combined_kernel(
+        kernels_type, kernels_input, hierarchy, combination, n_lags, rng=rng,
+        **kernel_kwargs
+    )
 
     # inducing points
-    hazard_codes = np.unique(X_train[:, -2])
-    mice_codes = np.unique(X_train[:, -1])
+    has_rows = features.lengths > 0
+    hazard_codes = np.unique(features.hazard_code[has_rows])
+    mice_codes = np.unique(features.mouse_code[has_rows])
 
     if fast_init:
         nz_total = n_z * len(mice_codes) * len(hazard_codes)
-        Z = np.zeros((nz_total, X_train.shape[1]))
+        Z = np.zeros((nz_total, n_cols))
 
     else:
-        Zs = []
-        for i, j in product(hazard_codes, mice_codes):
-            mask = np.all(X_train[:, -2:] == (i, j), axis=-1)
-            kmeans = MiniBatchKMeans(n_z).fit(X_train[mask])
-            Zs.append(kmeans.cluster_centers_.copy())
-        Z = np.vstack(Zs)
+        # subsample rows to keep memory bounded by the batch size if streaming
+        if streaming is not None and kmeans_rows is None:
+            kmeans_rows = 10 * batch_size
+        Z = init_inducing_points(
+            features, n_z, kmeans_rows, kmeans_init_size, n_workers, cache_dir
+        )
 
     # sparse variational GP model
     likelihood = gpflow.likelihoods.Bernoulli(invlink=tf.nn.sigmoid)
 
-    if mean_type == 'zero':
-        mean_func = None
-    elif mean_type == 'constant':
-        y_mean = y_train.mean()
-        base_rate = np.log(y_mean / (1 - y_mean))
-        mean_func = gpflow.mean_functions.Constant(base_rate)
-    elif mean_type == 'linear':
-        y_mean = y_train.mean()
+    if fast_init:
+        base_rate = 0.0
+    else:
+        y_mean = features.licked.sum() / features.num_rows
         base_rate = np.log(y_mean / (1 - y_mean))
-        mean_func = gpflow.mean_functions.Linear(
-            A=np.zeros((X_train.shape[1], 1)), b=base_rate
+    mean_func = build_mean_function(mean_type, base_rate, n_cols)
+
+    if streaming is None:
+        model = PartialSVGP(
+            X_train, y_train, kern=kernel, likelihood=likelihood, Z=Z,
+            minibatch_size=batch_size, mean_function=mean_func
         )
     else:
-        raise ValueError('Unknown mean function type {}.'.format(mean_type))
+        model = StreamingSVGP(
+            features, kern=kernel, likelihood=likelihood, Z=Z,
+            batch_size=batch_size, level=streaming,
+            seed=rng.randint(2**31), mean_function=mean_func
+        )
+
+    # attach parameters to the model
+    model.n_lags = n_lags
+    model.max_nt = max_nt
+
+    return model
+
 
-    model = PartialSVGP(
-        X_train, y_train, kern=kernel, likelihood=likelihood, Z=Z,
-        minibatch_size=batch_size, mean_function=mean_func
+POSTERIOR_CACHE = 'posterior_cache.npz'
+
+
+def params_digest(model_params):
+    """hash of model parameters, rounded to single precision
+
+    Rounding makes the hash independent of the precision used to load the
+    parameters (see `read_params`).
+    """
+    digest = hashlib.sha1()
+    for key in sorted(model_params):
+        value = np.asarray(model_params[key])
+        if value.dtype.kind == 'f':
+            value = value.astype(np.float32)
+        digest.update(key.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    return digest.hexdigest()
+
+
+def save_posterior_cache(model_dir, precision='float64'):
+    """precompute posterior factors of a fitted model and save them
+
+    The Cholesky factor `Lm` of Kmm, posterior weights `alpha` and variance
+    factor `B` (see `PartialSVGP._build_posterior_factors`) only depend on the
+    fitted parameters. They are saved next to the best parameters, with a
+    hash of these parameters to detect stale caches.
+    """
+    model_path = Path(model_dir)
+
+    # build the model in its own graph, to not interfere with other models
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph).as_default(), \
+            gpflow.settings.temp_settings(precision_settings(precision)):
+        model_params = read_params(model_path / 'model_params_best.npz')
+        model = load_model(model_path, model_params, use_cache=False)
+        Lm, alpha, B = model.compute_posterior_cache()
+
+    np.savez(
+        str(model_path / POSTERIOR_CACHE), Lm=Lm, alpha=alpha, B=B,
+        params_digest=params_digest(model_params)
+    )
+
+
+def read_posterior_cache(model_dir, model_params):
+    """load the posterior cache of a model, if valid for given parameters"""
+    cache_path = Path(model_dir) / POSTERIOR_CACHE
+    if not cache_path.exists():
+        return None
+    with np.load(str(cache_path)) as cache:
+        if str(cache['params_digest']) != params_digest(model_params):
+            return None
+        return {key: cache[key] for key in ('Lm', 'alpha', 'B')}
+
+
+def load_model(model_dir, model_params=None, use_cache=True,
+               samples_chunk_size=None):
+    """rebuild a fitted model for predictions, without its training data
+
+    The model is built from the options saved in `model_dir`, its inducing
+    points and other parameters being set from `model_params` (by default,
+    the best parameters saved in `model_dir`). Training data are replaced by
+    a single placeholder row, so loading cost does not depend on their size.
+    If `use_cache` is set, a posterior cache saved in `model_dir` is attached
+    to the model, unless it was computed from other parameters.
+
+    Models fitted with an ARD prior and not converted (see gp_convert.py) are
+    rebuilt as `FVGP` models, drawing `samples_chunk_size` hyperparameters
+    per graph call (by default, the value used for fitting).
+    """
+    model_path = Path(model_dir)
+    model_opts = dict(np.load(str(model_path / 'model_options.npz')))
+    if model_params is None:
+        model_params = read_params(model_path / 'model_params_best.npz')
+
+    n_lags = int(model_opts.pop('n_lags'))
+    max_nt = int(model_opts.pop('max_nt'))
+    n_cols = n_lags + 3
+    for key in ('n_z', 'batch_size', 'hazard'):
+        model_opts.pop(key, None)
+    mean_type = model_opts.pop('mean_type', 'zero')
+
+    kernel = build_combined_kernel(
+        n_lags=n_lags, rng=np.random.RandomState(0), **model_opts
     )
+    likelihood = gpflow.likelihoods.Bernoulli(invlink=tf.nn.sigmoid)
+    mean_func = build_mean_function(mean_type, 0.0, n_cols)
+    Z = next(
+        value for key, value in model_params.items()
+        if key.endswith('feature/Z')
+    )
+
+    use_ard = any(key.startswith('FVGP/') for key in model_params)
+    if use_ard:
+        if samples_chunk_size is None:
+            samples_chunk_size = fit_argument(
+                model_path, 'samples_chunk_size', SAMPLES_CHUNK_SIZE
+            )
+
+        # ARD priors are named after the model they are built for, as in
+        # `build_model_ard`
+        with gpflow.defer_build():
+            model = PartialSVGP(
+                np.zeros((1, n_cols)), np.zeros((1, 1)), kern=kernel,
+                likelihood=likelihood, Z=Z, mean_function=mean_func
+            )
+        priors, extra_factors = build_ard_priors(model.kern)
+        model = FVGP(
+            model.X.value, model.Y.value, model.kern, model.likelihood,
+            Z=Z, mean_function=model.mean_function, priors=priors,
+            extra_factors=extra_factors, samples_chunk_size=samples_chunk_size
+        )
+
+    else:
+        model = PartialSVGP(
+            np.zeros((1, n_cols)), np.zeros((1, 1)), kern=kernel,
+            likelihood=likelihood, Z=Z, mean_function=mean_func
+        )
+    model.assign(model_params)
 
     # attach parameters to the model
     model.n_lags = n_lags
     model.max_nt = max_nt
+    if use_cache and not use_ard:
+        model.posterior_cache = read_posterior_cache(model_path, model_params)
 
     return model
 
@@ -486,56 +1085,237 @@ def build_ard_priors(model_kernel):
     return priors, extra_factors
 
 
-def build_model_ard(*args, **kwargs):
-    """instantiate a GP model with ARD prior, using ADVI to fit posterior"""
+def build_model_ard(*args, samples_chunk_size=SAMPLES_CHUNK_SIZE, **kwargs):
+    """instantiate a GP model with ARD prior, using ADVI to fit posterior
+
+    Predictions use `samples_chunk_size` hyperparameters draws per graph call
+    (see `gp_advi.FVGP`).
+    """
 
     with gpflow.defer_build():
         model = build_model(*args, **kwargs)
     n_lags, max_nt = model.n_lags, model.max_nt
 
     priors, extra_factors = build_ard_priors(model.kern)
-    model = FVGP(
-        model.X.value, model.Y.value, model.kern, model.likelihood,
-        Z=model.feature.Z.value, mean_function=model.mean_function,
-        minibatch_size=model.X.batch_size,
-        priors=priors, extra_factors=extra_factors
-    )
+    if isinstance(model, StreamingSVGP):
+        model = StreamingFVGP(
+            model.lag_features, model.kern, model.likelihood,
+            batch_size=model.batch_size, level=model.level, seed=model.seed,
+            Z=model.feature.Z.value, mean_function=model.mean_function,
+            priors=priors, extra_factors=extra_factors,
+            samples_chunk_size=samples_chunk_size
+        )
+    else:
+        model = FVGP(
+            model.X.value, model.Y.value, model.kern, model.likelihood,
+            Z=model.feature.Z.value, mean_function=model.mean_function,
+            minibatch_size=model.X.batch_size,
+            priors=priors, extra_factors=extra_factors,
+            samples_chunk_size=samples_chunk_size
+        )
     model.n_lags, model.max_nt = n_lags, max_nt
 
     return model
 
 
-def predict_logpmf(model, dset, n_samples):
-    """approximate posterior log-PMF of the discrete time-survival model"""
+# floating point precisions of models
+Precision = strenum('Precision', 'float64 float32')
 
-    # transform data for the model
-    Xs = prepare_X(dset, model.n_lags, model.max_nt)
+# jitter added to covariance matrices, larger in single precision to keep
+# Cholesky decompositions stable
+JITTER_LEVELS = {'float64': 1e-6, 'float32': 1e-4}
 
-    log_pmf_trials = []
-    for i, X in enumerate(Xs):
-        # sample discrete-time hazard functions
-        samples = model.predict_f_samples(X, n_samples).squeeze()
-        hazard = expit(samples)  # inv-logit transform
 
-        # convert into probability mass functions
-        log_sf = np.log(1 - hazard).cumsum(axis=1)
-        log_sf = np.hstack([np.zeros((n_samples, 1)), log_sf[:, :-1]])
-        log_pmf = log_sf + np.log(hazard)
+def precision_settings(precision):
+    """gpflow settings to build models in single or double precision"""
+    settings = gpflow.settings.get_settings()
+    settings.dtypes.float_type = np.dtype(str(precision)).type
+    settings.numerics.jitter_level = JITTER_LEVELS[str(precision)]
+    return settings
 
-        # average to get Monte-Carlo estimate of the posterior PMF
-        log_pmf = logsumexp(log_pmf, axis=0) - np.log(n_samples)
 
-        # append no-lick probability at the end
-        log_prob_lick = logsumexp(log_pmf)
-        if np.isclose(log_prob_lick, 0):
-            log_pmf -= log_prob_lick  # ajust probabilities to sum to 1
-            log_prob_nolick = -np.inf  # P(no-lick) = 0
-        else:
-            log_prob_nolick = np.log1p(-np.exp(log_prob_lick))
-        log_pmf = np.append(log_pmf, log_prob_nolick)
+def fit_argument(model_dir, name, default):
+    """option used to fit a model, `default` if not recorded"""
+    arguments_path = Path(model_dir) / 'arguments.json'
+    if not arguments_path.exists():
+        return default
+    with arguments_path.open() as fd:
+        return json.load(fd).get(name, default)
+
+
+def fit_precision(model_dir):
+    """precision used to fit a model, double precision if not recorded"""
+    return Precision(fit_argument(model_dir, 'precision', 'float64'))
+
+
+def read_params(filename):
+    """load model parameters, with floats in the current precision"""
+    float_type = gpflow.settings.float_type
+    params = dict(np.load(filename))
+    for key, value in params.items():
+        if value.dtype.kind == 'f':
+            params[key] = value.astype(float_type)
+    return params
+
+
+def _padded_batches(lengths, max_rows):
+    """batches of trials sorted by length, with at most max_rows padded rows"""
+    order = np.argsort(lengths, kind='mergesort')
+    start = 0
+    while start < len(order):
+        padded_rows = np.arange(1, len(order) - start + 1) * np.maximum(
+            lengths[order[start:]], 1
+        )
+        stop = start + max(np.searchsorted(padded_rows, max_rows, 'right'), 1)
+        yield order[start:stop]
+        start = stop
+
+
+def _stacked_batches(row_offsets, max_rows):
+    """batches of consecutive trials, with at most max_rows rows"""
+    n_trials = len(row_offsets) - 1
+    start = 0
+    while start < n_trials:
+        stop = np.searchsorted(
+            row_offsets, row_offsets[start] + max_rows, 'right'
+        ) - 1
+        stop = min(max(stop, start + 1), n_trials)
+        yield np.arange(start, stop)
+        start = stop
+
+
+def _append_nolick(log_pmf, lengths):
+    """add no-lick probability to padded log-PMFs, as a list of arrays"""
+
+    log_prob_lick = logsumexp(log_pmf, axis=1)
+    is_lick_certain = np.isclose(log_prob_lick, 0)
+
+    # ajust probabilities to sum to 1 if P(no-lick) = 0
+    log_pmf[is_lick_certain] -= log_prob_lick[is_lick_certain, np.newaxis]
+    log_prob_nolick = np.full(len(log_pmf), -np.inf)
+    log_prob_nolick[~is_lick_certain] = np.log1p(
+        -np.exp(log_prob_lick[~is_lick_certain])
+    )
+
+    assert np.all(log_pmf <= 0)  # detect numerical errors
 
-        assert np.all(log_pmf <= 0)  # detect numerical errors
+    return [
+        np.append(trial_log_pmf[:length], trial_log_prob_nolick)
+        for trial_log_pmf, length, trial_log_prob_nolick
+        in zip(log_pmf, lengths, log_prob_nolick)
+    ]
+
+
+def predict_logpmf(model, dset, n_samples, max_rows=20000, method='cholesky',
+                   n_features=256):
+    """approximate posterior log-PMF of the discrete time-survival model
+
+    With the 'cholesky' method, hazard functions are sampled from the full
+    posterior covariance of each trial. Trials are then sorted by length and
+    evaluated in batches, padded to the longest trial of each batch, with at
+    most `max_rows` padded rows.
+
+    The 'inducing' and 'pathwise' methods sample hazard functions through
+    inducing variables, see `PartialSVGP.predict_fused`, with a cost linear in
+    the number of rows. Trials are evaluated in batches of at most `max_rows`
+    rows.
+    """
 
-        log_pmf_trials.append(log_pmf)
+    if method in ('inducing', 'pathwise'):
+        predictions = predict_trials(
+            model, dset, ['log_pmf'], n_samples, max_rows, method, n_features
+        )
+        return predictions['log_pmf']
+    elif method != 'cholesky':
+        raise ValueError('Unknown sampling method {}.'.format(method))
+
+    # transform data for the model
+    features = LagFeatures(dset, model.n_lags, model.max_nt, truncate=False)
+    lengths = features.lengths
+
+    log_pmf_trials = [None] * len(lengths)
+    for trials in _padded_batches(lengths, max_rows):
+        trial_lengths = lengths[trials]
+        n_pad = max(trial_lengths.max(), 1)
+        padding_mask = np.arange(n_pad) < trial_lengths[:, np.newaxis]
+        X_rows, _ = features.trial_rows(trials)
+
+        # scatter rows of trials into a padded array
+        X = np.zeros((len(trials), n_pad, X_rows.shape[1]))
+        X[padding_mask] = X_rows
+        log_pmf = model.predict_logpmf_padded(X, trial_lengths, n_samples)
+
+        log_pmf = _append_nolick(log_pmf.astype(float), trial_lengths)
+        for trial, trial_log_pmf in zip(trials, log_pmf):
+            log_pmf_trials[trial] = trial_log_pmf
 
     return log_pmf_trials
+
+
+def predict_trials(model, dset, outputs, n_samples=None, max_rows=20000,
+                   method='inducing', n_features=256):
+    """posterior predictions of a model, as lists of per-trial arrays
+
+    Trials are evaluated in batches of at most `max_rows` rows, all requested
+    outputs sharing kernel computations (see `PartialSVGP.predict_fused` for
+    available outputs). Components are returned as a list of arrays for each
+    trial. With the 'cholesky' sampling method, the log-PMF is computed
+    separately by `predict_logpmf`.
+    """
+
+    outputs = list(outputs)
+    fused_outputs = [
+        output for output in outputs
+        if output != 'log_pmf' or method != 'cholesky'
+    ]
+    if method not in ('cholesky', 'inducing', 'pathwise'):
+        raise ValueError('Unknown sampling method {}.'.format(method))
+    num_features = n_features if method == 'pathwise' else None
+
+    # transform data for the model
+    features = LagFeatures(dset, model.n_lags, model.max_nt, truncate=False)
+    lengths = features.lengths
+
+    predictions = {output: [None] * len(lengths) for output in outputs}
+    if fused_outputs:
+        batches = _stacked_batches(features.row_offsets, max_rows)
+    else:
+        batches = []
+
+    for trials in batches:
+        trial_lengths = lengths[trials]
+        X_rows, _ = features.trial_rows(trials)
+        row_offsets = np.zeros(len(trials), dtype=int)
+        np.cumsum(trial_lengths[:-1], out=row_offsets[1:])
+
+        first_rows = None
+        if 'log_pmf' in fused_outputs:
+            first_rows = np.repeat(row_offsets, trial_lengths)
+        results = model.predict_fused(
+            X_rows, fused_outputs, first_rows, n_samples, num_features
+        )
+
+        for output, result in results.items():
+            if output == 'log_pmf':
+                n_pad = max(trial_lengths.max(), 1)
+                padding_mask = np.arange(n_pad) < trial_lengths[:, np.newaxis]
+                log_pmf = np.full((len(trials), n_pad), -np.inf)
+                log_pmf[padding_mask] = result
+                trial_results = _append_nolick(log_pmf, trial_lengths)
+            elif output == 'components':
+                trial_results = [
+                    list(parts)
+                    for parts in np.split(result, row_offsets[1:], axis=1)
+                ]
+            else:
+                trial_results = np.split(result, row_offsets[1:])
+
+            for trial, trial_result in zip(trials, trial_results):
+                predictions[output][trial] = trial_result
+
+    if 'log_pmf' in outputs and method == 'cholesky':
+        predictions['log_pmf'] = predict_logpmf(
+            model, dset, n_samples, max_rows, method
+        )
+
+    return predictions
@@ -0,0 +1,484 @@
+"""NumPy implementation of fitted models, for inference without TensorFlow
+
+Kernels, mean functions and the SVGP posterior mirror their gpflow
+counterparts, with the same parameter names, so that saved parameter files
+can be loaded directly. Models are plain Python objects, which can be used in
+(and sent to) worker processes without a TensorFlow session.
+"""
+
+from functools import reduce
+from pathlib import Path
+
+import numpy as np
+from scipy.linalg import cholesky, solve_triangular
+
+# default jitter level of gpflow in double precision
+JITTER = 1e-6
+
+
+class Kernel:
+    """base kernel, with parameters and sub-kernels loaded from saved files"""
+
+    param_names = ()
+
+    def __init__(self, input_dim, active_dims=None):
+        self.input_dim = input_dim
+        if active_dims is None:
+            active_dims = slice(input_dim)
+        elif not isinstance(active_dims, slice):
+            active_dims = np.asarray(active_dims, dtype=int)
+        self.active_dims = active_dims
+
+    def children(self):
+        """named sub-kernels, as in gpflow parameter paths"""
+        return []
+
+    def load(self, params, prefix):
+        """set parameters values, given the path prefix of the kernel"""
+        for name in self.param_names:
+            setattr(self, name, np.asarray(params[prefix + '/' + name]))
+        for name, child in self.children():
+            child.load(params, prefix + '/' + name)
+
+    def _slice(self, X, X2=None):
+        X = X[:, self.active_dims]
+        if X2 is not None:
+            X2 = X2[:, self.active_dims]
+        return X, X2
+
+
+class Stationary(Kernel):
+    param_names = ('variance', 'lengthscales')
+
+    def scaled_square_dist(self, X, X2=None):
+        X = X / self.lengthscales
+        X2 = X if X2 is None else X2 / self.lengthscales
+        Xs = np.sum(X ** 2, axis=1)
+        X2s = np.sum(X2 ** 2, axis=1)
+        return -2 * X.dot(X2.T) + Xs[:, np.newaxis] + X2s[np.newaxis, :]
+
+    def scaled_euclid_dist(self, X, X2=None):
+        r2 = self.scaled_square_dist(X, X2)
+        return np.sqrt(np.maximum(r2, 1e-40))
+
+    def K(self, X, X2=None):
+        X, X2 = self._slice(X, X2)
+        return self.K_r(X, X2)
+
+    def Kdiag(self, X):
+        return np.full(len(X), self.variance)
+
+
+class RBF(Stationary):
+
+    def K_r(self, X, X2):
+        return self.variance * np.exp(-self.scaled_square_dist(X, X2) / 2)
+
+
+class Matern12(Stationary):
+
+    def K_r(self, X, X2):
+        r = self.scaled_euclid_dist(X, X2)
+        return self.variance * np.exp(-r)
+
+
+class Matern32(Stationary):
+
+    def K_r(self, X, X2):
+        r = self.scaled_euclid_dist(X, X2)
+        return self.variance * (1 + np.sqrt(3) * r) * np.exp(-np.sqrt(3) * r)
+
+
+class Matern52(Stationary):
+
+    def K_r(self, X, X2):
+        r = self.scaled_euclid_dist(X, X2)
+        return (
+            self.variance * (1 + np.sqrt(5) * r + 5 / 3 * r ** 2)
+            * np.exp(-np.sqrt(5) * r)
+        )
+
+
+class Linear(Kernel):
+    param_names = ('variance',)
+
+    def K(self, X, X2=None):
+        X, X2 = self._slice(X, X2)
+        X2 = X if X2 is None else X2
+        return (X * self.variance).dot(X2.T)
+
+    def Kdiag(self, X):
+        X, _ = self._slice(X)
+        return np.sum(X ** 2 * self.variance, axis=1)
+
+
+class Constant(Kernel):
+    param_names = ('variance',)
+
+    def K(self, X, X2=None):
+        X2 = X if X2 is None else X2
+        return np.full((len(X), len(X2)), self.variance)
+
+    def Kdiag(self, X):
+        return np.full(len(X), self.variance)
+
+
+class White(Kernel):
+    param_names = ('variance',)
+
+    def K(self, X, X2=None):
+        if X2 is None:
+            return self.variance * np.eye(len(X))
+        return np.zeros((len(X), len(X2)))
+
+    def Kdiag(self, X):
+        return np.full(len(X), self.variance)
+
+
+class Combination(Kernel):
+
+    def __init__(self, kernels):
+        super().__init__(None)
+        self.kernels = kernels
+
+    def children(self):
+        return [
+            ('kernels/{}'.format(i), kernel)
+            for i, kernel in enumerate(self.kernels)
+        ]
+
+
+class Sum(Combination):
+
+    def K(self, X, X2=None):
+        return reduce(np.add, [k.K(X, X2) for k in self.kernels])
+
+    def Kdiag(self, X):
+        return reduce(np.add, [k.Kdiag(X) for k in self.kernels])
+
+
+class Product(Combination):
+
+    def K(self, X, X2=None):
+        return reduce(np.multiply, [k.K(X, X2) for k in self.kernels])
+
+    def Kdiag(self, X):
+        return reduce(np.multiply, [k.Kdiag(X) for k in self.kernels])
+
+
+class Hierarchical(Combination):
+    """see gp_model.Hierarchical"""
+
+    def __init__(self, kernels, indicator_dims=[1]):
+        super().__init__(kernels)
+        self.indicator_dims = indicator_dims
+
+    def K(self, X, X2=None):
+        K = self.kernels[0].K(X, X2)
+
+        if X2 is None:
+            X2 = X
+
+        for i, ind_dim in enumerate(self.indicator_dims):
+            indX, indX2 = X[:, ind_dim:ind_dim + 1], X2[:, ind_dim:ind_dim + 1]
+            mask = indX == indX2.T
+            k = self.kernels[i + 1]
+            K = K + mask * k.K(X, X2)
+
+        return K
+
+    def Kdiag(self, X):
+        return reduce(np.add, [k.Kdiag(X) for k in self.kernels])
+
+
+class TransformedKernel(Kernel):
+    """base kernel applied on transformed inputs"""
+
+    def __init__(self, base_kernel, input_dim, active_dims=None):
+        super().__init__(input_dim, active_dims)
+        self.base_kernel = base_kernel
+
+    def children(self):
+        return [('base_kernel', self.base_kernel)]
+
+    def transform(self, X):
+        raise NotImplementedError
+
+    def K(self, X, X2=None):
+        X2 = None if X2 is None else self.transform(X2)
+        return self.base_kernel.K(self.transform(X), X2)
+
+    def Kdiag(self, X):
+        return self.base_kernel.Kdiag(self.transform(X))
+
+
+class ProjKernel(TransformedKernel):
+    """see gp_model.ProjKernel"""
+
+    param_names = ('W',)
+
+    def project(self, X):
+        X_sliced, _ = self._slice(X)
+        return X_sliced.dot(self.W)
+
+    def transform(self, X):
+        return np.hstack([X, self.project(X)])
+
+
+class ExpProjKernel(ProjKernel):
+    """see gp_model.ExpProjKernel"""
+
+    param_names = ('A', 'ND', 'L')
+
+    @property
+    def W(self):
+        t = np.arange(self.input_dim, dtype=float)[:, np.newaxis]
+        # multiply exponential with a sigmoid for non-decision time
+        nd = 1 / (np.exp(-t + self.ND) + 1)
+        return np.exp(t.dot(self.L)) * self.A * nd
+
+
+class WarpedKernel(TransformedKernel):
+    """see gp_model.WarpedKernel"""
+
+    param_names = ('coeffs_a', 'coeffs_b', 'coeffs_c')
+
+    def transform(self, X):
+        return X + np.sum(
+            self.coeffs_a * np.tanh(self.coeffs_b * X[..., np.newaxis]
+                                    + self.coeffs_c),
+            axis=-1
+        )
+
+
+class LogTranformedKernel(TransformedKernel):
+    """see gp_model.LogTranformedKernel"""
+
+    param_names = ('offset',)
+
+    def transform(self, X):
+        return np.log(X + self.offset)
+
+
+KERNEL_CLASSES = {
+    'RBF': RBF,
+    'Matern12': Matern12,
+    'Matern32': Matern32,
+    'Matern52': Matern52,
+    'Linear': Linear,
+    'Constant': Constant,
+    'Bias': Constant,
+    'White': White
+}
+
+
+def build_kernel(kernel_type, kernel_input, hierarchy, n_lags, n_proj=None,
+                 **kwargs):
+    """NumPy version of gp_model.build_kernel, without parameter values"""
+
+    kernel_class = KERNEL_CLASSES[str(kernel_type)]
+
+    if hierarchy:
+        base_kernel_class = kernel_class
+
+        # select dimensions of X that specify hierarchy divisions
+        hierarchy_dims = []
+        if 'hzrd' in hierarchy:
+            hierarchy_dims.append(n_lags + 1)
+        if 'mouse' in hierarchy:
+            hierarchy_dims.append(n_lags + 2)
+
+        def kernel_class(*args, **kwargs):
+            kernel_parent = base_kernel_class(*args, **kwargs)
+            kernel_child = base_kernel_class(*args, **kwargs)
+            return Hierarchical(
+                [kernel_parent, kernel_child], indicator_dims=hierarchy_dims
+            )
+
+    if kernel_type in ['White', 'Constant', 'Bias']:
+        kernel = kernel_class(n_lags + 2)
+
+    elif kernel_input == 'full':
+        kernel = kernel_class(n_lags + 1)
+
+    elif kernel_input == 'time':
+        kernel = kernel_class(1, active_dims=[n_lags])
+
+    elif kernel_input == 'logtime':
+        base_kernel = kernel_class(1, active_dims=[n_lags])
+        kernel = LogTranformedKernel(base_kernel, 1)
+
+    elif kernel_input == 'wtime':
+        base_kernel = kernel_class(1, active_dims=[n_lags])
+        kernel = WarpedKernel(base_kernel, 1)
+
+    elif kernel_input == 'hzrd':
+        kernel = kernel_class(1, active_dims=[n_lags + 1])
+
+    elif kernel_input == 'stim':
+        kernel = kernel_class(n_lags)
+
+    elif kernel_input in ('proj', 'expproj'):
+        kernel_dims = np.arange(n_proj) + n_lags + 3
+        base_kernel = kernel_class(n_proj, active_dims=kernel_dims)
+        kernel_class = ProjKernel if kernel_input == 'proj' else ExpProjKernel
+        kernel = kernel_class(base_kernel, n_lags)
+
+    else:
+        raise ValueError('Unknown kernel input type {}.'.format(kernel_input))
+
+    return kernel
+
+
+def build_combined_kernel(kernels_type, kernels_input, hierarchy, combination,
+                          n_lags, **kernel_kwargs):
+    """combine kernels for each input, as a sum or a product"""
+
+    if len(kernels_type) == 1:
+        kernels_type = list(kernels_type) * len(kernels_input)
+
+    kernels = [
+        build_kernel(k_type, k_input, hierarchy, n_lags, **kernel_kwargs)
+        for k_type, k_input in zip(kernels_type, kernels_input)
+    ]
+
+    if len(kernels) == 1:
+        return kernels[0]
+    return Product(kernels) if combination == 'mul' else Sum(kernels)
+
+
+class MeanFunction:
+    """mean function, Zero, Constant or Linear as in gpflow.mean_functions"""
+
+    def __init__(self, mean_type, params=None, prefix=None):
+        self.mean_type = mean_type
+        if mean_type == 'constant':
+            self.c = np.asarray(params[prefix + '/c'])
+        elif mean_type == 'linear':
+            self.A = np.asarray(params[prefix + '/A'])
+            self.b = np.asarray(params[prefix + '/b'])
+        elif mean_type != 'zero':
+            raise ValueError(
+                'Unknown mean function type {}.'.format(mean_type)
+            )
+
+    def __call__(self, X):
+        if self.mean_type == 'constant':
+            return np.ones((len(X), 1)) * self.c
+        if self.mean_type == 'linear':
+            return X.dot(self.A) + self.b
+        return np.zeros((len(X), 1))
+
+
+class SVGP:
+    """posterior of a fitted SVGP model, with a single latent function
+
+    The Cholesky factor `Lm` of Kmm, posterior weights `alpha` and variance
+    factor `B` are computed once, as in `gp_model.PartialSVGP`, so that the
+    posterior mean is `Knm alpha` and the posterior covariance is
+    `Knn - Knm Kmm^-1 Kmn + Knm B B^T Kmn`.
+    """
+
+    def __init__(self, kern, Z, q_mu, q_sqrt, mean_function=None, whiten=True,
+                 jitter=JITTER):
+        self.kern = kern
+        self.Z = Z
+        self.mean_function = mean_function or MeanFunction('zero')
+
+        Kmm = kern.K(Z) + np.eye(len(Z)) * jitter
+        self.Lm = cholesky(Kmm, lower=True)
+
+        alpha = q_mu
+        B = np.tril(q_sqrt[0])
+        if not whiten:
+            alpha = solve_triangular(self.Lm, alpha, lower=True)
+            B = solve_triangular(self.Lm, B, lower=True)
+        self.alpha = solve_triangular(self.Lm.T, alpha, lower=False)
+        self.B = solve_triangular(self.Lm.T, B, lower=False)
+
+    def predict_f(self, Xnew, full_cov=False):
+        """posterior mean and (co)variance of the latent function"""
+        Kmn = self.kern.K(self.Z, Xnew)
+        fmean = Kmn.T.dot(self.alpha) + self.mean_function(Xnew)
+
+        A = solve_triangular(self.Lm, Kmn, lower=True)
+        BTKmn = self.B.T.dot(Kmn)
+        if full_cov:
+            fvar = self.kern.K(Xnew) - A.T.dot(A) + BTKmn.T.dot(BTKmn)
+        else:
+            fvar = (
+                self.kern.Kdiag(Xnew) - np.sum(A ** 2, axis=0)
+                + np.sum(BTKmn ** 2, axis=0)
+            )[:, np.newaxis]
+
+        return fmean, fvar
+
+    def predict_f_partial(self, Xnew):
+        """posterior means of each component of an additive kernel"""
+        return [
+            kern.K(self.Z, Xnew).T.dot(self.alpha)
+            for kern in self.kern.kernels
+        ]
+
+    def predict_f_samples(self, Xnew, num_samples, jitter=JITTER,
+                          rng=np.random):
+        """joint samples of the latent function, with shape [S, N, 1]"""
+        fmean, fvar = self.predict_f(Xnew, full_cov=True)
+        L = cholesky(fvar + np.eye(len(Xnew)) * jitter, lower=True)
+        V = rng.randn(len(Xnew), num_samples)
+        samples = fmean + L.dot(V)
+        return samples.T[:, :, np.newaxis]
+
+    def project_stim(self, Xnew):
+        """stimulus projected on the filters of the first projected kernel"""
+        kernel_stack = [self.kern]
+        while kernel_stack:
+            kernel = kernel_stack.pop(0)
+            if isinstance(kernel, ProjKernel):
+                return kernel.project(Xnew)
+            if isinstance(kernel, Combination):
+                kernel_stack.extend(kernel.kernels)
+        raise ValueError('No projected kernel in the model.')
+
+
+def load_model(model_dir, model_params=None):
+    """load a fitted model, see gp_model.load_model
+
+    Parameters of models with variational posteriors on kernel
+    hyperparameters need to be converted first, see gp_convert.py.
+    """
+    model_path = Path(model_dir)
+    options_file = np.load(
+        str(model_path / 'model_options.npz'), allow_pickle=True
+    )
+    model_opts = {
+        key: value.item() if value.ndim == 0 else value
+        for key, value in options_file.items()
+    }
+    if model_params is None:
+        model_params = dict(np.load(str(model_path / 'model_params_best.npz')))
+
+    n_lags = int(model_opts.pop('n_lags'))
+    max_nt = int(model_opts.pop('max_nt'))
+    for key in ('n_z', 'batch_size', 'hazard', 'sigma', 'n_tanh'):
+        model_opts.pop(key, None)
+    mean_type = str(model_opts.pop('mean_type', 'zero'))
+
+    # parameters paths start with the name of the gpflow model class
+    prefix = next(
+        key[:-len('feature/Z')] for key in model_params
+        if key.endswith('feature/Z')
+    )
+
+    kernel = build_combined_kernel(n_lags=n_lags, **model_opts)
+    kernel.load(model_params, prefix + 'kern')
+    mean_func = MeanFunction(mean_type, model_params, prefix + 'mean_function')
+
+    Z, q_mu, q_sqrt = (
+        model_params[prefix + name] for name in ('feature/Z', 'q_mu', 'q_sqrt')
+    )
+    model = SVGP(kernel, Z, q_mu, q_sqrt, mean_func)
+    model.n_lags = n_lags
+    model.max_nt = max_nt
+
+    return model
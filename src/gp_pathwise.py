@@ -0,0 +1,204 @@
+import numpy as np
+import tensorflow as tf
+import gpflow
+
+# Matern kernels smoothness, their spectral density being a Student-t
+MATERN_NU = {
+    gpflow.kernels.Matern12: 0.5,
+    gpflow.kernels.Matern32: 1.5,
+    gpflow.kernels.Matern52: 2.5
+}
+
+
+# kernels with random features, combined kernels being supported if all their
+# sub-kernels are
+BASE_KERNELS = (
+    gpflow.kernels.RBF, gpflow.kernels.Linear, gpflow.kernels.Constant,
+    gpflow.kernels.White
+) + tuple(MATERN_NU)
+
+
+def unsupported_kernels(kernel):
+    """names of kernels without random features in a combination of kernels
+
+    The kernel tree is walked as in `build_feature_map`, without building any
+    graph, so that unsupported models can be rejected early.
+    """
+    if isinstance(kernel, BASE_KERNELS):
+        return []
+    if isinstance(kernel, gpflow.kernels.Sum) or \
+            hasattr(kernel, 'indicator_dims'):
+        children = kernel.kernels
+    elif hasattr(kernel, '_project') or hasattr(kernel, '_warp'):
+        children = [kernel.base_kernel]
+    else:
+        return [type(kernel).__name__]
+    return [name for child in children for name in unsupported_kernels(child)]
+
+
+def _stationary_features(kernel, n_features):
+    """random Fourier features of a RBF or Matern kernel"""
+
+    float_type = gpflow.settings.float_type
+
+    # frequencies are drawn once, to be shared by all inputs
+    freqs = tf.random_normal([kernel.input_dim, n_features], dtype=float_type)
+    nu = MATERN_NU.get(type(kernel))
+    if nu is not None:
+        gammas = tf.random_gamma([n_features], nu, beta=nu, dtype=float_type)
+        freqs /= tf.sqrt(gammas)
+    phases = tf.random_uniform(
+        [n_features], maxval=2 * np.pi, dtype=float_type
+    )
+    scale = tf.sqrt(2 / tf.cast(n_features, float_type))
+
+    def feature_fn(X):
+        with gpflow.params_as_tensors_for(kernel):
+            X, _ = kernel._slice(X, None)
+            X_scaled = X / kernel.lengthscales
+            return (
+                scale * tf.sqrt(kernel.variance)
+                * tf.cos(tf.matmul(X_scaled, freqs) + phases)
+            )
+
+    return feature_fn
+
+
+def _hierarchical_features(kernel, inputs, n_features):
+    """features of a hierarchical kernel, one set per group for sub-kernels"""
+
+    float_type = gpflow.settings.float_type
+    parent_fn, noise_variance = build_feature_map(
+        kernel.kernels[0], inputs, n_features
+    )
+
+    child_fns = []
+    for ind_dim, child in zip(kernel.indicator_dims, kernel.kernels[1:]):
+        child_fn, child_noise = build_feature_map(child, inputs, n_features)
+        noise_variance += child_noise
+
+        # groups found in all inputs, sub-kernel features being set to zero
+        # outside of their group
+        groups, _ = tf.unique(
+            tf.concat([X[:, ind_dim] for X in inputs], axis=0)
+        )
+        child_fns.append((child_fn, ind_dim, groups))
+
+    def feature_fn(X):
+        features = [parent_fn(X)]
+        for child_fn, ind_dim, groups in child_fns:
+            onehot = tf.cast(
+                tf.equal(X[:, ind_dim:ind_dim + 1], groups), float_type
+            )
+            child_features = onehot[:, :, None] * child_fn(X)[:, None, :]
+            features.append(
+                tf.reshape(child_features, [tf.shape(X)[0], -1])
+            )
+        return tf.concat(features, axis=1)
+
+    return feature_fn, noise_variance
+
+
+def build_feature_map(kernel, inputs, n_features):
+    """random feature map approximating a kernel, and its white noise variance
+
+    The kernel is approximated as `k(x, y) = phi(x) phi(y)^T + s2 * (x == y)`,
+    where `phi` is the returned feature function and `s2` the white noise
+    variance. Stationary kernels use `n_features` random Fourier features.
+    `inputs` lists all tensors the feature function will be applied to, used
+    to find groups in hierarchical kernels.
+
+    Supported kernels are RBF, Matern12, Matern32, Matern52, Linear, Constant
+    and White kernels, and their sums, hierarchical combinations and
+    projected, warped or log-transformed versions. Products and other kernels
+    are not supported (see `unsupported_kernels`).
+    """
+
+    float_type = gpflow.settings.float_type
+
+    if isinstance(kernel, gpflow.kernels.Sum):
+        feature_maps = [
+            build_feature_map(k, inputs, n_features) for k in kernel.kernels
+        ]
+
+        def feature_fn(X):
+            return tf.concat([fn(X) for fn, _ in feature_maps], axis=1)
+
+        return feature_fn, sum(noise for _, noise in feature_maps)
+
+    # hierarchical kernels, see gp_model.Hierarchical
+    if hasattr(kernel, 'indicator_dims'):
+        return _hierarchical_features(kernel, inputs, n_features)
+
+    # kernels transforming their inputs before a base kernel, see
+    # gp_model.ProjKernel and gp_model.WarpedKernel for example
+    if hasattr(kernel, '_project'):
+        transform = kernel._project
+    elif hasattr(kernel, '_warp'):
+        transform = kernel._warp
+    else:
+        transform = None
+
+    if transform is not None:
+        def transform_fn(X):
+            with gpflow.params_as_tensors_for(kernel):
+                X, _ = transform(X, None)
+            return X
+
+        base_fn, noise_variance = build_feature_map(
+            kernel.base_kernel, [transform_fn(X) for X in inputs], n_features
+        )
+        return (lambda X: base_fn(transform_fn(X))), noise_variance
+
+    if isinstance(kernel, (gpflow.kernels.RBF, ) + tuple(MATERN_NU)):
+        return _stationary_features(kernel, n_features), 0
+
+    if isinstance(kernel, gpflow.kernels.Linear):
+        def feature_fn(X):
+            with gpflow.params_as_tensors_for(kernel):
+                X, _ = kernel._slice(X, None)
+                return X * tf.sqrt(kernel.variance)
+        return feature_fn, 0
+
+    if isinstance(kernel, gpflow.kernels.Constant):
+        def feature_fn(X):
+            with gpflow.params_as_tensors_for(kernel):
+                ones = tf.ones([tf.shape(X)[0], 1], dtype=float_type)
+                return ones * tf.sqrt(kernel.variance)
+        return feature_fn, 0
+
+    if isinstance(kernel, gpflow.kernels.White):
+        def feature_fn(X):
+            return tf.zeros([tf.shape(X)[0], 0], dtype=float_type)
+        with gpflow.params_as_tensors_for(kernel):
+            return feature_fn, kernel.variance
+
+    raise NotImplementedError(
+        'Random features not implemented for {} kernels.'
+        .format(type(kernel).__name__)
+    )
+
+
+def sample_prior(kernel, inputs, num_samples, n_features):
+    """jointly sample GP prior functions at several inputs
+
+    Prior samples are approximated with random features, so their cost is
+    linear in the number of rows of the inputs.
+    """
+    float_type = gpflow.settings.float_type
+
+    feature_fn, noise_variance = build_feature_map(kernel, inputs, n_features)
+    features = [feature_fn(X) for X in inputs]
+
+    weights = tf.random_normal(
+        [tf.shape(features[0])[1], num_samples], dtype=float_type
+    )
+    noise_std = tf.sqrt(tf.cast(noise_variance, float_type))
+
+    samples = []
+    for X_features in features:
+        noise = tf.random_normal(
+            [tf.shape(X_features)[0], num_samples], dtype=float_type
+        )
+        samples.append(tf.matmul(X_features, weights) + noise_std * noise)
+    return samples
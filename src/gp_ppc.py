@@ -5,90 +5,504 @@ from itertools import product
 
 import defopt
 import numpy as np
-import pandas as pd
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pyplot as plt
-import seaborn as sb
 
 from strenum import strenum
+from trial_store import Ragged, PredictionLoader
+from rt_density import (
+    kde_curves, cdf_curves, expected_kde_curves, expected_cdf_curves
+)
 
 
-def sample_rt(dset, n_samples):
-    """sample reaction-time for each trial using predicted log-PMF"""
-    n_trials = len(dset)
+# sampled reaction-time of trials without lick
+NO_LICK = -1
 
-    rt = np.empty((n_trials, n_samples))
-    for i, (_, row) in enumerate(dset.iterrows()):
-        pmf = np.exp(row.log_pmf)
-        rt[i, :] = np.argmax(np.random.multinomial(1, pmf, n_samples), -1)
-        rt[i, rt[i, :] == len(pmf) - 1] = np.nan
+# trial metadata read from predictions
+PPC_COLUMNS = ['sig', 'mouse', 'hazard', 'change', 'rt', 'rt_change']
+
+
+def sample_rt(dset, n_samples, rng=np.random):
+    """sample reaction-time for each trial using predicted log-PMF
+
+    Cumulative PMFs of all trials are stacked in one buffer, shifted by their
+    trial index to be sorted, so that inverse-CDF samples of all trials are
+    drawn with a single search. The last PMF entry, the no-lick probability,
+    takes the remaining probability mass. Returns an integer array of time
+    steps, `NO_LICK` marking samples without lick.
+    """
+    log_pmf = dset['log_pmf']
+    if not isinstance(log_pmf, Ragged):
+        log_pmf = Ragged.from_arrays(log_pmf, dtype=float)
+    n_trials = len(log_pmf)
+    starts, ends = log_pmf.offsets[:-1], log_pmf.offsets[1:]
+
+    # cumulative PMFs of each trial, ending exactly at 1
+    cdf = np.cumsum(np.exp(log_pmf.values))
+    cdf -= np.repeat(cdf[starts] - np.exp(log_pmf.values[starts]),
+                     log_pmf.lengths)
+    cdf[ends - 1] = 1
+    np.minimum(cdf, 1, out=cdf)
+    cdf += np.repeat(np.arange(n_trials), log_pmf.lengths)
+
+    # one uniform draw per trial and sample, shifted like the CDFs
+    u = rng.random_sample((n_trials, n_samples))
+    u += np.arange(n_trials)[:, np.newaxis]
+    idx = np.searchsorted(cdf, u, side='right')
+    np.minimum(idx, ends[:, np.newaxis] - 1, out=idx)
+
+    rt = idx - starts[:, np.newaxis]
+    rt[idx == ends[:, np.newaxis] - 1] = NO_LICK
 
     return rt
 
 
-def load_data(pred_filename, n_samples, folds):
-    """load predictions dataset and draw predictive samples"""
+class TrialGroups:
+    """change time and categorical metadata of predicted trials
+
+    The stimulus, mouse and hazard block of each trial are stored as codes of
+    their categories, used to group trials in reductions.
+    """
+
+    columns = ('sig', 'mouse', 'hazard')
+
+    def __init__(self, change, codes, categories):
+        self.change = change
+        self._codes = codes
+        self._categories = categories
+
+    @classmethod
+    def _metadata(cls, dset):
+        """change time, codes and categories of dataset trials"""
+        codes, categories = {}, {}
+        for name in cls.columns:
+            categories[name], codes[name] = np.unique(
+                np.asarray(dset[name]), return_inverse=True
+            )
+        change = np.asarray(dset['change']).astype(np.int16)
+        return change, codes, categories
+
+    @property
+    def n_trials(self):
+        return len(self.change)
+
+    def __len__(self):
+        return self.n_trials
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.columns:
+            raise AttributeError(name)
+        return self._categories[name][self._codes[name]]
+
+    def __getitem__(self, idx):
+        return self.take(idx)
+
+    def _take_metadata(self, idx):
+        codes = {name: codes[idx] for name, codes in self._codes.items()}
+        return self.change[idx], codes, self._categories
+
+    def _grouping(self, by):
+        """trial codes and group levels, a single group if `by` is None"""
+        if by is None:
+            return np.zeros(self.n_trials, dtype=int), np.array([None])
+        return self._codes[by], self._categories[by]
+
+
+class PredictiveSamples(TrialGroups):
+    """posterior predictive reaction-times, as a trials x samples matrix
+
+    Sampled reaction-times are stored as int16 time steps (`NO_LICK` for
+    samples without lick), along with the metadata of each trial. Outcomes are
+    derived on demand as trials x samples boolean matrices and per-sample
+    summaries are computed with grouped reductions, without expanding to a
+    long table.
+    """
+
+    def __init__(self, rt, change, codes, categories):
+        super().__init__(change, codes, categories)
+        self.rt = rt
+
+    @classmethod
+    def from_dataset(cls, dset, rt):
+        """store samples from `sample_rt`, with metadata of dataset trials"""
+        return cls(rt.astype(np.int16), *cls._metadata(dset))
+
+    @property
+    def n_samples(self):
+        return self.rt.shape[1]
+
+    def take(self, idx):
+        """select trials given a boolean mask or indices, as a new store"""
+        idx = np.asarray(idx)
+        return PredictiveSamples(self.rt[idx], *self._take_metadata(idx))
+
+    @property
+    def miss(self):
+        return self.rt == NO_LICK
+
+    @property
+    def early(self):
+        return (self.rt != NO_LICK) & (self.rt <= self.change[:, np.newaxis])
+
+    @property
+    def hit(self):
+        return self.rt > self.change[:, np.newaxis]
+
+    @property
+    def rt_change(self):
+        return self.rt - self.change[:, np.newaxis]
+
+    def sample_values(self, values, where):
+        """selected entries of a trials x samples array, for each sample"""
+        return [
+            sample_values[sample_where]
+            for sample_values, sample_where in zip(values.T, where.T)
+        ]
+
+    def _group_keys(self, by, where):
+        """group x sample keys of selected entries, sorted by key"""
+        if where is None:
+            where = np.ones(self.rt.shape, dtype=bool)
+        codes, categories = self._grouping(by)
+        trials, samples = np.nonzero(where)
+        keys = codes[trials] * self.n_samples + samples
+        n_keys = len(categories) * self.n_samples
+        return keys, n_keys, (trials, samples)
+
+    def _group_result(self, by, result, counts):
+        """reshape grouped results, dropping groups without any entry"""
+        result = result.reshape(-1, self.n_samples)
+        valid = counts.reshape(-1, self.n_samples).sum(axis=1) > 0
+        return self._grouping(by)[1][valid], result[valid]
+
+    def group_mean(self, by, values, where=None):
+        """mean of selected entries, per group of trials and per sample
+
+        Returns the group levels and a levels x samples array of means, NaN
+        denoting samples without entry in a group.
+        """
+        keys, n_keys, entries = self._group_keys(by, where)
+        counts = np.bincount(keys, minlength=n_keys)
+        sums = np.bincount(
+            keys, weights=values[entries].astype(float), minlength=n_keys
+        )
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / counts
+        return self._group_result(by, means, counts)
+
+    def group_median(self, by, values, where=None):
+        """median of selected entries, per group of trials and per sample
+
+        Returns the group levels and a levels x samples array of medians, NaN
+        denoting samples without entry in a group.
+        """
+        keys, n_keys, entries = self._group_keys(by, where)
+        values = values[entries]
+        order = np.lexsort((values, keys))
+        values = values[order].astype(float)
+
+        counts = np.bincount(keys, minlength=n_keys)
+        starts = np.cumsum(counts) - counts
+        low = np.minimum(starts + (counts - 1) // 2, len(values) - 1)
+        high = np.minimum(starts + counts // 2, len(values) - 1)
+
+        medians = np.full(n_keys, np.nan)
+        nonempty = counts > 0
+        medians[nonempty] = (
+            values[low[nonempty]] + values[high[nonempty]]
+        ) / 2
+        return self._group_result(by, medians, counts)
+
+
+class PredictiveDistribution(TrialGroups):
+    """posterior predictive distribution of reaction-times, from log-PMFs
+
+    Lick probabilities of each trial and time step are stored as a ragged
+    array, along with the no-lick probability and the metadata of each trial.
+    Expected outcome proportions, reaction-time distributions and their
+    summaries are computed exactly by summing PMFs of trials within groups,
+    without drawing samples. Standard deviations of these statistics over
+    datasets of the same trials are given for plotting uncertainty.
+    """
+
+    def __init__(self, lick_pmf, change, codes, categories):
+        super().__init__(change, codes, categories)
+        self.lick_pmf = lick_pmf
+
+    @classmethod
+    def from_dataset(cls, dset):
+        """store PMFs and metadata of dataset trials"""
+        log_pmf = dset['log_pmf']
+        if not isinstance(log_pmf, Ragged):
+            log_pmf = Ragged.from_arrays(log_pmf, dtype=float)
+
+        # drop no-lick entries, the last of each trial
+        keep = np.ones(len(log_pmf.values), dtype=bool)
+        keep[log_pmf.offsets[1:] - 1] = False
+        offsets = log_pmf.offsets - np.arange(len(log_pmf) + 1)
+        lick_pmf = Ragged(np.exp(log_pmf.values[keep]), offsets)
+
+        return cls(lick_pmf, *cls._metadata(dset))
+
+    def take(self, idx):
+        """select trials given a boolean mask or indices, as a new store"""
+        idx = np.asarray(idx)
+        return PredictiveDistribution(
+            self.lick_pmf.take(idx), *self._take_metadata(idx)
+        )
+
+    def _entries(self, event):
+        """trial, time step and probability of lick entries of an event"""
+        lengths = self.lick_pmf.lengths
+        trials = np.repeat(np.arange(self.n_trials), lengths)
+        times = (
+            np.arange(len(self.lick_pmf.values))
+            - np.repeat(self.lick_pmf.offsets[:-1], lengths)
+        )
+        probs = self.lick_pmf.values
+
+        if event == 'early':
+            mask = times <= self.change[trials]
+        elif event == 'hit':
+            mask = times > self.change[trials]
+        elif event == 'lick':
+            mask = slice(None)
+        else:
+            raise ValueError('Unknown event {}.'.format(event))
+
+        return trials[mask], times[mask], probs[mask]
+
+    def _probability(self, event):
+        trials, _, probs = self._entries(event)
+        probs = np.bincount(trials, weights=probs, minlength=self.n_trials)
+        return np.minimum(probs, 1)
+
+    @property
+    def early(self):
+        return self._probability('early')
+
+    @property
+    def hit(self):
+        return self._probability('hit')
+
+    @property
+    def miss(self):
+        return 1 - self._probability('lick')
+
+    def sample_proportions(self, probs, n_samples, rng=np.random):
+        """sample proportions of trials with an event, given its probabilities
+
+        Returns an array of `n_samples` proportions, i.e. draws of the
+        statistic only, without sampling reaction-times.
+        """
+        u = rng.random_sample((self.n_trials, n_samples))
+        return (u < probs[:, np.newaxis]).mean(axis=0)
+
+    def group_proportion(self, by, probs, given=None):
+        """expected proportion of trials with an event, per group of trials
+
+        `probs` and `given` are probabilities of each trial to have the event
+        and to have a conditioning event (all trials by default), the first
+        event implying the second. Proportions are estimated as ratios of
+        expected counts, and their standard deviations with the delta method.
+        Returns group levels, proportions and standard deviations.
+        """
+        codes, levels = self._grouping(by)
+        if given is None:
+            given = np.ones(self.n_trials)
+
+        def group_sum(weights):
+            return np.bincount(codes, weights=weights, minlength=len(levels))
+
+        counts = group_sum(probs)
+        totals = group_sum(given)
+        counts_var = group_sum(probs * (1 - probs))
+        totals_var = group_sum(given * (1 - given))
+        covariance = group_sum(probs * (1 - given))
+
+        valid = totals > 0
+        ratio = counts[valid] / totals[valid]
+        ratio_var = (
+            counts_var[valid] - 2 * ratio * covariance[valid]
+            + ratio ** 2 * totals_var[valid]
+        ) / totals[valid] ** 2
+
+        return levels[valid], ratio, np.sqrt(np.maximum(ratio_var, 0))
+
+    def group_rt_pmf(self, by, event, aligned=False):
+        """distribution of reaction-times given an event, per group of trials
+
+        Reaction-times are time steps, relative to the change if `aligned`.
+        Returns group levels, an array of time steps, a levels x times array
+        of probabilities and the expected number of events of each group,
+        dropping groups without any chance of the event.
+        """
+        codes, levels = self._grouping(by)
+        trials, times, probs = self._entries(event)
+        if aligned:
+            times = times - self.change[trials]
+
+        start = times.min() if len(times) > 0 else 0
+        n_times = times.max() - start + 1 if len(times) > 0 else 0
+        keys = codes[trials] * n_times + times - start
+        pmf = np.bincount(
+            keys, weights=probs, minlength=len(levels) * n_times
+        ).reshape(len(levels), n_times)
+
+        counts = pmf.sum(axis=1)
+        valid = counts > 0
+        pmf = pmf[valid] / counts[valid, np.newaxis]
+        return levels[valid], start + np.arange(n_times), pmf, counts[valid]
+
+    def group_rt_mean(self, by, event, aligned=False):
+        """expected mean reaction-time given an event, per group of trials
+
+        Returns group levels, means and their standard deviations over
+        datasets with the expected number of events.
+        """
+        levels, times, pmf, counts = self.group_rt_pmf(by, event, aligned)
+        means = pmf @ times
+        variances = np.maximum(pmf @ times ** 2 - means ** 2, 0)
+        return levels, means, np.sqrt(variances / counts)
+
+    def group_rt_median(self, by, event, aligned=False):
+        """median reaction-time given an event, per group of trials
+
+        Returns group levels, medians of the reaction-time distributions and
+        their asymptotic standard deviations over datasets with the expected
+        number of events.
+        """
+        levels, times, pmf, counts = self.group_rt_pmf(by, event, aligned)
+        idx = np.argmax(np.cumsum(pmf, axis=1) >= 0.5, axis=1)
+        density = pmf[np.arange(len(levels)), idx]
+        return levels, times[idx], 1 / (2 * density * np.sqrt(counts))
+
+
+def ppc_loader(folds, n_workers=4):
+    """loader of the log-PMF and trial metadata of predictions, on some folds
+
+    Loaded stores are then passed to `prepare_data`.
+    """
+    return PredictionLoader(
+        PPC_COLUMNS + ['log_pmf'], folds, n_workers=n_workers
+    )
 
-    dset = pd.read_pickle(pred_filename)
 
-    mask = False
-    for fold in folds:
-        mask |= dset[fold]
-    dset = dset[mask].copy()
+def prepare_data(store, n_samples, rng=np.random):
+    """dataset and predictive samples of loaded predictions
+
+    Returns the dataset and its predictive samples, as `PredictiveSamples`, or
+    its exact predictive distribution, as `PredictiveDistribution`, if
+    `n_samples` is None.
+    """
 
     # convert to base 2
     # TODO move to matlab code
-    dset['sig'] /= np.log(2)
+    store['sig'] = store['sig'] / np.log(2)
 
     # sample predicted reaction-time on test dataset
-    samples = sample_rt(dset, n_samples)
-
-    dset_base = dset[['sig', 'mouse', 'hazard', 'change']]
-    dset_pred = pd.concat([
-        pd.DataFrame({'rt': sample, 'sample_id': i, **dset_base})
-        for i, sample in enumerate(samples.T)
-    ])
-
-    dset_pred['rt_change'] = dset_pred['rt'] - dset_pred['change']
+    if n_samples is None:
+        dset_pred = PredictiveDistribution.from_dataset(store)
+    else:
+        dset_pred = PredictiveSamples.from_dataset(
+            store, sample_rt(store, n_samples, rng)
+        )
 
     # add early/correct/late columns to datasets
+    dset = store.to_dataframe(PPC_COLUMNS)
     dset['early'] = dset['rt'] <= dset['change']
     dset['hit'] = dset['rt'] > dset['change']
     dset['miss'] = np.isnan(dset['rt'])
 
-    dset_pred['early'] = dset_pred['rt'] <= dset_pred['change']
-    dset_pred['hit'] = dset_pred['rt'] > dset_pred['change']
-    dset_pred['miss'] = np.isnan(dset_pred['rt'])
-
     return dset, dset_pred
 
 
-def plot_licks(dset_test, dset_pred, lick_col, rt_col, axes, titles=True,
-               xlabels=True):
+def load_data(pred_filename, n_samples, folds, rng=np.random):
+    """load predictions dataset and draw predictive samples
+
+    Only the log-PMF and trial metadata are read, see `prepare_data` for the
+    returned values.
+    """
+    store = ppc_loader(folds).load([pred_filename])
+    return prepare_data(store, n_samples, rng)
+
+
+def plot_sampled_licks(dset_test, dset_pred, lick_col, rt_col, axes):
+    """plot lick statistics of each predictive sample"""
+    import seaborn as sb
 
     # lick proportion distribution
-    lick_pred = dset_pred.groupby('sample_id').agg({lick_col: np.mean})
+    licks = getattr(dset_pred, lick_col)
+    lick_pred = licks.mean(axis=0)
 
     sb.distplot(lick_pred, ax=axes[0])
     axes[0].axvline(dset_test[lick_col].mean(), color='k', lw=2)
 
-    # plot distribution for each predictive sample
-    for i in dset_pred.sample_id.unique():
-        df_pred = dset_pred[(dset_pred.sample_id == i) & dset_pred[lick_col]]
-        rt_pred = df_pred[rt_col]
+    # distributions of each predictive sample and of the dataset, estimated
+    # together on a common grid
+    rt_preds = dset_pred.sample_values(getattr(dset_pred, rt_col), licks)
+    rt_test = dset_test[dset_test[lick_col]][rt_col].values
+    rt_all = np.concatenate(rt_preds + [rt_test])
 
-        sb.kdeplot(rt_pred, cut=0, alpha=0.1, color='b', legend=False,
-                   ax=axes[1])
-        sb.kdeplot(rt_pred, cut=0, alpha=0.1, color='b', legend=False,
-                   ax=axes[2], cumulative=True)
+    if len(rt_all) > 0:
+        grid = np.arange(rt_all.min(), rt_all.max() + 1)
+        kde = kde_curves(rt_preds + [rt_test], grid, cut=0)
+        cdf = np.nancumsum(kde, axis=1)
+        cdf[np.isnan(kde)] = np.nan
 
-    # plot dataset distribution
-    df_test = dset_test[dset_test[lick_col]]
-    rt_test = df_test[rt_col]
+        axes[1].plot(grid, kde[:-1].T, alpha=0.1, color='b')
+        axes[2].plot(grid, cdf[:-1].T, alpha=0.1, color='b')
+        axes[1].plot(grid, kde[-1], color='k', lw=2)
+        axes[2].plot(grid, cdf[-1], color='k', lw=2)
 
-    sb.kdeplot(rt_test, cut=0, color='k', lw=2, legend=False, ax=axes[1])
-    sb.kdeplot(rt_test, cut=0, color='k', lw=2, legend=False, ax=axes[2],
-               cumulative=True)
+
+def plot_expected_licks(dset_test, dset_pred, lick_col, rt_col, axes):
+    """plot lick statistics of the exact predictive distribution
+
+    Predicted proportion and reaction-time curves are displayed with bands of
+    two standard deviations over datasets of the same trials.
+    """
+
+    # lick proportion distribution, as a Gaussian approximation
+    _, proportion, proportion_std = dset_pred.group_proportion(
+        None, getattr(dset_pred, lick_col)
+    )
+    if len(proportion) > 0 and proportion_std[0] > 0:
+        zs = np.linspace(-4, 4, 201)
+        axes[0].plot(
+            proportion[0] + zs * proportion_std[0],
+            np.exp(-zs ** 2 / 2) / (np.sqrt(2 * np.pi) * proportion_std[0])
+        )
+    axes[0].axvline(dset_test[lick_col].mean(), color='k', lw=2)
+
+    # expected reaction-time density and empirical CDF, and dataset ones
+    _, times, pmf, counts = dset_pred.group_rt_pmf(
+        None, lick_col, aligned=(rt_col == 'rt_change')
+    )
+    rt_test = dset_test[dset_test[lick_col]][rt_col].values
+    rt_all = np.concatenate([times, rt_test])
+
+    if len(rt_all) > 0:
+        grid = np.arange(rt_all.min(), rt_all.max() + 1)
+
+        if len(counts) > 0:
+            kde, kde_std = expected_kde_curves(pmf, times[0], grid, counts)
+            cdf, cdf_std = expected_cdf_curves(pmf, times[0], grid, counts)
+            for ax, curve, curve_std in zip(
+                    axes[1:], (kde[0], cdf[0]), (kde_std[0], cdf_std[0])):
+                ax.fill_between(grid, curve - 2 * curve_std,
+                                curve + 2 * curve_std, alpha=0.3, color='b')
+                ax.plot(grid, curve, color='b')
+
+        axes[1].plot(grid, kde_curves([rt_test], grid, cut=0)[0],
+                     color='k', lw=2)
+        axes[2].plot(grid, cdf_curves([rt_test], grid)[0], color='k', lw=2)
+
+
+def plot_licks(dset_test, dset_pred, lick_col, rt_col, axes, titles=True,
+               xlabels=True):
+    if isinstance(dset_pred, PredictiveDistribution):
+        plot_expected_licks(dset_test, dset_pred, lick_col, rt_col, axes)
+    else:
+        plot_sampled_licks(dset_test, dset_pred, lick_col, rt_col, axes)
 
     axes[0].grid()
     axes[1].grid()
@@ -107,6 +521,7 @@ def plot_licks(dset_test, dset_pred, lick_col, rt_col, axes, titles=True,
 
 
 def plot_early_licks(dset_test, dset_pred, fig_title=None):
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(1, 3, figsize=(16, 5))
     plot_licks(dset_test, dset_pred, 'early', 'rt', axes)
     if fig_title:
@@ -118,6 +533,7 @@ def plot_early_licks(dset_test, dset_pred, fig_title=None):
 
 
 def plot_hit_licks(dset_test, dset_pred, fig_title=None):
+    import matplotlib.pyplot as plt
     sigs = sorted(dset_test.sig.unique())
     n_sigs = len(sigs)
 
@@ -142,16 +558,29 @@ def plot_hit_licks(dset_test, dset_pred, fig_title=None):
     return fig
 
 
+def plot_band(ax, xs, ys, ys_std, color='b'):
+    """plot a predicted curve with a band of two standard deviations"""
+    ax.fill_between(xs, ys - 2 * ys_std, ys + 2 * ys_std, alpha=0.3, lw=0,
+                    color=color)
+    ax.plot(xs, ys, color=color)
+
+
 def plot_psycho_chrono(dset_test, dset_pred, fig_title=None):
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(1, 3, sharex=True, figsize=(12, 4))
 
+    analytic = isinstance(dset_pred, PredictiveDistribution)
+
     # early licks proportions
-    earlylicks_pred = (
-        dset_pred.groupby(['sig', 'sample_id']).agg({'early': 'mean'})
-    )
     earlylicks_test = dset_test.groupby('sig').agg({'early': 'mean'})
+    if analytic:
+        plot_band(
+            axes[0], *dset_pred.group_proportion('sig', dset_pred.early)
+        )
+    else:
+        sigs, earlylicks_pred = dset_pred.group_mean('sig', dset_pred.early)
+        axes[0].plot(sigs, earlylicks_pred, 'b', alpha=0.1)
 
-    axes[0].plot(earlylicks_pred.unstack(), 'b', alpha=0.1)
     axes[0].plot(earlylicks_test, '-ok', lw=2)
     axes[0].grid()
     axes[0].set_xlabel('change magnitude (octaves)')
@@ -160,16 +589,20 @@ def plot_psycho_chrono(dset_test, dset_pred, fig_title=None):
     axes[0].set_ylim([0, 1])
 
     # psychometric curve, i.e. hit / (hit + miss)
-    hitlicks_pred = (
-        dset_pred[~dset_pred['early']]
-        .groupby(['sig', 'sample_id']).agg({'hit': 'mean'})
-    )
     hitlicks_test = (
         dset_test[~dset_test['early']]
         .groupby('sig').agg({'hit': 'mean'})
     )
+    if analytic:
+        plot_band(axes[1], *dset_pred.group_proportion(
+            'sig', dset_pred.hit, 1 - dset_pred.early
+        ))
+    else:
+        sigs, hitlicks_pred = dset_pred.group_mean(
+            'sig', dset_pred.hit, ~dset_pred.early
+        )
+        axes[1].plot(sigs, hitlicks_pred, 'b', alpha=0.1)
 
-    axes[1].plot(hitlicks_pred.unstack(), 'b', alpha=0.1)
     axes[1].plot(hitlicks_test, '-ok', lw=2)
     axes[1].grid()
     axes[1].set_xlabel('change magnitude (octaves)')
@@ -179,16 +612,23 @@ def plot_psycho_chrono(dset_test, dset_pred, fig_title=None):
 
     # chronometric curve
     period = 0.05
-    hitrt_pred = period * (
-        dset_pred[dset_pred['hit'] & (dset_pred['sig'] > 0)]
-        .groupby(['sig', 'sample_id']).agg({'rt_change': 'mean'})
-    )
     hitrt_test = period * (
         dset_test[dset_test['hit'] & (dset_test['sig'] > 0)]
         .groupby('sig').agg({'rt_change': 'mean'})
     )
+    if analytic:
+        sigs, hitrt_pred, hitrt_std = (
+            dset_pred[dset_pred.sig > 0]
+            .group_rt_mean('sig', 'hit', aligned=True)
+        )
+        plot_band(axes[2], sigs, period * hitrt_pred, period * hitrt_std)
+    else:
+        sigs, hitrt_pred = dset_pred.group_mean(
+            'sig', dset_pred.rt_change,
+            dset_pred.hit & (dset_pred.sig > 0)[:, np.newaxis]
+        )
+        axes[2].plot(sigs, period * hitrt_pred, 'b', alpha=0.1)
 
-    axes[2].plot(hitrt_pred.unstack(), 'b', alpha=0.1)
     axes[2].plot(hitrt_test, '-ok', lw=2)
     axes[2].grid()
     axes[2].set_xlabel('change magnitude (octaves)')
@@ -206,23 +646,32 @@ def plot_psycho_chrono(dset_test, dset_pred, fig_title=None):
 Fold = strenum('Fold', 'train val test')
 
 
-def main(pred_filename, figure_dir, *, folds=('test',), n_samples=100):
+def main(pred_filename, figure_dir, *, folds=('test',), n_samples=100,
+         seed=12345, analytic=False):
     """Sample the predictive posterior distribution and plot results
 
-    :param str pred_filename: Pandas dataset file (.pickle format) with
-                              predicted log-PMF
+    :param str pred_filename: predictions folder (or Pandas dataset file in
+                              .pickle format) with predicted log-PMF
     :param str figure_dir: directory for generated figures
     :param list[Fold] folds: data folds to use
     :param int n_samples: number of samples
+    :param int seed: random seed for predictive samples
+    :param bool analytic: use the exact predictive distribution of each trial
+                          instead of sampling reaction-times
 
     """
+    from matplotlib.backends.backend_pdf import PdfPages
+    import matplotlib.pyplot as plt
 
     # create output directory
     figure_path = Path(figure_dir)
     figure_path.mkdir(parents=True, exist_ok=True)
 
     # load dataset (and draw predictive samples)
-    dset, dset_pred = load_data(pred_filename, n_samples, folds)
+    rng = np.random.RandomState(seed)
+    if analytic:
+        n_samples = None
+    dset, dset_pred = load_data(pred_filename, n_samples, folds, rng)
 
     # early and hit licks distribution, psycho/chonometric curves
     with PdfPages(str(figure_path / 'early_licks.pdf')) as pdf_early, \
@@ -4,42 +4,88 @@ from pathlib import Path
 
 import defopt
 import numpy as np
-import pandas as pd
-import gpflow.kernels
-
-from gp_model import build_model, prepare_X, predict_logpmf, extract_filters
-
-def make_predictions(model, model_opts, model_params, dset, nsamples=200):
-    # generate expected logit-hazard rate
-    Xs = prepare_X(dset, model.n_lags, model.max_nt)
-    dset['logit_hazard'] = [model.predict_f(X)[0] for X in Xs]
+import gpflow
+
+from strenum import strenum
+from gp_model import (
+    load_model, predict_trials, extract_filters, precision_settings,
+    read_params, fit_precision, Precision
+)
+from gp_pathwise import unsupported_kernels
+from trial_store import Ragged, read_dataset
+
+def make_predictions(model, model_opts, dset, nsamples=200,
+                     sampling='cholesky', nfeatures=256,
+                     outputs=('mean', 'components', 'projection')):
+    # select outputs, all computed in a single pass over the data
+    fused_outputs = []
+    if 'mean' in outputs:
+        fused_outputs.append('mean')
 
     # add filtered signal if projected kernel
-    if 'proj' in model_opts['kernels_input']:
-        W = next(v for (k, v) in model_params.items() if k.endswith('/W'))
-        Xs_proj = [X[:, :-3].dot(W) for X in Xs]
-        dset['projected_stim'] = Xs_proj
+    if 'projection' in outputs and 'proj' in model_opts['kernels_input']:
+        fused_outputs.append('projected_stim')
 
     # decompose prediction if additive kernel
-    if isinstance(model.kern, gpflow.kernels.Sum):
-        logit_hazard = zip(*[model.predict_f_partial(X) for X in Xs])
-        for hazard, k_input in zip(logit_hazard, model_opts['kernels_input']):
-            dset['logit_hazard_{}'.format(k_input)] = hazard
+    if 'components' in outputs and isinstance(model.kern, gpflow.kernels.Sum):
+        fused_outputs.append('components')
 
     # sample predictive distribution
     if nsamples is not None:
-        dset['log_pmf'] = predict_logpmf(model, dset, nsamples)
+        fused_outputs.append('log_pmf')
+
+    predictions = predict_trials(
+        model, dset, fused_outputs, nsamples, method=sampling,
+        n_features=nfeatures
+    )
+
+    if 'mean' in predictions:
+        dset['logit_hazard'] = predictions['mean']
+
+    if 'projected_stim' in predictions:
+        dset['projected_stim'] = predictions['projected_stim']
+
+    if 'components' in predictions:
+        logit_hazard = zip(*predictions['components'])
+        for hazard, k_input in zip(logit_hazard, model_opts['kernels_input']):
+            dset['logit_hazard_{}'.format(k_input)] = list(hazard)
+
+    if 'log_pmf' in predictions:
+        dset['log_pmf'] = predictions['log_pmf']
 
     return dset
 
-def main(result_dir, pred_filename, *, nsamples=None, zero_filter=None):
+Sampling = strenum('Sampling', 'cholesky inducing pathwise')
+Output = strenum('Output', 'mean components projection')
+
+
+def main(result_dir, pred_filename, *, nsamples=None, zero_filter=None,
+         precision=None, sampling=Sampling.cholesky, nfeatures=256,
+         outputs=tuple(Output), hazard_precision=Precision.float64):
     """Generate predictions from a fitted GP model for experimental data
 
     :param str result_dir: directory of the fitted Gaussian process
-    :param str pred_filename: output Pandas dataset file (.pickle format)
+    :param str pred_filename: output predictions folder, read column by column
+                              with `trial_store.read_predictions`, or Pandas
+                              dataset file if ending with .pickle
     :param int nsamples: number of samples to estimate posterior lick
                          probability, not computed by default
     :param int zero_filter: make predictions with one of the filters set to 0
+    :param Precision precision: floating point precision of the model
+                                (default: same as for fitting, double
+                                precision if unknown)
+    :param Sampling sampling: method to sample hazard functions, from the full
+                              covariance of each trial or through inducing
+                              variables, with a pathwise correction or not
+                              (pathwise: no product kernels, see
+                              `gp_pathwise.build_feature_map`)
+    :param int nfeatures: number of random features per kernel for pathwise
+                          sampling
+    :param list[Output] outputs: posterior mean predictions to generate, i.e.
+                                 total logit-hazard, its additive components
+                                 and the projected stimulus
+    :param Precision hazard_precision: floating point precision used to store
+                                       logit-hazard predictions
     """
 
     # fix seed for reproducibility
@@ -48,21 +94,48 @@ def main(result_dir, pred_filename, *, nsamples=None, zero_filter=None):
 
     # load dataset and model
     result_path = Path(result_dir)
-    dset = pd.read_pickle(result_path / 'dataset.pickle')
-
-    model_opts = np.load(result_path / 'model_options.npz')
-    model = build_model(dset[dset.train], fast_init=True, **model_opts)
-    model_params = dict(np.load(result_path / 'model_params_best.npz'))
-
-    if zero_filter is not None:
-        _, filters_idx, _ = extract_filters(model_params)
-        model_params['PartialSVGP/kern/kernels/0/W'][:, filters_idx[zero_filter]] = 0
-
-    model.assign(model_params)
-
-    dset = make_predictions(model, model_opts, model_params, dset, nsamples)
-    # save predictions
-    dset.to_pickle(pred_filename)
+    dset = read_dataset(result_path)
+
+    if precision is None:
+        precision = fit_precision(result_path)
+
+    with gpflow.settings.temp_settings(precision_settings(precision)):
+        model_opts = np.load(result_path / 'model_options.npz')
+        model_params = read_params(result_path / 'model_params_best.npz')
+
+        if zero_filter is not None:
+            _, filters_idx, _ = extract_filters(model_params)
+            filters = model_params['PartialSVGP/kern/kernels/0/W']
+            filters[:, filters_idx[zero_filter]] = 0
+
+        model = load_model(result_path, model_params)
+
+        # reject kernels without random features before building any graph
+        if sampling == Sampling.pathwise:
+            unsupported = unsupported_kernels(model.kern)
+            if unsupported:
+                raise ValueError(
+                    'Pathwise sampling is not supported for {} kernels.'
+                    .format(', '.join(sorted(set(unsupported))))
+                )
+
+        dset = make_predictions(
+            model, model_opts, dset, nsamples, str(sampling), nfeatures,
+            [str(output) for output in outputs]
+        )
+
+    # save predictions, optionally with compact hazard arrays
+    for name in dset.columns:
+        if name.startswith('logit_hazard'):
+            column = dset[name]
+            dset[name] = Ragged(
+                column.values.astype(str(hazard_precision)), column.offsets
+            )
+
+    if pred_filename.endswith('.pickle'):
+        dset.to_dataframe().to_pickle(pred_filename)
+    else:
+        dset.save(pred_filename)
 
 
 if __name__ == "__main__":
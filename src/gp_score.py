@@ -4,11 +4,10 @@ import itertools as it
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sb
 import defopt
 
+from trial_store import Ragged, PredictionLoader
+
 
 def compress_method_names(methods):
     """remove starting and ending common sub-strings in methods names"""
@@ -30,16 +29,47 @@ def compress_method_names(methods):
     return [method[idx_start:idx_end] for method in methods]
 
 
+def observed_logprob(log_pmf, rt):
+    """predictive log-probability of observed reaction-times
+
+    Log-PMFs are gathered at the observed time step of each trial, or at the
+    last (no-lick) entry of trials without lick.
+    """
+    if not isinstance(log_pmf, Ragged):
+        log_pmf = Ragged.from_arrays(log_pmf, dtype=float)
+    rt = np.asarray(rt, dtype=float)
+    rows = np.where(np.isnan(rt), -1, np.nan_to_num(rt)).astype(int)
+    return log_pmf.gather(rows)
+
+
+def score_predictions(pred_filenames, methods, columns, n_workers=4):
+    """score prediction files, reading them concurrently
+
+    Only selected columns and the observed log-probability of each trial are
+    kept in memory, not the predicted log-PMFs.
+    """
+    loader = PredictionLoader(
+        columns, derived={'logprob': (observed_logprob, ['log_pmf', 'rt'])},
+        n_workers=n_workers
+    )
+    store = loader.load(pred_filenames)
+    scores = store.to_dataframe(list(columns) + ['logprob'])
+    scores.insert(0, 'method', np.asarray(methods)[store.codes('source')[0]])
+    return scores
+
+
 def main(figure_dir, *pred_filename, labels=None, for_paper=False):
     """Score GP model fit and plot results
 
     :param str figure_dir: directory for generated figures
-    :param str pred_filename: Pandas dataset file (.pickle format) with
-                              predicted log-PMF
+    :param str pred_filename: predictions folder (or Pandas dataset file in
+                              .pickle format) with predicted log-PMF
     :param list[str] labels: method name for each input dataset
     :param bool for_paper: use settings for the paper panel
 
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sb
 
     if labels and len(pred_filename) != len(labels):
         raise ValueError(
@@ -51,32 +81,21 @@ def main(figure_dir, *pred_filename, labels=None, for_paper=False):
     figure_path = Path(figure_dir)
     figure_path.mkdir(parents=True, exist_ok=True)
 
-    # load datasets
-    dsets = (pd.read_pickle(fname) for fname in pred_filename)
-
-    cols = ['sig', 'mouse', 'log_pmf', 'rt', 'train', 'test', 'val']
+    # load datasets and extract predictive log-likelihood at observation
+    # datapoint
+    cols = ['sig', 'mouse', 'rt', 'train', 'test', 'val']
     methods = labels if labels else compress_method_names(pred_filename)
-
-    dset = pd.concat([
-        pd.DataFrame(data={'method': method, **dset[cols]})
-        for method, dset in zip(methods, dsets)
-    ])
+    dset = score_predictions(pred_filename, methods, cols)
 
     # convert to base 2
     # TODO move to matlab code
     dset['sig'] /= np.log(2)
 
-    # extract predictive log-likelihood at observation datapoint
-    dset['logprob'] = dset.apply(
-        lambda x: x.log_pmf[-1 if np.isnan(x.rt) else int(x.rt)], axis=1
-    )
-
     dset['split'] = 'train'
     dset.loc[dset.val, 'split'] = 'valid.'
     dset.loc[dset.test, 'split'] = 'test'
 
     # save numerical results
-    dset = dset.drop('log_pmf', axis=1)
     dset.to_csv(figure_path / 'logprob.csv')
 
     # plot summary results
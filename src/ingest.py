@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from functools import partial
+from multiprocessing import get_context
+
+import numpy as np
+import scipy.io as io
+import pandas as pd
+
+from trial_store import TrialStore
+
+# rules used to clean datasets, part of the cache key of cleaned datasets
+CLEANING_RULES = {
+    'version': 2,
+    'min_trials_per_sig': 200,
+    'drop_noiseless': True,
+    'drop_outcomes': ['abort']
+}
+
+
+def _read_data(filename):
+    """read raw reaction time dataset"""
+    if not filename.endswith('.mat'):
+        return pd.read_pickle(filename)
+
+    # convert matlab data into dataframe
+    mat = io.loadmat(filename)
+    return pd.DataFrame({
+        'rt': mat['rt'].ravel() - 1,
+        'sig': mat['sig'].ravel(),
+        'sig_avg': mat['sig_avg'].ravel(),
+        'sig_std': mat['sig_std'].ravel(),
+        'session': mat['session'].ravel(),
+        'hazard': np.vstack(mat['hazard'].ravel()).ravel(),
+        'outcome': mat['outcome'].ravel(),
+        'noiseless': mat['noiseless'].ravel() != 0,
+        'ys': [y.ravel() for y in mat['ys'].flat],
+        'change': mat['change'].ravel() - 1
+    })
+
+
+def clean_data(dset, rules=CLEANING_RULES):
+    """remove rare stimuli, noiseless sessions and aborted trials"""
+
+    # add reaction-time from change point
+    # TODO move to matlab code
+    dset['rt_change'] = dset.rt - dset.change
+
+    # misc. cleaning, all masks being computed on the full dataset
+    # TODO move to matlab code
+    sig_counts = dset.sig.map(dset.sig.value_counts())
+    mask = sig_counts > rules['min_trials_per_sig']  # NaN counts are dropped
+    if rules['drop_noiseless']:
+        mask &= ~dset.noiseless
+    for outcome in rules['drop_outcomes']:
+        mask &= dset.outcome != outcome
+
+    return dset[mask.values]
+
+
+def _cache_key(filename, rules):
+    """hash of a dataset file content and of the cleaning rules"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(partial(fd.read, 1 << 20), b''):
+            digest.update(chunk)
+    digest.update(json.dumps(rules, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _cache_dataset(filename, cache_dir, rules):
+    """clean a dataset and save it in the cache, if not already there"""
+    cache_path = Path(cache_dir) / '{}-{}.trials'.format(
+        Path(filename).stem, _cache_key(filename, rules)[:16]
+    )
+    if not cache_path.exists():
+        dset = clean_data(_read_data(filename), rules)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        TrialStore.from_dataframe(dset).save(cache_path, overwrite=False)
+    return cache_path
+
+
+def _load_store(filename, cache_dir, rules):
+    """load and clean one dataset, going through the cache if any"""
+    if cache_dir is None:
+        dset = clean_data(_read_data(filename), rules)
+        return TrialStore.from_dataframe(dset)
+    return TrialStore.load(_cache_dataset(filename, cache_dir, rules))
+
+
+def load_data(filename, cache_dir=None, rules=CLEANING_RULES):
+    """load reaction time dataset
+
+    If a cache folder is given, the cleaned dataset is stored there, keyed on
+    the content of the file and the cleaning rules, and reused by later calls.
+    """
+    dset = _load_store(filename, cache_dir, rules).to_dataframe()
+
+    # add filename as mouse name
+    # TODO move to matlab code
+    dset['mouse'] = Path(filename).stem
+
+    return dset
+
+
+def load_datasets(filenames, cache_dir=None, n_workers=0,
+                  rules=CLEANING_RULES):
+    """load and concatenate datasets, parsing files in parallel processes"""
+
+    if n_workers <= 0:
+        n_workers = min(len(filenames), os.cpu_count() or 1)
+
+    load_store = partial(_load_store, cache_dir=cache_dir, rules=rules)
+    if n_workers <= 1:
+        stores = [load_store(filename) for filename in filenames]
+
+    # workers are spawned, as forking a process running TensorFlow can
+    # deadlock, and with a cache they only fill it, to avoid sending data back
+    elif cache_dir is not None:
+        cache_dataset = partial(_cache_dataset, cache_dir=cache_dir,
+                                rules=rules)
+        with get_context('spawn').Pool(n_workers) as pool:
+            cache_paths = pool.map(cache_dataset, filenames)
+        stores = [TrialStore.load(cache_path) for cache_path in cache_paths]
+
+    else:
+        with get_context('spawn').Pool(n_workers) as pool:
+            stores = pool.map(load_store, filenames)
+
+    dsets = []
+    for filename, store in zip(filenames, stores):
+        dset = store.to_dataframe()
+        dset['mouse'] = Path(filename).stem
+        dsets.append(dset)
+
+    return pd.concat(dsets)
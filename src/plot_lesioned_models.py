@@ -5,42 +5,71 @@ import numpy as np
 import pandas as pd
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
-from gp_ppc import load_data
-from gp_model import extract_filters
+from gp_ppc import ppc_loader, prepare_data, PredictiveDistribution
+from gp_features import extract_filters
 from plot_orsolic_paper import plot_psycho, plot_chrono
 from strenum import strenum
+from trial_store import PredictionLoader
 import seaborn as sb
 
-def get_lick_stims(row, filter_idx):
+# prediction columns used to plot filter activations at the time of licks
+STIMS_COLUMNS = ['sig', 'hazard', 'rt', 'outcome', 'projected_stim']
+
+def get_lick_stims(projected_stim, rt, filter_idx):
     """
     Get filter activations at the time of licks
 
-    row - row of dataframe for a given trial
+    projected_stim - projected stimulus of each trial, as a ragged array
+    rt - reaction time of each trial, NaN for trials without lick
     filter_idx - filter activations to extract
     """
-    if ~np.isnan(row.rt):
-        return row.projected_stim[int(row.rt), filter_idx]
-    else:
-        return np.nan
-
-def make_plots(model_dir, block, axes, axes_early, folds, n_samples):
-    """Plot the effects of zeroing top filters"""
-    pred_filename = model_dir + 'predictions.pickle'
-    pred_filename_0 = model_dir + 'predictions_drop_filter_0.pickle'
-    pred_filename_1 = model_dir + 'predictions_drop_filter_1.pickle'
-    dset, dset_pred_full = load_data(pred_filename, n_samples, folds)
-    _, dset_pred_0 = load_data(pred_filename_0, n_samples, folds)
-    _, dset_pred_1 = load_data(pred_filename_1, n_samples, folds)
+    rt = np.asarray(rt, dtype=float)
+    lick = ~np.isnan(rt)
+    lick_stims = projected_stim.take(lick)
+    lick_rt = rt[lick].astype(int)
+    if np.any((lick_rt < 0) | (lick_rt >= lick_stims.lengths)):
+        raise ValueError('Reaction times beyond the end of their trials.')
+    stims = np.full(len(rt), np.nan)
+    stims[lick] = lick_stims.gather(lick_rt)[:, filter_idx]
+    return stims
+
+def early_proportions(dset_pred, n_samples):
+    """proportions of early licks of each predictive sample
+
+    Only proportions are sampled from the exact predictive distribution.
+    """
+    if isinstance(dset_pred, PredictiveDistribution):
+        return dset_pred.sample_proportions(dset_pred.early, n_samples)
+    return dset_pred.early.mean(axis=0)
+
+def make_plots(model_dir, block, axes, axes_early, loaders, n_samples,
+               analytic=False):
+    """
+    Plot the effects of zeroing top filters
+
+    loaders - loaders of predictive checks data and of stimulus projections,
+              shared by both blocks so that each file is read once
+    """
+    pred_filenames = [
+        model_dir + 'predictions.trials',
+        model_dir + 'predictions_drop_filter_0.trials',
+        model_dir + 'predictions_drop_filter_1.trials'
+    ]
+    ppc_loader, stims_loader = loaders
     if block == 'split':
-        dset = dset[dset.hazard != 'nonsplit'].copy()
-        dset_pred_full = dset_pred_full[dset_pred_full.hazard != 'nonsplit'].copy()
-        dset_pred_0 = dset_pred_0[dset_pred_0.hazard != 'nonsplit'].copy()
-        dset_pred_1 = dset_pred_1[dset_pred_1.hazard != 'nonsplit'].copy()
+        where = lambda store: store['hazard'] != 'nonsplit'
+        stims_where = where
     else:
-        dset = dset[dset.hazard == 'nonsplit'].copy()
-        dset_pred_full = dset_pred_full[dset_pred_full.hazard == 'nonsplit'].copy()
-        dset_pred_0 = dset_pred_0[dset_pred_0.hazard == 'nonsplit'].copy()
-        dset_pred_1 = dset_pred_1[dset_pred_1.hazard == 'nonsplit'].copy()
+        where = lambda store: store['hazard'] == 'nonsplit'
+        stims_where = lambda store: store['hazard'] != 'split'
+
+    store = ppc_loader.load(pred_filenames, where)
+    sources, _ = store.codes('source')
+    n_pred_samples = None if analytic else n_samples
+    dset, dset_pred_full = prepare_data(
+        store.take(sources == 0), n_pred_samples)
+    _, dset_pred_0 = prepare_data(store.take(sources == 1), n_pred_samples)
+    _, dset_pred_1 = prepare_data(store.take(sources == 2), n_pred_samples)
 
     dsets = [ dset_pred_full, dset_pred_0, dset_pred_1 ]
     (f0_color, f1_color) = (sb.xkcd_rgb['mauve'], sb.xkcd_rgb['green'])
@@ -73,17 +102,15 @@ def make_plots(model_dir, block, axes, axes_early, folds, n_samples):
     # plot filter activations at the time of licks
     model_params = dict(np.load(model_dir + 'model/model_params_best.npz'))
     filters, filters_idx, flip_mask = extract_filters(model_params)
-    predictions = pd.read_pickle(pred_filename)
+    predictions = stims_loader.load(pred_filenames[:1], stims_where)
+    projected_stim = predictions['projected_stim']
+    predictions = predictions.to_dataframe(['sig', 'hazard', 'rt', 'outcome'])
     predictions['sig'] /= np.log(2)
 
-    if block == 'split':
-        predictions = predictions[predictions.hazard != 'nonsplit'].copy()
-    else:
-        predictions = predictions[predictions.hazard != 'split'].copy()
     for (f, c) in zip([0, 1], [f0_color, f1_color]):
         col_name = 'lick_stim_{}'.format(f)
-        predictions[col_name] = predictions.apply(get_lick_stims,
-            args=(filters_idx[f],), axis=1)
+        predictions[col_name] = get_lick_stims(
+            projected_stim, predictions.rt, filters_idx[f])
         # make sure sign of filter activations is consistent
         if flip_mask[f]:
             predictions[col_name] = -predictions[col_name]
@@ -97,11 +124,14 @@ def make_plots(model_dir, block, axes, axes_early, folds, n_samples):
     axes[2].axhline(0, linestyle=':')
 
     # plot proportion of early licks
-    early_licks_full = dset_pred_full.groupby('sample_id').agg({'early': np.mean})
+    early_licks_full = pd.DataFrame(
+        {'early': early_proportions(dset_pred_full, n_samples)})
     early_licks_full['dset'] = 'Full'
-    early_licks_0 = dset_pred_0.groupby('sample_id').agg({'early': np.mean})
+    early_licks_0 = pd.DataFrame(
+        {'early': early_proportions(dset_pred_0, n_samples)})
     early_licks_0['dset'] = 'Without filter 1'
-    early_licks_1 = dset_pred_1.groupby('sample_id').agg({'early': np.mean})
+    early_licks_1 = pd.DataFrame(
+        {'early': early_proportions(dset_pred_1, n_samples)})
     early_licks_1['dset'] = 'Without filter 2'
 
     my_pal = {"Full": "k",
@@ -119,12 +149,15 @@ def make_plots(model_dir, block, axes, axes_early, folds, n_samples):
 
 Fold = strenum('Fold', 'train val test')
 
-def main(figure_dir, *, folds=('test','val','train'), n_samples=200):
+def main(figure_dir, *, folds=('test','val','train'), n_samples=200,
+         analytic=False):
     """Evaluate the contribution of the top two stimulus filters to model performance
 
     :param str figure_dir: directory for generated figures
     :param list[Fold] folds: data folds to use
     :param int n_samples: number of samples
+    :param bool analytic: use the exact predictive distribution, only sampling
+                          early licks proportions
 
     """
     # set seaborn style, fix sans-serif font to avoid missing minus sign in pdf
@@ -160,12 +193,15 @@ def main(figure_dir, *, folds=('test','val','train'), n_samples=200):
         for ii, mouse in enumerate(mice):
             model_dir = 'manuscript/results/' + mouse + \
                 '__constant__matern52__proj_wtime__ard/'
+            loaders = (ppc_loader(folds), PredictionLoader(STIMS_COLUMNS))
             # running version, no hazard rate blocks
             make_plots(model_dir, 'nonsplit',
-                axes_plots[ii,0:3], axes_early[0,ii], folds, n_samples)
+                axes_plots[ii,0:3], axes_early[0,ii], loaders, n_samples,
+                analytic)
             # stationary version with hazard rate blocks
             make_plots(model_dir, 'split',
-                axes_plots[ii,3:], axes_early[1,ii], folds, n_samples)
+                axes_plots[ii,3:], axes_early[1,ii], loaders, n_samples,
+                analytic)
 
         sb.despine(fig_plots, offset=3, trim=False)
         fig_plots.tight_layout()
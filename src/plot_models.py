@@ -4,14 +4,14 @@ from pathlib import Path
 
 import defopt
 import numpy as np
-import pandas as pd
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 import seaborn as sb
 from scipy.special import expit
-import gp_predict
-from gp_model import build_model, _prepare_X, predict_logpmf
+from gp_features import _prepare_X
+from gp_numpy import load_model
+from trial_store import read_predictions
 
 
 def extract_filters(params):
@@ -184,15 +184,19 @@ def main(result_dir, fig_dir):
             model_path = result_path / model_name / 'model'
             #gp_predict.main(model_path, result_path / 'predictions.pickle', nsamples=200)
 
-            dset = pd.read_pickle(model_path / 'dataset.pickle')
             model_opts = np.load(model_path / 'model_options.npz')
             model_params = dict(np.load(model_path / 'model_params_best.npz'))
-            model = build_model(dset[dset.train], fast_init=True, **model_opts)
-            model.assign(model_params)
+            model = load_model(model_path, model_params)
 
-            predictions = pd.read_pickle(result_path / model_name / 'predictions.pickle')
+            predictions = read_predictions(
+                result_path / model_name / 'predictions.trials'
+            )
 
-            sample = predictions.loc[1]
+            # only convert the displayed trial
+            sample = (
+                predictions.take(predictions.index == 1)
+                .to_dataframe().iloc[0]
+            )
             plot_model_parts(sample, model, model_params, model_opts, axes[i, :])
         sb.despine(fig, offset=3, trim=False)
         fig.tight_layout(pad=0.5)
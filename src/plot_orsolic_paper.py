@@ -8,58 +8,88 @@ import matplotlib.ticker as ticker
 import seaborn as sb
 import defopt
 
-from gp_ppc import load_data
-from scipy.stats import gaussian_kde
+from gp_ppc import ppc_loader, prepare_data, PredictiveDistribution
+from rt_density import (
+    kde_curves, cdf_curves, percentile_bands, expected_kde_curves,
+    expected_cdf_curves
+)
+
+
+# number of standard deviations covering 95% of a Gaussian distribution
+Z_95 = 1.96
 
 
 def plot_psycho(dset_pred, ax, label, color='k'):
     """plot predictive psychometric curve"""
 
-    hitlicks_pred = (
-        dset_pred[~dset_pred['early']]
-        .groupby(['sig', 'sample_id']).agg({'hit': 'mean'})
-        .unstack()
-    )
-    hitlicks_mean = hitlicks_pred.mean(axis=1)
-    hitlicks_prc = hitlicks_pred.quantile([0.025, 0.975], axis=1)
+    if isinstance(dset_pred, PredictiveDistribution):
+        sigs, hitlicks_mean, hitlicks_std = dset_pred.group_proportion(
+            'sig', dset_pred.hit, 1 - dset_pred.early
+        )
+        hitlicks_prc = [hitlicks_mean - Z_95 * hitlicks_std,
+                        hitlicks_mean + Z_95 * hitlicks_std]
+    else:
+        sigs, hitlicks_pred = dset_pred.group_mean(
+            'sig', dset_pred.hit, ~dset_pred.early
+        )
+        hitlicks_mean = np.nanmean(hitlicks_pred, axis=1)
+        hitlicks_prc = np.nanpercentile(hitlicks_pred, [2.5, 97.5], axis=1)
 
     ax.fill_between(
-        hitlicks_pred.index, hitlicks_prc.loc[0.025], hitlicks_prc.loc[0.975],
-        alpha=0.3, lw=0, color=color
+        sigs, hitlicks_prc[0], hitlicks_prc[1], alpha=0.3, lw=0, color=color
     )
 
-    ax.plot(hitlicks_mean, color=color, label=label, alpha=0.8)
+    ax.plot(sigs, hitlicks_mean, color=color, label=label, alpha=0.8)
 
 
 def plot_chrono(dset_pred, period, ax, color='k'):
     """plot predictive chronometric curve"""
 
-    hitrt_pred = period * (
-        dset_pred[dset_pred['hit'] & (dset_pred['sig'] > 0)]
-        .groupby(['sig', 'sample_id']).agg({'rt_change': 'median'})
-        .unstack()
-    )
-    hitrt_mean = hitrt_pred.median(axis=1)
-    hitrt_prc = hitrt_pred.quantile([0.025, 0.975], axis=1)
+    if isinstance(dset_pred, PredictiveDistribution):
+        sigs, hitrt_mean, hitrt_std = (
+            dset_pred[dset_pred.sig > 0]
+            .group_rt_median('sig', 'hit', aligned=True)
+        )
+        hitrt_mean = period * hitrt_mean
+        hitrt_prc = [hitrt_mean - Z_95 * period * hitrt_std,
+                     hitrt_mean + Z_95 * period * hitrt_std]
+    else:
+        sigs, hitrt_pred = dset_pred.group_median(
+            'sig', dset_pred.rt_change,
+            dset_pred.hit & (dset_pred.sig > 0)[:, np.newaxis]
+        )
+        hitrt_pred *= period
+        hitrt_mean = np.nanmedian(hitrt_pred, axis=1)
+        hitrt_prc = np.nanpercentile(hitrt_pred, [2.5, 97.5], axis=1)
 
     ax.fill_between(
-        hitrt_pred.index, hitrt_prc.loc[0.025], hitrt_prc.loc[0.975],
-        alpha=0.3, lw=0, color=color
+        sigs, hitrt_prc[0], hitrt_prc[1], alpha=0.3, lw=0, color=color
     )
 
-    ax.plot(hitrt_mean, color=color, alpha=0.8)
+    ax.plot(sigs, hitrt_mean, color=color, alpha=0.8)
+
+
+def _rt_samples(dset_pred, event):
+    """sampled reaction-times of licks or early licks, for each sample"""
+    where = dset_pred.early if event == 'early' else ~dset_pred.miss
+    return dset_pred.sample_values(dset_pred.rt, where)
 
 
-def plot_rt_cdf(dset_pred, rt_range, period, color, ax):
+def plot_rt_cdf(dset_pred, event, rt_range, period, color, ax):
     """plot cumulative density function for reaction time"""
-    sample_groups = dset_pred[~dset_pred['miss']].groupby('sample_id')
-    cdf_pred = np.zeros((len(sample_groups), len(rt_range)))
-    for i, (_, group) in enumerate(sample_groups):
-        cdf_pred[i] = np.mean(
-            group.rt.values[:, np.newaxis] <= rt_range, axis=0
+    if isinstance(dset_pred, PredictiveDistribution):
+        _, times, pmf, counts = dset_pred.group_rt_pmf(None, event)
+        if len(counts) == 0:
+            return
+        cdf_mean, cdf_std = expected_cdf_curves(
+            pmf, times[0], rt_range, counts
         )
-    cdf_perc = np.percentile(cdf_pred, [2.5, 97.5], axis=0)
-    cdf_mean = cdf_pred.mean(0)
+        cdf_mean, cdf_std = cdf_mean[0], cdf_std[0]
+        cdf_perc = [cdf_mean - Z_95 * cdf_std, cdf_mean + Z_95 * cdf_std]
+    else:
+        cdf_pred = cdf_curves(_rt_samples(dset_pred, event), rt_range)
+        cdf_perc = percentile_bands(cdf_pred)
+        cdf_mean = np.nanmean(cdf_pred, axis=0)
 
     rt_test_sec = rt_range * period
     ax.fill_between(rt_test_sec, cdf_perc[0], cdf_perc[1], alpha=0.3, lw=0,
@@ -67,16 +97,22 @@ def plot_rt_cdf(dset_pred, rt_range, period, color, ax):
     ax.plot(rt_test_sec, cdf_mean, alpha=0.8, color=color)
 
 
-def plot_rt_kde(dset_pred, rt_range, period, color, ax):
+def plot_rt_kde(dset_pred, event, rt_range, period, color, ax):
     """plot cumulative density function for reaction time"""
-    sample_groups = dset_pred[~dset_pred['miss']].groupby('sample_id')
-    kde_pred = np.zeros((len(sample_groups), len(rt_range)))
-    for i, (_, group) in enumerate(sample_groups):
-        kernel = gaussian_kde(group.rt.values)
-        kde_pred[i] = kernel(rt_range).T
-
-    kde_perc = np.percentile(kde_pred, [2.5, 97.5], axis=0)
-    kde_median = np.median(kde_pred, axis=0)
+    if isinstance(dset_pred, PredictiveDistribution):
+        _, times, pmf, counts = dset_pred.group_rt_pmf(None, event)
+        if len(counts) == 0:
+            return
+        kde_median, kde_std = expected_kde_curves(
+            pmf, times[0], rt_range, counts
+        )
+        kde_median, kde_std = kde_median[0], kde_std[0]
+        kde_perc = [np.maximum(kde_median - Z_95 * kde_std, 0),
+                    kde_median + Z_95 * kde_std]
+    else:
+        kde_pred = kde_curves(_rt_samples(dset_pred, event), rt_range)
+        kde_perc = percentile_bands(kde_pred)
+        kde_median = np.nanmedian(kde_pred, axis=0)
 
     rt_test_sec = rt_range * period
     ax.fill_between(rt_test_sec, kde_perc[0], kde_perc[1], alpha=0.3, lw=0,
@@ -137,20 +173,21 @@ def plot_psycho_chrono(dset_test, dset_gp, filters, axes, early_licks):
     # cumulative density function of early licks
     if early_licks:
         dset_test = dset_test[dset_test['early']]
-        dset_gp = dset_gp[dset_gp['early']]
+        gp_event = 'early'
+    else:
+        gp_event = 'lick'
 
     for i, (hazard, dset_group) in enumerate(dset_test.groupby('hazard')):
         rt_range = np.linspace(0, 16, num=161) / period
         rt_test = np.sort(dset_group[~dset_group['miss']]['rt'].values)
         # cdf_test = np.mean(rt_test[:, np.newaxis] <= rt_range, axis=0)
 
-        kernel = gaussian_kde(rt_test)
-        kde_test = kernel(rt_range)
+        kde_test = kde_curves([rt_test], rt_range)[0]
 
         axes[2].plot(rt_range * period, kde_test, '--',
                      dashes=(4, 4), color=cmap[i])
-        plot_rt_kde(dset_gp[dset_gp.hazard == hazard], rt_range, period,
-                    color=cmap[i], ax=axes[2])
+        plot_rt_kde(dset_gp[dset_gp.hazard == hazard], gp_event, rt_range,
+                    period, color=cmap[i], ax=axes[2])
 
     axes[2].set_xlabel('Time from stimulus onset (s)')
     axes[2].set_ylabel('Early lick density')
@@ -190,13 +227,16 @@ def load_filters(model_path):
     return filters
 
 
-def main(fname, *, supplement=False, early_licks=False, all_splits=False):
+def main(fname, *, supplement=False, early_licks=False, all_splits=False,
+         analytic=False):
     """Plot model fit summaries
 
     :param str fname: output file name
     :param bool supplement: whether to print supplemental figure
     :param bool early_licks: whether to only plot timing of early licks
     :param bool all_splits: whether to use all splits
+    :param bool analytic: whether to use the exact predictive distribution
+                          instead of sampling reaction-times
     """
 
     # set seaborn style, fix sans-serif font to avoid missing minus sign in pdf
@@ -235,25 +275,24 @@ def main(fname, *, supplement=False, early_licks=False, all_splits=False):
         len(models), 4, figsize=(20/2.54, 4.25/2.54 * len(models))
     )
 
-    for idx, model in enumerate(models):
-        # define input models
-        gp_path = Path('results', model)
+    # define input models and load their predictions concurrently
+    gp_paths = [Path('results', model) for model in models]
+    folds = ('test', 'train', 'val') if all_splits else ('test',)
+    predictions = ppc_loader(folds).load(
+        [gp_path / 'predictions.trials' for gp_path in gp_paths],
+        where=lambda store: store['hazard'] != 'nonsplit'
+    )
+    sources, _ = predictions.codes('source')
 
+    for idx, gp_path in enumerate(gp_paths):
         # fix random seed for reproducibitity
         np.random.seed(1234)
 
-        # load model, make predictions and get filters
-        if all_splits:
-            dset_test, dset_gp = load_data(
-                gp_path / 'predictions.pickle', 500, ('test', 'train', 'val')
-            )
-        else:
-            dset_test, dset_gp = load_data(
-                gp_path / 'predictions.pickle', 500, ('test',)
-            )
-
-        dset_test = dset_test[dset_test.hazard != 'nonsplit'].copy()
-        dset_gp = dset_gp[dset_gp.hazard != 'nonsplit'].copy()
+        # make predictions and get filters
+        n_samples = None if analytic else 500
+        dset_test, dset_gp = prepare_data(
+            predictions.take(sources == idx), n_samples
+        )
 
         model_opts = np.load(gp_path / 'model' / 'model_options.npz')
         if 'proj' in model_opts['kernels_input']:
@@ -0,0 +1,202 @@
+"""density and cumulative distribution curves of many reaction-time samples
+
+Reaction-times live on an integer frame grid, so curves of all predictive
+samples are computed at once from their histograms, Gaussian kernel density
+estimates being obtained by FFT convolution and CDFs by cumulative sums.
+Expected curves of samples drawn from known discrete distributions, and their
+sampling variability, are computed the same way from the distributions.
+"""
+
+import numpy as np
+from scipy.fftpack import next_fast_len
+
+
+def histograms(samples, start, n_bins):
+    """counts of integer-valued samples, in bins `start` to `start + n_bins`
+
+    Returns a samples x bins array, values outside of the bins being ignored.
+    """
+    lengths = [len(sample) for sample in samples]
+    if sum(lengths) == 0:
+        return np.zeros((len(samples), n_bins))
+    values = np.concatenate(samples).astype(int) - start
+    sample_ids = np.repeat(np.arange(len(samples)), lengths)
+    valid = (values >= 0) & (values < n_bins)
+    counts = np.bincount(
+        sample_ids[valid] * n_bins + values[valid],
+        minlength=len(samples) * n_bins
+    )
+    return counts.reshape(len(samples), n_bins).astype(float)
+
+
+def _interpolate(curves, start, grid):
+    """linear interpolation of curves defined on integers from `start`"""
+    positions = np.clip(grid - start, 0, curves.shape[1] - 1)
+    low = np.floor(positions).astype(int)
+    high = np.minimum(low + 1, curves.shape[1] - 1)
+    weights = positions - low
+    return curves[:, low] * (1 - weights) + curves[:, high] * weights
+
+
+def scott_bandwidths(samples):
+    """kernel bandwidth of each sample, as in scipy.stats.gaussian_kde"""
+    return np.array([
+        np.std(sample, ddof=1) * len(sample) ** (-1 / 5)
+        if len(sample) > 1 else np.nan
+        for sample in samples
+    ])
+
+
+def gaussian_smooth(counts, bandwidths):
+    """convolve each row of binned values with a Gaussian kernel, using FFT
+
+    `bandwidths` are kernel standard deviations, in bins, one per row.
+    """
+    n_bins = counts.shape[1]
+
+    # padding to avoid kernel tails wrapping around with the circular FFT
+    max_bandwidth = bandwidths.max() if len(bandwidths) > 0 else 0
+    n_pad = int(np.ceil(6 * max_bandwidth)) + 1
+    n_fft = next_fast_len(n_bins + n_pad)
+
+    freqs = np.fft.rfftfreq(n_fft)
+    transfer = np.exp(
+        -2 * np.pi ** 2 * bandwidths[:, np.newaxis] ** 2 * freqs ** 2
+    )
+    smoothed = np.fft.irfft(
+        np.fft.rfft(counts, n_fft, axis=1) * transfer, n_fft, axis=1
+    )[:, :n_bins]
+    return np.maximum(smoothed, 0, out=smoothed)
+
+
+def kde_curves(samples, grid, bandwidths=None, cut=None):
+    """Gaussian kernel density estimates of integer-valued samples
+
+    Histograms of all samples are smoothed at once in the Fourier domain, each
+    sample with its own bandwidth (Scott's rule by default), and evaluated on
+    `grid`. If `cut` is given, curves are set to NaN beyond `cut` bandwidths
+    from the extreme values of each sample, as in `seaborn.kdeplot`. Returns a
+    samples x grid array, NaN for empty samples.
+    """
+    samples = [np.asarray(sample) for sample in samples]
+    grid = np.asarray(grid, dtype=float)
+    if bandwidths is None:
+        bandwidths = scott_bandwidths(samples)
+    bandwidths = np.nan_to_num(bandwidths)
+    n_values = np.array([len(sample) for sample in samples])
+
+    # integer range covering the grid and all samples
+    nonempty = [sample for sample in samples if len(sample) > 0]
+    start = int(np.floor(min([grid.min()] + [s.min() for s in nonempty])))
+    stop = int(np.ceil(max([grid.max()] + [s.max() for s in nonempty])))
+    n_bins = stop - start + 1
+
+    counts = histograms(samples, start, n_bins)
+    density = gaussian_smooth(counts, bandwidths)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density /= n_values[:, np.newaxis]
+
+    curves = _interpolate(density, start, grid)
+
+    if cut is not None:
+        for curve, sample, bandwidth in zip(curves, samples, bandwidths):
+            if len(sample) > 0:
+                outside = (
+                    (grid < sample.min() - cut * bandwidth)
+                    | (grid > sample.max() + cut * bandwidth)
+                )
+                curve[outside] = np.nan
+
+    return curves
+
+
+def cdf_curves(samples, grid):
+    """empirical cumulative distribution functions of integer-valued samples
+
+    Returns a samples x grid array of `P(x <= grid)`, NaN for empty samples.
+    """
+    samples = [np.asarray(sample) for sample in samples]
+    grid = np.asarray(grid, dtype=float)
+    n_values = np.array([len(sample) for sample in samples])
+
+    nonempty = [sample for sample in samples if len(sample) > 0]
+    start = int(np.floor(min([grid.min()] + [s.min() for s in nonempty])))
+    stop = int(np.ceil(max([grid.max()] + [s.max() for s in nonempty])))
+
+    counts = histograms(samples, start, stop - start + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdf = np.cumsum(counts, axis=1) / n_values[:, np.newaxis]
+    return cdf[:, np.floor(grid).astype(int) - start]
+
+
+def percentile_bands(curves, percentiles=(2.5, 97.5)):
+    """percentiles of curves over samples, ignoring empty samples"""
+    curves = curves[~np.all(np.isnan(curves), axis=1)]
+    return np.nanpercentile(curves, percentiles, axis=0)
+
+
+def _pad_pmf(pmf, start, grid):
+    """extend distributions on integers from `start` to cover `grid`"""
+    new_start = int(min(start, np.floor(grid.min())))
+    new_stop = int(max(start + pmf.shape[1] - 1, np.ceil(grid.max())))
+    padded = np.zeros((pmf.shape[0], new_stop - new_start + 1))
+    padded[:, start - new_start:start - new_start + pmf.shape[1]] = pmf
+    return padded, new_start
+
+
+def expected_kde_curves(pmf, start, grid, n_values):
+    """expected kernel density estimates of samples of discrete distributions
+
+    Rows of `pmf` are distributions on integers from `start` and `n_values`
+    the (expected) sizes of samples drawn from them, which set the Scott's
+    rule bandwidths. Returns the mean and standard deviation of the density
+    estimates on `grid`, as two rows x grid arrays.
+    """
+    grid = np.asarray(grid, dtype=float)
+    n_values = np.asarray(n_values, dtype=float)
+
+    times = start + np.arange(pmf.shape[1])
+    mean = pmf @ times
+    variance = np.maximum(pmf @ times ** 2 - mean ** 2, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bandwidths = np.sqrt(variance * n_values / (n_values - 1))
+        bandwidths *= n_values ** (-1 / 5)
+    bandwidths = np.nan_to_num(bandwidths)
+
+    pmf, start = _pad_pmf(pmf, start, grid)
+    density = gaussian_smooth(pmf, bandwidths)
+
+    # squared Gaussian kernels are Gaussian kernels with a bandwidth divided
+    # by sqrt(2), scaled by 1 / (2 * sqrt(pi) * bandwidth)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density_sq = (
+            gaussian_smooth(pmf, bandwidths / np.sqrt(2))
+            / (2 * np.sqrt(np.pi) * bandwidths[:, np.newaxis])
+        )
+        density_var = (density_sq - density ** 2) / n_values[:, np.newaxis]
+    density_std = np.sqrt(np.maximum(density_var, 0))
+
+    return (
+        _interpolate(density, start, grid),
+        _interpolate(density_std, start, grid)
+    )
+
+
+def expected_cdf_curves(pmf, start, grid, n_values):
+    """expected empirical CDFs of samples of discrete distributions
+
+    Rows of `pmf` are distributions on integers from `start` and `n_values`
+    the (expected) sizes of samples drawn from them. Returns the mean and
+    standard deviation of the empirical CDFs on `grid`, as two rows x grid
+    arrays.
+    """
+    grid = np.asarray(grid, dtype=float)
+    n_values = np.asarray(n_values, dtype=float)
+
+    pmf, start = _pad_pmf(pmf, start, grid)
+    cdf = np.minimum(np.cumsum(pmf, axis=1), 1)[
+        :, np.floor(grid).astype(int) - start
+    ]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdf_std = np.sqrt(cdf * (1 - cdf) / n_values[:, np.newaxis])
+    return cdf, cdf_std
@@ -0,0 +1,522 @@
+import hashlib
+import json
+import os
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+
+class Ragged:
+    """sequence of variable-length arrays stored in one contiguous buffer
+
+    Rows of the i-th array are `values[offsets[i]:offsets[i+1]]`. Values can
+    have trailing dimensions, shared by all arrays.
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_arrays(cls, arrays, dtype=None):
+        """concatenate a sequence of arrays into a ragged array"""
+        arrays = [np.asarray(array, dtype=dtype) for array in arrays]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in arrays], out=offsets[1:])
+        if arrays:
+            values = np.concatenate(arrays)
+        else:
+            values = np.zeros(0, dtype=dtype or float)
+        return cls(values, offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def take(self, idx):
+        """select arrays given their indices, as a new ragged array"""
+        idx = np.arange(len(self))[idx]
+        lengths = self.lengths[idx]
+        offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = (
+            np.repeat(self.offsets[idx] - offsets[:-1], lengths)
+            + np.arange(offsets[-1])
+        )
+        return Ragged(self.values[positions], offsets)
+
+    def gather(self, rows):
+        """select one row of each array, negative rows counting from the end
+
+        Returns the selected rows stacked in one array, in a single indexing
+        step over the values buffer. Rows outside of their array raise an
+        `IndexError`, instead of reading a neighbouring array.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = self.lengths
+        if np.any((rows >= lengths) | (rows < -lengths)):
+            raise IndexError('Rows out of range of their arrays.')
+        bases = np.where(rows < 0, self.offsets[1:], self.offsets[:-1])
+        return self.values[bases + rows]
+
+    def tolist(self):
+        return list(self)
+
+
+def _is_arrays(values):
+    """check if a sequence only contains numerical or string arrays"""
+    return len(values) > 0 and all(
+        isinstance(x, np.ndarray) and x.dtype.kind in 'biufU' for x in values
+    )
+
+
+class TrialStore:
+    """columnar dataset of trials, with scalar and ragged columns
+
+    Scalar columns are typed arrays, string columns are stored as categorical
+    codes and per-trial arrays (e.g. stimuli) are stored as `Ragged` arrays.
+    Stores can be saved in a folder of `.npy` files, which are memory-mapped
+    when loaded back.
+    """
+
+    def __init__(self, columns, categories=None, index=None):
+        self._columns = OrderedDict(columns)
+        self._categories = dict(categories or {})
+        n_trials = len(next(iter(self._columns.values()))) if columns else 0
+        self.index = np.arange(n_trials) if index is None else index
+
+    @classmethod
+    def from_dataframe(cls, dset):
+        """convert a dataframe, with per-trial arrays in object columns"""
+        columns, categories = OrderedDict(), {}
+
+        for name, column in dset.items():
+            if column.dtype.name == 'category':
+                categories[name] = list(column.cat.categories)
+                columns[name] = column.cat.codes.values
+            elif column.dtype.kind in 'biuf':
+                columns[name] = column.values
+            elif _is_arrays(column.values):
+                columns[name] = Ragged.from_arrays(column.values)
+            else:
+                column = column.astype('category')
+                categories[name] = list(column.cat.categories)
+                columns[name] = column.cat.codes.values
+
+        return cls(columns, categories, dset.index.values)
+
+    def to_dataframe(self, columns=None):
+        """convert into a dataframe, ragged columns becoming object columns"""
+        import pandas as pd
+        columns = self.columns if columns is None else columns
+        data = {}
+        for name in columns:
+            column = self[name]
+            if isinstance(column, Ragged):
+                column = column.tolist()
+            data[name] = column
+        return pd.DataFrame(data, index=self.index, columns=columns)
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    def codes(self, name):
+        """categorical codes and categories of a string column"""
+        return self._columns[name], self._categories[name]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._columns:
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            column = self._columns[key]
+            if key in self._categories:
+                categories = np.asarray(self._categories[key], dtype=object)
+                column = np.where(column >= 0, categories[column], None)
+            return column
+        return self.take(key)
+
+    def __setitem__(self, name, column):
+        self._categories.pop(name, None)
+        if isinstance(column, Ragged):
+            pass
+        elif _is_arrays(column):
+            column = Ragged.from_arrays(column)
+        else:
+            column = np.asarray(column)
+        self._columns[name] = column
+
+    def take(self, idx):
+        """select trials given a boolean mask or indices, as a new store"""
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        columns = OrderedDict(
+            (name, column.take(idx) if isinstance(column, Ragged)
+             else column[idx])
+            for name, column in self._columns.items()
+        )
+        return TrialStore(columns, self._categories, self.index[idx])
+
+    @classmethod
+    def concat(cls, stores, source_name=None, sources=None):
+        """concatenate stores with the same columns into a new store
+
+        Categories of string columns are merged. If `source_name` is given, a
+        categorical column with this name records the source of each trial,
+        using `sources` labels, one per store.
+        """
+        first = stores[0]
+        columns, categories = OrderedDict(), {}
+
+        for name in first.columns:
+            parts = [store._columns[name] for store in stores]
+            if isinstance(parts[0], Ragged):
+                lengths = np.concatenate([part.lengths for part in parts])
+                offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+                np.cumsum(lengths, out=offsets[1:])
+                values = np.concatenate([part.values for part in parts])
+                columns[name] = Ragged(values, offsets)
+            elif name in first._categories:
+                # recode each store, keeping -1 for missing values
+                lookup = OrderedDict()
+                codes = []
+                for store, part in zip(stores, parts):
+                    mapping = np.array([
+                        lookup.setdefault(category, len(lookup))
+                        for category in store._categories[name]
+                    ] + [-1])
+                    codes.append(mapping[part])
+                columns[name] = np.concatenate(codes)
+                categories[name] = list(lookup)
+            else:
+                columns[name] = np.concatenate(parts)
+
+        if source_name is not None:
+            columns[source_name] = np.repeat(
+                np.arange(len(stores)), [len(store) for store in stores]
+            )
+            categories[source_name] = list(sources)
+
+        index = np.concatenate([store.index for store in stores])
+        return cls(columns, categories, index)
+
+    def select(self, columns):
+        """subset of columns, as a new store sharing their arrays"""
+        return TrialStore(
+            OrderedDict((name, self._columns[name]) for name in columns),
+            {name: self._categories[name] for name in columns
+             if name in self._categories},
+            self.index
+        )
+
+    def digest(self):
+        """content hash of index, columns and categories"""
+        sha = hashlib.sha1()
+
+        def update(array):
+            array = np.ascontiguousarray(array)
+            sha.update('{}{}'.format(array.dtype.str, array.shape).encode())
+            sha.update(array.tobytes())
+
+        update(self.index)
+        for name, column in self._columns.items():
+            sha.update(name.encode())
+            sha.update(json.dumps(self._categories.get(name)).encode())
+            if isinstance(column, Ragged):
+                update(column.values)
+                update(column.offsets)
+            else:
+                update(column)
+
+        return sha.hexdigest()
+
+    def save(self, path, overwrite=True):
+        """save columns as .npy files in a folder
+
+        The folder is written under a temporary name and then renamed, so that
+        concurrent readers never see a partially written store. If `overwrite`
+        is not set, an existing folder is left untouched.
+        """
+        path = Path(path)
+        tmp_path = path.with_name('{}.tmp{}'.format(path.name, os.getpid()))
+        if tmp_path.exists():
+            shutil.rmtree(str(tmp_path))
+        tmp_path.mkdir(parents=True)
+
+        meta = {'n_trials': len(self), 'columns': []}
+        np.save(str(tmp_path / 'index.npy'), self.index)
+
+        for name, column in self._columns.items():
+            if isinstance(column, Ragged):
+                kind = 'ragged'
+                np.save(str(tmp_path / (name + '.values.npy')), column.values)
+                np.save(str(tmp_path / (name + '.offsets.npy')),
+                        column.offsets)
+            else:
+                kind = 'categorical' if name in self._categories else 'scalar'
+                np.save(str(tmp_path / (name + '.npy')), column)
+            meta['columns'].append({
+                'name': name,
+                'kind': kind,
+                'categories': self._categories.get(name)
+            })
+
+        with (tmp_path / 'columns.json').open('w') as fd:
+            json.dump(meta, fd, indent=4)
+
+        if overwrite and path.exists():
+            shutil.rmtree(str(path))
+        try:
+            tmp_path.rename(path)
+        except OSError:
+            # another process saved the same store in the meantime
+            shutil.rmtree(str(tmp_path))
+            if overwrite:
+                raise
+
+    @classmethod
+    def load(cls, path, columns=None, mmap_mode='r'):
+        """load a saved store, optionally only a subset of its columns"""
+        path = Path(path)
+        with (path / 'columns.json').open() as fd:
+            meta = json.load(fd)
+
+        def load_array(filename):
+            try:
+                return np.load(str(path / filename), mmap_mode=mmap_mode)
+            except ValueError:  # empty arrays cannot be memory-mapped
+                return np.load(str(path / filename))
+
+        store_columns, categories = OrderedDict(), {}
+        for column_meta in meta['columns']:
+            name = column_meta['name']
+            if columns is not None and name not in columns:
+                continue
+            if column_meta['kind'] == 'ragged':
+                store_columns[name] = Ragged(
+                    load_array(name + '.values.npy'),
+                    load_array(name + '.offsets.npy')
+                )
+            else:
+                store_columns[name] = load_array(name + '.npy')
+            if column_meta['kind'] == 'categorical':
+                categories[name] = column_meta['categories']
+
+        if columns is not None:
+            store_columns = OrderedDict(
+                (name, store_columns[name]) for name in columns
+            )
+
+        return cls(store_columns, categories, load_array('index.npy'))
+
+
+# dataset reference and split masks of model folders using a shared store
+DATASET_REF = 'dataset.json'
+DATASET_SPLITS = 'splits.npz'
+SPLITS = ('train', 'val', 'test')
+
+
+def save_dataset(dset, result_path, store_dir=None):
+    """save the dataset of a model folder, optionally in a shared store
+
+    Without a store folder, the whole dataset is saved in the model folder.
+    Otherwise, the dataset without its split columns is saved once in the
+    store folder, named after its content hash, and the model folder only
+    records its relative path and compressed split masks.
+    """
+    result_path = Path(result_path)
+    ref_path = result_path / DATASET_REF
+
+    if store_dir is None:
+        if ref_path.exists():
+            ref_path.unlink()
+        dset.save(result_path / 'dataset.trials')
+        return
+
+    shared = dset.select([name for name in dset.columns if name not in SPLITS])
+    digest = shared.digest()
+    store_path = Path(store_dir) / '{}.trials'.format(digest[:20])
+    if not store_path.exists():
+        store_path.parent.mkdir(parents=True, exist_ok=True)
+        shared.save(store_path, overwrite=False)
+
+    np.savez_compressed(
+        str(result_path / DATASET_SPLITS),
+        **{name: np.asarray(dset[name], dtype=bool) for name in SPLITS}
+    )
+    _write_dataset_ref(ref_path, digest, store_path, dset.columns)
+
+
+def _write_dataset_ref(ref_path, digest, store_path, columns):
+    """record the path of a shared dataset, relative to the model folder"""
+    ref = {
+        'digest': digest,
+        'store': os.path.relpath(str(store_path), str(ref_path.parent)),
+        'columns': columns
+    }
+    with ref_path.open('w') as fd:
+        json.dump(ref, fd, indent=4)
+
+
+def copy_dataset(input_path, output_path):
+    """copy the dataset of a model folder, only its reference if shared"""
+    input_path, output_path = Path(input_path), Path(output_path)
+
+    if (input_path / DATASET_REF).exists():
+        with (input_path / DATASET_REF).open() as fd:
+            ref = json.load(fd)
+        _write_dataset_ref(output_path / DATASET_REF, ref['digest'],
+                           input_path / ref['store'], ref['columns'])
+        shutil.copy(str(input_path / DATASET_SPLITS),
+                    str(output_path / DATASET_SPLITS))
+
+    elif (input_path / 'dataset.trials').exists():
+        if (output_path / 'dataset.trials').exists():
+            shutil.rmtree(str(output_path / 'dataset.trials'))
+        shutil.copytree(str(input_path / 'dataset.trials'),
+                        str(output_path / 'dataset.trials'))
+
+    else:
+        shutil.copy(str(input_path / 'dataset.pickle'),
+                    str(output_path / 'dataset.pickle'))
+
+
+def read_dataset(result_path):
+    """load the dataset saved in a model folder"""
+    result_path = Path(result_path)
+
+    # shared dataset, with split masks of the model
+    ref_path = result_path / DATASET_REF
+    if ref_path.exists():
+        with ref_path.open() as fd:
+            ref = json.load(fd)
+        dset = TrialStore.load(result_path / ref['store'])
+        splits = np.load(str(result_path / DATASET_SPLITS))
+        for name in SPLITS:
+            dset[name] = splits[name]
+        return dset.select(ref['columns'])
+
+    store_path = result_path / 'dataset.trials'
+    if store_path.exists():
+        return TrialStore.load(store_path)
+    # fall back on datasets saved by previous versions
+    import pandas as pd
+    return TrialStore.from_dataframe(
+        pd.read_pickle(str(result_path / 'dataset.pickle'))
+    )
+
+
+def read_predictions(pred_path, columns=None):
+    """load predictions saved by `gp_predict`, optionally only some columns
+
+    Predictions saved as a store are memory-mapped, only reading the requested
+    columns. Pandas pickle files, saved by previous versions, are loaded as a
+    whole and also looked for if the store does not exist.
+    """
+    pred_path = Path(pred_path)
+    if (pred_path / 'columns.json').exists():
+        return TrialStore.load(pred_path, columns)
+    # fall back on predictions saved by previous versions
+    if not pred_path.exists():
+        pred_path = pred_path.with_suffix('.pickle')
+    import pandas as pd
+    dset = pd.read_pickle(str(pred_path))
+    if columns is not None:
+        dset = dset[list(columns)]
+    return TrialStore.from_dataframe(dset)
+
+
+class PredictionLoader:
+    """concurrent loader of the same columns from many prediction files
+
+    Files are read on a thread pool, only keeping trials of the selected folds
+    (all trials by default) and the requested columns, copied out of
+    memory-mapped files. `derived` maps names of additional columns to a
+    function and the list of columns it takes as arguments, evaluated while
+    reading each file so that its input columns are not kept. Each file is
+    read once per loader, repeated requests reusing loaded trials.
+    """
+
+    def __init__(self, columns, folds=None, derived=None, n_workers=4):
+        self.columns = list(columns)
+        self.folds = None if folds is None else [str(fold) for fold in folds]
+        self.derived = OrderedDict(derived or {})
+        self.n_workers = n_workers
+        self._stores = {}
+
+    def _read(self, pred_path):
+        """read selected trials and columns of one prediction file"""
+        read_columns = list(self.columns)
+        derived_inputs = [
+            name for _, inputs in self.derived.values() for name in inputs
+        ]
+        for name in (self.folds or []) + derived_inputs:
+            if name not in read_columns:
+                read_columns.append(name)
+        store = read_predictions(pred_path, read_columns)
+
+        if self.folds is not None:
+            mask = np.zeros(len(store), dtype=bool)
+            for fold in self.folds:
+                mask |= store[fold]
+            store = store.take(mask)
+        else:
+            store = store.take(np.arange(len(store)))
+
+        columns = OrderedDict(
+            (name, store._columns[name]) for name in self.columns
+        )
+        categories = {
+            name: store._categories[name] for name in self.columns
+            if name in store._categories
+        }
+        for name, (fn, inputs) in self.derived.items():
+            columns[name] = np.asarray(fn(*[store[col] for col in inputs]))
+
+        return TrialStore(columns, categories, store.index)
+
+    def load(self, pred_paths, where=None):
+        """load prediction files, as one store with a 'source' column
+
+        The 'source' column gives the path of the file of each trial. If
+        given, `where` is a function returning a mask of trials to keep from
+        the store of each file.
+        """
+        keys = [os.path.abspath(str(pred_path)) for pred_path in pred_paths]
+        missing = [
+            key for key in OrderedDict.fromkeys(keys)
+            if key not in self._stores
+        ]
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            loaded = executor.map(self._read, missing)
+            self._stores.update(zip(missing, loaded))
+
+        stores = [self._stores[key] for key in keys]
+        if where is not None:
+            stores = [store.take(where(store)) for store in stores]
+
+        return TrialStore.concat(
+            stores, 'source', [str(pred_path) for pred_path in pred_paths]
+        )